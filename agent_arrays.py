@@ -0,0 +1,730 @@
+# IMPORT LIBS
+import os
+import numpy as np
+
+from instrumentation import NULL_PROFILER
+from random_streams import keyed_uniforms
+from shared_arrays import to_shared_array, attach_shared_array
+from mapped_arrays import column_path, to_mapped_array, resize_mapped_array, write_manifest
+
+
+class Lang_Agents_Arrays:
+    """ Column store that keeps the state of all language agents in NumPy arrays.
+        Row i of every array holds the state of the agent whose 'row' attribute is i.
+        Besides storage, it implements a vectorized version of Simple_Language_Agent.step
+        so that a whole population can be stepped with a few batched array operations.
+        Population statistics (agents per language type and sums of cat pcts over
+        bilinguals) are kept as running aggregates, updated on every change of
+        language or cat pcts, so that they can be read in constant time.
+        Word counts are packed in int32 pairs, and the total of each pair is kept
+        in a column of its own, so that it is never summed again.
+        Rows of removed agents are kept in a free-list (with x = y = -1) and reused
+        by the next added agents, so that arrays work as a pool of agent slots.
+        Columns can be moved to memory-mapped files (see map_to_disk), so that
+        populations larger than RAM can be stepped in blocks of rows
+    """
+
+    columns = ['x', 'y', 'language', 'spoken', 'heard', 'spoken_total', 'heard_total',
+               'cat_pct_s', 'cat_pct_h', 'cluster']
+    # initial word counts and cat pcts for each lang type 0, 1, 2 => spa, bil, cat
+    init_counts = np.array([[50, 0], [25, 25], [0, 50]])
+    init_cat_pcts = np.array([0., 0.5, 1.])
+    # agents can only switch language after this step
+    lang_switch_start = 10
+    # streams of keyed uniforms drawn in simultaneous steps
+    keyed_streams = {'move': 0, 'match': 1, 'l1': 2, 'l2': 3}
+
+    def __init__(self, capacity, rng):
+        """ Arguments:
+                * capacity: initial number of rows
+                * rng: Buffered_RNG instance used for batched draws
+        """
+        self.rng = rng
+        # optional Step_Profiler, set by the model
+        self.profiler = None
+        # optional Spatial_Metrics, updated on every change of agent state, set by the model
+        self.metrics = None
+        self.num_rows = 0
+        self.x = np.full(capacity, -1, dtype=np.int64)
+        self.y = np.full(capacity, -1, dtype=np.int64)
+        self.language = np.zeros(capacity, dtype=np.int8)  # 0, 1, 2 => spa, bil, cat
+        self.spoken = np.zeros((capacity, 2), dtype=np.int32)  # 0, 1 => spa, cat
+        self.heard = np.zeros((capacity, 2), dtype=np.int32)
+        self.spoken_total = np.zeros(capacity, dtype=np.int32)  # spoken.sum(axis=1)
+        self.heard_total = np.zeros(capacity, dtype=np.int32)
+        self.cat_pct_s = np.zeros(capacity)
+        self.cat_pct_h = np.zeros(capacity)
+        self.cluster = np.full(capacity, -1, dtype=np.int32)  # index of agent's initial cluster, if any
+        # running aggregates
+        self.lang_counts = np.zeros(3, dtype=np.int64)
+        self.biling_cat_pct_h_sum = 0.
+        self.biling_cat_pct_s_sum = 0.
+        # shared memory blocks of columns, see share_memory
+        self.shared_blocks = None
+        # rows of removed agents, reused last-in first-out by add_rows
+        self.free_rows = []
+        # directory of memory-mapped columns, see map_to_disk
+        self.mapped_dir = None
+        # if set, simultaneous steps process agents in blocks of about block_size rows
+        self.block_size = None
+
+    def __len__(self):
+        return self.num_rows
+
+    def _grow(self, min_capacity):
+        """ Double arrays capacity until it can hold min_capacity rows """
+        if self.shared_blocks is not None:
+            raise RuntimeError('agent arrays cannot grow while they are in shared memory')
+        capacity = max(len(self.x), 1)
+        while capacity < min_capacity:
+            capacity *= 2
+        for attr in self.columns:
+            old = getattr(self, attr)
+            if self.mapped_dir is not None:
+                new = resize_mapped_array(self.mapped_dir, attr, old, capacity)
+            else:
+                new = np.zeros((capacity,) + old.shape[1:], dtype=old.dtype)
+                new[:len(old)] = old
+            setattr(self, attr, new)
+        self.x[self.num_rows:] = -1
+        self.y[self.num_rows:] = -1
+        self.cluster[self.num_rows:] = -1
+
+    def add_rows(self, languages, xs=None, ys=None, clusters=None):
+        """ Method to add new agents to the arrays and initialize their
+            language frequencies according to their language type.
+            Free rows are reused first, then rows are appended
+
+            Arguments:
+                * languages: array-like of integers from [0, 1, 2]
+                * xs, ys: optional arrays of coords. By default agents are not on the grid
+                * clusters: optional array of cluster indices
+
+            Returns:
+                * numpy array with the indices of the new rows
+        """
+        languages = np.asarray(languages, dtype=np.int8)
+        num_reused = min(len(languages), len(self.free_rows))
+        reused = self.free_rows[len(self.free_rows) - num_reused:][::-1]
+        del self.free_rows[len(self.free_rows) - num_reused:]
+        appended = np.arange(self.num_rows, self.num_rows + len(languages) - num_reused)
+        if len(appended) and appended[-1] >= len(self.x):
+            self._grow(appended[-1] + 1)
+        rows = np.concatenate((np.array(reused, dtype=np.int64), appended))
+        self.language[rows] = languages
+        self.spoken[rows] = self.init_counts[languages]
+        self.heard[rows] = self.init_counts[languages]
+        self.spoken_total[rows] = self.init_counts[languages].sum(axis=1)
+        self.heard_total[rows] = self.init_counts[languages].sum(axis=1)
+        self.cat_pct_s[rows] = self.init_cat_pcts[languages]
+        self.cat_pct_h[rows] = self.init_cat_pcts[languages]
+        if xs is not None:
+            self.x[rows] = xs
+            self.y[rows] = ys
+        if clusters is not None:
+            self.cluster[rows] = clusters
+        self.num_rows += len(appended)
+        self._update_stats(rows, 1)
+        if self.metrics is not None:
+            self.metrics.update(rows, 1)
+        return rows
+
+    def add_row(self, language):
+        return int(self.add_rows([language])[0])
+
+    def remove_rows(self, rows):
+        """ Method to remove agents from the arrays. Their rows are cleared
+            (x = y = cluster = -1) and added to the free-list
+
+            Arguments:
+                * rows: array-like of unique rows of agents in use
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        self._update_stats(rows, -1)
+        if self.metrics is not None:
+            self.metrics.update(rows, -1)
+        self.x[rows] = -1
+        self.y[rows] = -1
+        self.cluster[rows] = -1
+        self.free_rows.extend(rows.tolist())
+
+    def set_positions(self, rows, xs, ys):
+        """ Write coords of agents (-1 for agents off the grid), keeping spatial metrics
+            up to date
+
+            Arguments:
+                * rows: unique agent rows, or a single row
+                * xs, ys: scalars or arrays of new coords
+        """
+        if self.metrics is None:
+            self.x[rows] = xs
+            self.y[rows] = ys
+            return
+        metric_rows = [rows] if isinstance(rows, (int, np.integer)) else rows
+        keys = self.metrics.get_keys(metric_rows)
+        self.x[rows] = xs
+        self.y[rows] = ys
+        self.metrics.update_changed(metric_rows, keys)
+
+    def set_clusters(self, rows, clusters):
+        """ Write cluster of agents, keeping spatial metrics up to date
+
+            Arguments:
+                * rows: unique agent rows
+                * clusters: scalar or array of cluster indices
+        """
+        keys = None if self.metrics is None else self.metrics.get_keys(rows)
+        self.cluster[rows] = clusters
+        if keys is not None:
+            self.metrics.update_changed(rows, keys)
+
+    def get_rows(self):
+        """ Returns:
+                * sorted array of rows in use: all rows below num_rows but free ones
+        """
+        if not self.free_rows:
+            return np.arange(self.num_rows)
+        in_use = np.ones(self.num_rows, dtype=bool)
+        in_use[self.free_rows] = False
+        return np.flatnonzero(in_use)
+
+    def get_row_blocks(self):
+        """ Returns:
+                * generator of sorted arrays of rows in use, one for each
+                  block of block_size rows below num_rows
+        """
+        free_rows = np.sort(np.array(self.free_rows, dtype=np.int64))
+        for start in range(0, self.num_rows, self.block_size):
+            stop = min(start + self.block_size, self.num_rows)
+            rows = np.arange(start, stop)
+            free = free_rows[np.searchsorted(free_rows, start):np.searchsorted(free_rows, stop)]
+            yield np.setdiff1d(rows, free, assume_unique=True) if len(free) else rows
+
+    def get_state(self, with_columns=True):
+        """ Arguments:
+                * with_columns: if False, columns are left out of the state,
+                  e.g. if they are saved with write_columns
+
+            Returns:
+                * dict with used rows of all columns and running aggregates.
+                  Arrays are not copied
+        """
+        state = {attr: getattr(self, attr)[:self.num_rows] for attr in self.columns} if with_columns else {}
+        state.update(num_rows=self.num_rows, free_rows=np.array(self.free_rows, dtype=np.int64),
+                     lang_counts=self.lang_counts,
+                     biling_cat_pct_h_sum=self.biling_cat_pct_h_sum,
+                     biling_cat_pct_s_sum=self.biling_cat_pct_s_sum)
+        return state
+
+    def set_state(self, state, columns_dir=None):
+        """ Restore columns and running aggregates from a dict built by get_state
+
+            Arguments:
+                * state: dict
+                * columns_dir: optional directory of columns saved by write_columns,
+                  read from their files instead of from state
+        """
+        self.num_rows = state['num_rows']
+        if self.num_rows > len(self.x):
+            self._grow(self.num_rows)
+        columns = state
+        if columns_dir is not None:
+            # files are mapped, so columns are copied without being loaded in RAM
+            columns = {attr: np.load(column_path(columns_dir, attr), mmap_mode='r') for attr in self.columns}
+        for attr in self.columns:
+            if attr in columns:
+                getattr(self, attr)[:self.num_rows] = columns[attr]
+        self.recount_totals()
+        self.free_rows = np.asarray(state.get('free_rows', []), dtype=np.int64).tolist()
+        self.lang_counts = np.array(state['lang_counts'])
+        self.biling_cat_pct_h_sum = state['biling_cat_pct_h_sum']
+        self.biling_cat_pct_s_sum = state['biling_cat_pct_s_sum']
+
+    def write_columns(self, directory):
+        """ Method to write used rows of all columns to .npy files in directory,
+            e.g. to checkpoint columns mapped to disk without loading them in RAM
+
+            Arguments:
+                * directory: path of an existing directory
+        """
+        for attr in self.columns:
+            with open(column_path(directory, attr), 'wb') as f:
+                np.save(f, getattr(self, attr)[:self.num_rows])
+
+    def map_to_disk(self, directory, capacity=1):
+        """ Method to move all columns to .npy files in directory, mapped in memory.
+            Only the pages in use are kept in RAM by the OS, so that columns can be
+            larger than RAM. Files grow with the arrays, and they can be opened
+            read-only by other processes while the model runs
+            (see mapped_arrays.open_agents_snapshot)
+
+            Arguments:
+                * directory: path of directory, created if needed. Existing column
+                  files in it are overwritten
+                * capacity: minimum number of rows of the files. Rows are added
+                  on disk, so arrays may start empty and be mapped before being filled
+        """
+        if self.shared_blocks is not None:
+            raise RuntimeError('agent arrays in shared memory cannot be mapped to disk')
+        os.makedirs(directory, exist_ok=True)
+        # empty files cannot be mapped
+        if not len(self.x):
+            self._grow(1)
+        self.mapped_dir = directory
+        for attr in self.columns:
+            setattr(self, attr, to_mapped_array(directory, attr, getattr(self, attr)))
+        if len(self.x) < capacity:
+            self._grow(capacity)
+        self.sync_mapped(0)
+
+    def sync_mapped(self, step):
+        """ Method to write changed pages of mapped columns to their files, then
+            the manifest with the number of used rows, so that readers of the
+            snapshot see all rows added so far
+
+            Arguments:
+                * step: step of the model, stored in the manifest
+        """
+        for attr in self.columns:
+            getattr(self, attr).flush()
+        write_manifest(self.mapped_dir, {'step': step, 'num_rows': self.num_rows,
+                                         'columns': self.columns})
+
+    def share_memory(self):
+        """ Method to move all columns to shared memory blocks, so that worker processes
+            can read and write agent state in place. Rows cannot be added beyond
+            current capacity until release_memory is called
+
+            Returns:
+                * dict with spec of each column, to be passed to attach_memory
+        """
+        if self.mapped_dir is not None:
+            raise RuntimeError('agent arrays mapped to disk cannot be moved to shared memory')
+        specs = dict()
+        self.shared_blocks = []
+        for attr in self.columns:
+            block, shared, specs[attr] = to_shared_array(getattr(self, attr))
+            self.shared_blocks.append(block)
+            setattr(self, attr, shared)
+        return specs
+
+    def release_memory(self):
+        """ Method to copy columns back to private memory and free shared blocks """
+        for attr in self.columns:
+            setattr(self, attr, getattr(self, attr).copy())
+        for block in self.shared_blocks:
+            block.close()
+            block.unlink()
+        self.shared_blocks = None
+
+    @classmethod
+    def attach_memory(cls, specs, num_rows):
+        """ Method to build, in a worker process, arrays over the shared columns
+            of the arrays of the main process. Running aggregates start at zero,
+            so that they accumulate the changes made by the worker
+
+            Arguments:
+                * specs: dict returned by share_memory
+                * num_rows: number of used rows
+
+            Returns:
+                * Lang_Agents_Arrays instance. Its shared_blocks must be closed
+                  (not unlinked) when done
+        """
+        ags_data = cls(0, None)
+        ags_data.shared_blocks = []
+        for attr in cls.columns:
+            block, array = attach_shared_array(specs[attr])
+            ags_data.shared_blocks.append(block)
+            setattr(ags_data, attr, array)
+        ags_data.num_rows = num_rows
+        return ags_data
+
+    def _update_stats(self, rows, sign):
+        """ Add (sign=1) or remove (sign=-1) the contribution of given rows
+            to the running aggregates. Rows must be unique
+        """
+        if len(rows) == 1:
+            row = rows[0]
+            lang = self.language[row]
+            self.lang_counts[lang] += sign
+            if lang == 1:
+                self.biling_cat_pct_h_sum += sign * self.cat_pct_h[row]
+                self.biling_cat_pct_s_sum += sign * self.cat_pct_s[row]
+        else:
+            langs = self.language[rows]
+            self.lang_counts += sign * np.bincount(langs, minlength=3)
+            biling = np.asarray(rows)[langs == 1]
+            self.biling_cat_pct_h_sum += sign * self.cat_pct_h[biling].sum()
+            self.biling_cat_pct_s_sum += sign * self.cat_pct_s[biling].sum()
+
+    def recount_totals(self):
+        """ Recompute total spoken and heard words of each agent from word counts """
+        n = self.num_rows
+        block_size = self.block_size or max(n, 1)
+        for start in range(0, n, block_size):
+            block = slice(start, min(start + block_size, n))
+            self.spoken_total[block] = self.spoken[block].sum(axis=1)
+            self.heard_total[block] = self.heard[block].sum(axis=1)
+
+    def count_word(self, speaker, listener, lang):
+        """ Count one word in language lang (0, 1 => spa, cat) said by speaker
+            to listener (agent rows)
+        """
+        self.spoken[speaker, lang] += 1
+        self.spoken_total[speaker] += 1
+        self.heard[listener, lang] += 1
+        self.heard_total[listener] += 1
+
+    def set_counts(self, attr, row, values):
+        """ Write word counts ('spoken' or 'heard') of an agent, keeping its total up to date
+
+            Arguments:
+                * attr: string with attribute name
+                * row: agent row
+                * values: pair of counts (spa, cat)
+        """
+        getattr(self, attr)[row] = values
+        getattr(self, attr + '_total')[row] = getattr(self, attr)[row].sum()
+
+    def set_values(self, attr, rows, values):
+        """ Write values of an agent attribute ('language', 'cat_pct_s' or 'cat_pct_h')
+            keeping the running aggregates up to date
+
+            Arguments:
+                * attr: string with attribute name
+                * rows: unique agent rows
+                * values: scalar or array of new values
+        """
+        keys = None if self.metrics is None else self.metrics.get_keys(rows)
+        self._update_stats(rows, -1)
+        getattr(self, attr)[rows] = values
+        self._update_stats(rows, 1)
+        if keys is not None:
+            self.metrics.update_changed(rows, keys)
+
+    def recount_stats(self):
+        """ Compute population statistics with a full scan of all agents
+
+            Returns:
+                * lang_counts array, sum of cat_pct_h and sum of cat_pct_s over bilinguals
+        """
+        rows = self.get_rows()
+        langs = self.language[rows]
+        biling = rows[langs == 1]
+        return (np.bincount(langs, minlength=3),
+                self.cat_pct_h[biling].sum(), self.cat_pct_s[biling].sum())
+
+    def check_stats(self):
+        """ Debug method that compares running aggregates and word totals with a full recount """
+        n = self.num_rows
+        for attr in ['spoken', 'heard']:
+            if not np.array_equal(getattr(self, attr)[:n].sum(axis=1), getattr(self, attr + '_total')[:n]):
+                raise RuntimeError('{} totals differ from sum of word counts'.format(attr))
+        lang_counts, cat_pct_h_sum, cat_pct_s_sum = self.recount_stats()
+        if (not np.array_equal(lang_counts, self.lang_counts) or
+                not np.isclose(cat_pct_h_sum, self.biling_cat_pct_h_sum) or
+                not np.isclose(cat_pct_s_sum, self.biling_cat_pct_s_sum)):
+            raise RuntimeError('running lang stats {} differ from recount {}'.format(
+                (self.lang_counts, self.biling_cat_pct_h_sum, self.biling_cat_pct_s_sum),
+                (lang_counts, cat_pct_h_sum, cat_pct_s_sum)))
+
+    @staticmethod
+    def _ratio(num, den):
+        """ Elementwise num/den, with 0.5 wherever den is zero """
+        return np.divide(num, den, out=np.full(len(num), 0.5), where=den != 0)
+
+    def get_conversation_lang(self, ags, others, uniforms=None):
+        """ Vectorized version of Simple_Language_Agent.get_conversation_lang.
+            Language draws are computed from the frequencies at the beginning
+            of the call, then word counts of all agents involved are updated at once.
+            Rows of other agents are not written
+
+            Arguments:
+                * ags: array of speaker rows
+                * others: array of partner rows (same length as ags)
+                * uniforms: optional pair of arrays of uniforms (one per conversation)
+                  for the draws of speaker and partner languages.
+                  By default they are drawn from the model rng
+
+            Returns:
+                * sorted array of rows of all agents involved
+        """
+        pair_langs = 3 * self.language[ags] + self.language[others]
+        spa_pairs = np.isin(pair_langs, [0, 1, 3])  # (0,0), (0,1), (1,0)
+        cat_pairs = np.isin(pair_langs, [7, 5, 8])  # (2,1), (1,2), (2,2)
+        bil_pairs = pair_langs == 4  # (1,1)
+        # spa-cat pairs are all remaining ones
+        spa_cat_pairs = ~(spa_pairs | cat_pairs | bil_pairs)
+        if self.profiler is not None:
+            self.profiler.count('conversations', len(ags))
+            for pair_type, pairs in [('spa_pairs', spa_pairs), ('cat_pairs', cat_pairs),
+                                     ('bil_bil_pairs', bil_pairs), ('spa_cat_pairs', spa_cat_pairs)]:
+                self.profiler.count(pair_type, int(pairs.sum()))
+
+        # prob that each speaker uses cat (l1) and that each partner answers in cat (l2)
+        tot_spoken = self.spoken_total[ags]
+        p_spa_spoken = self._ratio(self.spoken[ags, 0], tot_spoken)
+        p_spa_heard = self._ratio(self.heard[ags, 0], self.heard_total[ags])
+        p_l1 = np.where(bil_pairs, 1 - (2/3 * p_spa_spoken + 1/3 * p_spa_heard), 1 - p_spa_spoken)
+        p_l1 = np.where(tot_spoken != 0, p_l1, 0.5)
+        p_l2 = 1 - self._ratio(self.heard[others, 0], self.heard_total[others])
+        p_l2 = np.where(self.spoken_total[others] != 0, p_l2, 0.5)
+
+        if uniforms is None:
+            u_l1 = self.rng.generator.random(len(ags))
+            u_l2 = np.zeros(len(ags))
+            u_l2[spa_cat_pairs] = self.rng.generator.random(spa_cat_pairs.sum())
+        else:
+            u_l1, u_l2 = uniforms
+        l1 = (u_l1 < p_l1).astype(np.int64)
+        l1[spa_pairs] = 0
+        l1[cat_pairs] = 1
+        l2 = l1.copy()
+        l2[spa_cat_pairs] = u_l2[spa_cat_pairs] < p_l2[spa_cat_pairs]
+
+        # speaker says l1 and hears l2, partner hears l1 and says l2
+        if 4 * len(ags) >= self.num_rows and self.shared_blocks is None:
+            # most rows are involved: update all rows, without sorting. Not used on shared
+            # memory, where other processes write their own rows
+            n = self.num_rows
+            new_spoken = np.bincount(np.concatenate((2 * ags + l1, 2 * others + l2)),
+                                     minlength=2 * n).reshape(-1, 2)
+            new_heard = np.bincount(np.concatenate((2 * others + l1, 2 * ags + l2)),
+                                    minlength=2 * n).reshape(-1, 2)
+            # each agent says and hears one word per conversation
+            new_total = np.bincount(np.concatenate((ags, others)), minlength=n)
+            self.spoken[:n] += new_spoken
+            self.heard[:n] += new_heard
+            self.spoken_total[:n] += new_total
+            self.heard_total[:n] += new_total
+            return np.flatnonzero(new_total)
+        rows, idxs = np.unique(np.concatenate((ags, others)), return_inverse=True)
+        ags_idxs, others_idxs = idxs[:len(ags)], idxs[len(ags):]
+        minlength = 2 * len(rows)
+        new_spoken = np.bincount(np.concatenate((2 * ags_idxs + l1, 2 * others_idxs + l2)),
+                                 minlength=minlength).reshape(-1, 2)
+        new_heard = np.bincount(np.concatenate((2 * others_idxs + l1, 2 * ags_idxs + l2)),
+                                minlength=minlength).reshape(-1, 2)
+        self.spoken[rows] += new_spoken
+        self.heard[rows] += new_heard
+        self.spoken_total[rows] += new_spoken.sum(axis=1)
+        self.heard_total[rows] += new_heard.sum(axis=1)
+        return rows
+
+    def update_lang_pcts(self, rows):
+        keys = None if self.metrics is None else self.metrics.get_keys(rows)
+        self._update_stats(rows, -1)
+        freqs = [(self.spoken, self.spoken_total, self.cat_pct_s),
+                 (self.heard, self.heard_total, self.cat_pct_h)]
+        if len(rows) == 1:
+            # scalar path, much faster for the per-agent engine
+            row = rows[0]
+            for freq, total, pct in freqs:
+                tot = total[row]
+                pct[row] = np.round(freq[row, 1] / tot, 2) if tot else 0
+        else:
+            for freq, total, pct in freqs:
+                tot = total[rows]
+                pct[rows] = np.where(tot != 0, np.round(freq[rows, 1] / np.maximum(tot, 1), 2), 0)
+        self._update_stats(rows, 1)
+        if keys is not None:
+            self.metrics.update_changed(rows, keys)
+
+    def update_lang_switch(self, rows):
+        if len(rows) == 1:
+            row = rows[0]
+            lang, cat_pct_h = self.language[row], self.cat_pct_h[row]
+            if (lang == 0 and cat_pct_h >= 0.25) or (lang == 2 and cat_pct_h <= 0.75):
+                new_lang = 1
+            elif lang == 1 and cat_pct_h >= 0.9:
+                new_lang = 2
+            elif lang == 1 and cat_pct_h <= 0.1:
+                new_lang = 0
+            else:
+                return
+            if self.profiler is not None:
+                self.profiler.count('lang_switches')
+            self.set_values('language', rows, new_lang)
+            return
+        langs = self.language[rows]
+        cat_pct_h = self.cat_pct_h[rows]
+        new_langs = langs.copy()
+        new_langs[(langs == 0) & (cat_pct_h >= 0.25)] = 1
+        new_langs[(langs == 2) & (cat_pct_h <= 0.75)] = 1
+        new_langs[(langs == 1) & (cat_pct_h >= 0.9)] = 2
+        new_langs[(langs == 1) & (cat_pct_h <= 0.1)] = 0
+        if self.profiler is not None:
+            self.profiler.count('lang_switches', int((new_langs != langs).sum()))
+        self.set_values('language', rows, new_langs)
+
+    def update_lang_status(self, rows, steps):
+        self.update_lang_pcts(rows)
+        if steps > self.lang_switch_start:
+            self.update_lang_switch(rows)
+
+    def step(self, model):
+        """ Advance all agents one step: batched move, pairing of co-located agents,
+            conversations and language status update of all agents that spoke
+
+            Arguments:
+                * model: Simple_Language_Model instance owning the arrays.
+                  Its grid must be a Cell_Index_Grid
+        """
+        profiler = self.profiler or NULL_PROFILER
+        rows = self.get_rows()
+        with profiler.phase('move_random'):
+            model.grid.random_moves(rows)
+        with profiler.phase('cell_partner'):
+            ags, others = model.grid.random_cell_partners(rows)
+        profiler.count('empty_cell_speaks', len(rows) - len(ags))
+        with profiler.phase('conversation_lang'):
+            speakers = self.get_conversation_lang(ags, others)
+        with profiler.phase('lang_status'):
+            self.update_lang_status(speakers, model.schedule.steps)
+
+    def simultaneous_step(self, model):
+        """ Advance all agents one step with simultaneous update. Co-located agents are
+            matched in disjoint pairs, and each agent of a pair starts one conversation
+            with the other. All language draws are computed against the word counts at the
+            beginning of the step, then counts, cat pcts and language switches are
+            committed at once. Random draws are keyed uniforms of (model.stream_key,
+            step, row), so the result does not depend on the order in which
+            agents or batches of agents are processed
+
+            Arguments:
+                * model: Simple_Language_Model instance owning the arrays.
+                  Its grid must be a Cell_Index_Grid
+        """
+        if self.block_size:
+            self.simultaneous_step_blocks(model)
+            return
+        profiler = self.profiler or NULL_PROFILER
+        step = model.schedule.steps
+        rows = self.get_rows()
+        with profiler.phase('move_random'):
+            model.grid.random_moves(rows, keyed_uniforms(model.stream_key, step,
+                                                         self.keyed_streams['move'], rows))
+        with profiler.phase('cell_partner'):
+            firsts, seconds = model.grid.cell_matching(
+                rows, keyed_uniforms(model.stream_key, step, self.keyed_streams['match'], rows))
+        profiler.count('empty_cell_speaks', len(rows) - 2 * len(firsts))
+        with profiler.phase('conversation_lang'):
+            speakers = self.converse_matched(firsts, seconds, model.stream_key, step)
+        with profiler.phase('lang_status'):
+            self.update_lang_status(speakers, step)
+
+    def simultaneous_step_blocks(self, model):
+        """ Same as simultaneous_step, but temporary arrays are of the size of a block,
+            not of the population. Agents move block by block of block_size rows, then
+            agents of consecutive cells are matched and converse block by block of about
+            block_size agents. Since draws are keyed by row, pairs never span two cells
+            and agents converse only with their pair, agent state evolves exactly as in
+            simultaneous_step. Running sums of cat pcts may differ by rounding errors
+        """
+        profiler = self.profiler or NULL_PROFILER
+        step = model.schedule.steps
+        grid = model.grid
+        with profiler.phase('move_random'):
+            for rows in self.get_row_blocks():
+                grid.random_moves(rows, keyed_uniforms(model.stream_key, step, self.keyed_streams['move'], rows),
+                                  rebuild=False)
+            grid.rebuild_blocks(self.get_row_blocks)
+        for rows in grid.get_cell_blocks(self.block_size):
+            with profiler.phase('cell_partner'):
+                firsts, seconds = grid.cell_matching(
+                    rows, keyed_uniforms(model.stream_key, step, self.keyed_streams['match'], rows))
+            profiler.count('empty_cell_speaks', len(rows) - 2 * len(firsts))
+            with profiler.phase('conversation_lang'):
+                speakers = self.converse_matched(firsts, seconds, model.stream_key, step)
+            with profiler.phase('lang_status'):
+                self.update_lang_status(speakers, step)
+
+    def converse_matched(self, firsts, seconds, stream_key, step):
+        """ Each agent of every matched pair starts one conversation with the other,
+            with keyed draws. See simultaneous_step
+
+            Returns:
+                * sorted array of rows of all agents involved
+        """
+        ags = np.concatenate((firsts, seconds))
+        others = np.concatenate((seconds, firsts))
+        return self.get_conversation_lang(ags, others, uniforms=[
+            keyed_uniforms(stream_key, step, self.keyed_streams[stream], ags)
+            for stream in ['l1', 'l2']])
+
+
+class Lang_Counts_View:
+    """ List-like view over the word counts ('spoken' or 'heard') of one row
+        of a Lang_Agents_Arrays instance. Items can be read and written,
+        e.g. lang_freq['spoken'][0] += 1, and writes keep cached totals up to date
+    """
+    __slots__ = ('ags_data', 'attr', 'row')
+
+    def __init__(self, ags_data, attr, row):
+        self.ags_data = ags_data
+        self.attr = attr
+        self.row = row
+
+    def __getitem__(self, idx):
+        return getattr(self.ags_data, self.attr)[self.row][idx]
+
+    def __setitem__(self, idx, value):
+        counts = getattr(self.ags_data, self.attr)[self.row].copy()
+        counts[idx] = value
+        self.ags_data.set_counts(self.attr, self.row, counts)
+
+    def __len__(self):
+        return 2
+
+    def __iter__(self):
+        return iter(getattr(self.ags_data, self.attr)[self.row].tolist())
+
+    def __array__(self, dtype=None, copy=None):
+        return np.array(getattr(self.ags_data, self.attr)[self.row], dtype=dtype)
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+class Lang_Freq_View:
+    """ Dict-like view over the language frequencies stored in one row
+        of a Lang_Agents_Arrays instance. It preserves the agent.lang_freq interface:
+        'spoken' and 'heard' return writable Lang_Counts_View pairs of counts,
+        'cat_pct_s' and 'cat_pct_h' return floats. Counts can be written item by item,
+        e.g. lang_freq['spoken'][0] += 1, or as a whole pair, e.g.
+        lang_freq['spoken'] = [50, 0]. Both keep cached totals up to date
+    """
+    __slots__ = ('ags_data', 'row')
+    keys_ = ('spoken', 'heard', 'cat_pct_s', 'cat_pct_h')
+
+    def __init__(self, ags_data, row):
+        self.ags_data = ags_data
+        self.row = row
+
+    def __getitem__(self, key):
+        if key not in self.keys_:
+            raise KeyError(key)
+        if key in ['spoken', 'heard']:
+            return Lang_Counts_View(self.ags_data, key, self.row)
+        return getattr(self.ags_data, key)[self.row]
+
+    def __setitem__(self, key, value):
+        if key not in self.keys_:
+            raise KeyError(key)
+        if key in ['cat_pct_s', 'cat_pct_h']:
+            self.ags_data.set_values(key, [self.row], value)
+        else:
+            self.ags_data.set_counts(key, self.row, value)
+
+    def keys(self):
+        return list(self.keys_)
+
+    def __iter__(self):
+        return iter(self.keys_)
+
+    def __repr__(self):
+        return repr({key: self[key] for key in self.keys_})
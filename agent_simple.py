@@ -1,32 +1,47 @@
 # IMPORT LIBS
-import random
-import numpy as np
-import networkx as nx
+from time import perf_counter
+
+from agent_arrays import Lang_Freq_View
 
 class Simple_Language_Agent:
+    # no per-instance __dict__: agent state lives in model.ags_data
+    __slots__ = ('model', 'unique_id', 'S', 'rng', 'row')
 
-    def __init__(self, model, unique_id, language, S):
+    def __init__(self, model, unique_id, language, S, row=None):
         self.model = model
         self.unique_id = unique_id
-        self.language = language # 0, 1, 2 => spa, bil, cat
         self.S = S
-
-        self.lang_freq = dict()
-        if self.language == 0:
-            self.lang_freq['spoken'] = [50, 0] # 0, 2 => spa, cat
-            self.lang_freq['heard'] = [50, 0]
-            self.lang_freq['cat_pct_s'] = 0
-            self.lang_freq['cat_pct_h'] = 0
-        elif self.language == 2:
-            self.lang_freq['spoken'] = [0, 50] # 0, 2 => spa, cat
-            self.lang_freq['heard'] = [0, 50]
-            self.lang_freq['cat_pct_s'] = 1
-            self.lang_freq['cat_pct_h'] = 1
-        else:
-            self.lang_freq['spoken'] = [25, 25] # 0, 2 => spa, cat
-            self.lang_freq['heard'] = [25, 25]
-            self.lang_freq['cat_pct_s'] = 0.5
-            self.lang_freq['cat_pct_h'] = 0.5
+        self.rng = model.rng
+        # agent state is stored in a row of model.ags_data arrays.
+        # A new row is added unless an existing one is given (language is then ignored)
+        if row is None:
+            row = model.ags_data.add_row(language) # language: 0, 1, 2 => spa, bil, cat
+        self.row = row
+
+    @property
+    def language(self):
+        return int(self.model.ags_data.language[self.row])
+
+    @language.setter
+    def language(self, value):
+        self.model.ags_data.set_values('language', [self.row], value)
+
+    @property
+    def pos(self):
+        x = self.model.ags_data.x[self.row]
+        if x < 0:
+            return None
+        return int(x), int(self.model.ags_data.y[self.row])
+
+    @pos.setter
+    def pos(self, value):
+        # grid sets pos to None when agent is removed
+        x, y = (-1, -1) if value is None else value
+        self.model.ags_data.set_positions(self.row, x, y)
+
+    @property
+    def lang_freq(self):
+        return Lang_Freq_View(self.model.ags_data, self.row)
 
 
     def move_random(self):
@@ -40,13 +55,7 @@ class Simple_Language_Agent:
             Returns:
                 * modifies self.pos attribute
         """
-        x, y = self.pos  # attr pos is defined when adding agent to schedule
-        possible_steps = self.model.grid.get_neighborhood(
-            (x, y),
-            moore=True,
-            include_center=False
-        )
-        chosen_cell = random.choice(possible_steps)
+        chosen_cell = self.model.grid.random_neighbor_cell(self.pos)
         self.model.grid.move_agent(self, chosen_cell)
 
     def speak(self, with_agent=None):
@@ -66,94 +75,103 @@ class Simple_Language_Agent:
                 * Defines conversation and language(s) in which it takes place.
                   Updates heard/used stats
         """
+        # when model is profiled, phases are timed and conversation events counted
+        profiler = self.model.profiler
         if with_agent is None:
-            pos = [self.pos]
-            # get all agents currently placed on chosen cell
-            others = self.model.grid.get_cell_list_contents(pos)
             ## linguistic model of encounter with another random agent
-            if len(others) > 1:
-                other = random.choice(others)
-                self.get_conversation_lang(other)
-                # update lang status
-                self.update_lang_status()
-                other.update_lang_status()
+            ## from current cell, if any
+            start = perf_counter() if profiler is not None else None
+            other = self.model.grid.random_cell_partner(self)
+            if profiler is not None:
+                profiler.add_time('cell_partner', perf_counter() - start)
+                if other is None:
+                    profiler.count('empty_cell_speaks')
+            if other is None:
+                return
         else:
-            self.get_conversation_lang(with_agent)
             other = with_agent
+        if profiler is None:
+            self.get_conversation_lang(other)
+            # update lang status
+            self.update_lang_status()
+            other.update_lang_status()
+        else:
+            profiler.count_pair(self.language, other.language)
+            start = perf_counter()
+            self.get_conversation_lang(other)
+            t_conv = perf_counter()
             # update lang status
             self.update_lang_status()
             other.update_lang_status()
+            profiler.add_time('conversation_lang', t_conv - start)
+            profiler.add_time('lang_status', perf_counter() - t_conv)
+
+    def get_network_partner(self, network):
+        """ Pick a random contact of the agent in one of the model networks,
+            e.g. to have a distance conversation with self.speak(with_agent=partner)
+
+            Arguments:
+                * network: model network (Compact_Network instance)
+
+            Returns:
+                * an agent, or None if agent has no contacts in network
+        """
+        row = network.random_neighbor(self.row, self.rng)
+        if row is not None:
+            return self.model.grid.row_agents[row]
 
     def get_conversation_lang(self, other):
+        ags_data = self.model.ags_data
+        spoken, heard = ags_data.spoken, ags_data.heard
+        spoken_total, heard_total = ags_data.spoken_total, ags_data.heard_total
+        i, j = self.row, other.row
         # spa-bilingual
         if (self.language, other.language) in [(0,0),(0,1),(1,0)]:
-            for key in ['heard','spoken']:
-                self.lang_freq[key][0] += 1
-                other.lang_freq[key][0] += 1
+            ags_data.count_word(i, j, 0)
+            ags_data.count_word(j, i, 0)
         # bilingual-cat
         elif (self.language, other.language) in [(2,1),(1,2),(2,2)]:
-            for key in ['heard', 'spoken']:
-                self.lang_freq[key][1] += 1
-                other.lang_freq[key][1] += 1
+            ags_data.count_word(i, j, 1)
+            ags_data.count_word(j, i, 1)
         # bilingual-bilingual
         elif (self.language, other.language) == (1, 1):
             # find out lang spoken by self
-            if sum(self.lang_freq['spoken']) != 0:
-                p10 = (2/3 * self.lang_freq['spoken'][0]/sum(self.lang_freq['spoken']) +
-                       1/3 * self.lang_freq['heard'][0]/sum(self.lang_freq['heard'])
+            if spoken_total[i] != 0:
+                p10 = (2/3 * spoken[i, 0]/spoken_total[i] +
+                       1/3 * heard[i, 0]/heard_total[i]
                        )
                 p11 = 1 - p10
-                l1 = np.random.binomial(1,p11)
+                l1 = self.rng.bernoulli(p11)
             else:
-                l1 = random.choice([0,1])
-            self.lang_freq['spoken'][l1] += 1
-            other.lang_freq['heard'][l1] += 1
-            # find out language spoken by other
-            self.lang_freq['heard'][l1] += 1
-            other.lang_freq['spoken'][l1] += 1
+                l1 = self.rng.choice([0,1])
+            # other answers in the same language
+            ags_data.count_word(i, j, l1)
+            ags_data.count_word(j, i, l1)
         # spa-cat
         else:
-            if sum(self.lang_freq['spoken']) != 0:
-                p10 = self.lang_freq['spoken'][0]/sum(self.lang_freq['spoken'])
+            if spoken_total[i] != 0:
+                p10 = spoken[i, 0]/spoken_total[i]
                 p11 = 1 - p10
-                l1 = np.random.binomial(1, p11)
+                l1 = self.rng.bernoulli(p11)
             else:
-                l1 = random.choice([0, 1])
-            self.lang_freq['spoken'][l1] += 1
-            other.lang_freq['heard'][l1] += 1
+                l1 = self.rng.choice([0, 1])
+            ags_data.count_word(i, j, l1)
             # find out language spoken by other
-            if sum(other.lang_freq['spoken']) != 0:
-                p20 = other.lang_freq['heard'][0]/sum(other.lang_freq['heard'])
+            if spoken_total[j] != 0:
+                p20 = heard[j, 0]/heard_total[j]
                 p21 = 1 - p20
-                l2 = np.random.binomial(1,p21)
+                l2 = self.rng.bernoulli(p21)
             else:
-                l2 = random.choice([0, 1])
-            self.lang_freq['heard'][l2] += 1
-            other.lang_freq['spoken'][l2] += 1
+                l2 = self.rng.choice([0, 1])
+            ags_data.count_word(j, i, l2)
 
     def update_lang_pcts(self):
-        if sum(self.lang_freq['spoken']) != 0:
-            self.lang_freq['cat_pct_s'] = round(self.lang_freq['spoken'][1] / sum(self.lang_freq['spoken']), 2)
-        else:
-            self.lang_freq['cat_pct_s'] = 0
-        if sum(self.lang_freq['heard']) != 0:
-            self.lang_freq['cat_pct_h'] = round(self.lang_freq['heard'][1] / sum(self.lang_freq['heard']), 2)
-        else:
-            self.lang_freq['cat_pct_h'] = 0
+        self.model.ags_data.update_lang_pcts([self.row])
 
     def update_lang_switch(self):
-        if self.model.schedule.steps > 10:
-            if self.language == 0:
-                if self.lang_freq['cat_pct_h'] >= 0.25:
-                    self.language = 1
-            elif self.language == 2:
-                if self.lang_freq['cat_pct_h'] <= 0.75:
-                    self.language = 1
-            else:
-                if self.lang_freq['cat_pct_h'] >= 0.9:
-                    self.language = 2
-                elif self.lang_freq['cat_pct_h'] <= 0.1:
-                    self.language = 0
+        if self.model.schedule.steps > self.model.ags_data.lang_switch_start:
+            self.model.ags_data.update_lang_switch([self.row])
+
     def update_lang_status(self):
         # update lang experience
         self.update_lang_pcts()
@@ -162,7 +180,13 @@ class Simple_Language_Agent:
 
 
     def step(self):
-        self.move_random()
+        profiler = self.model.profiler
+        if profiler is None:
+            self.move_random()
+        else:
+            start = perf_counter()
+            self.move_random()
+            profiler.add_time('move_random', perf_counter() - start)
         self.speak()
 
     def __repr__(self):
@@ -0,0 +1,134 @@
+# IMPORT LIBS
+import os
+import itertools
+from multiprocessing import Pool
+import numpy as np
+import pandas as pd
+
+# IMPORT MODEL
+from model_simple import Simple_Language_Model
+
+
+def get_batch_runs(params_grid, num_replicates=1, seed=0):
+    """ Function to list all runs of a parameter sweep in a deterministic order
+
+        Arguments:
+            * params_grid: dict mapping Simple_Language_Model constructor parameters
+              to lists of values. All combinations of values are run
+            * num_replicates: number of runs of each combination
+            * seed: integer base seed of the sweep
+
+        Returns:
+            * list of (run_id, run_seed, replicate, params) tuples. Each run seed is derived
+              from the base seed and the run_id only, so that it does not depend on
+              which worker executes the run or on previous runs
+    """
+    keys = sorted(params_grid)
+    combinations = itertools.product(*[params_grid[key] for key in keys])
+    runs = []
+    for run_id, (values, replicate) in enumerate(itertools.product(combinations, range(num_replicates))):
+        run_seed = int(np.random.SeedSequence(seed, spawn_key=(run_id,)).generate_state(1)[0])
+        runs.append((run_id, run_seed, replicate, dict(zip(keys, values))))
+    return runs
+
+
+def run_single(run, steps, run_options=None):
+    """ Function to execute one run of a sweep. It is executed in worker processes
+
+        Arguments:
+            * run: (run_id, run_seed, replicate, params) tuple from get_batch_runs
+            * steps: maximum number of model steps
+            * run_options: optional dict of extra arguments of run_model, e.g.
+              collect_freq or convergence criteria
+
+        Returns:
+            * pandas DataFrame with DataCollector series of the run, one row per collected
+              step, with run_id, replicate, seed, parameters, stop reason and stop step
+              of the run as extra columns
+    """
+    run_id, run_seed, replicate, params = run
+    model = Simple_Language_Model(seed=run_seed, **params)
+    report = model.run_model(steps, progress_bar=False, **(run_options or {}))
+    data = model.get_model_vars_dataframe().reset_index()
+    for key, value in params.items():
+        # lists such as init_lang_distrib are stored as strings
+        data[key] = value if np.isscalar(value) else str(value)
+    data['stop_reason'] = report['stop_reason']
+    data['stop_step'] = report['stop_step']
+    data.insert(0, 'seed', run_seed)
+    data.insert(0, 'replicate', replicate)
+    data.insert(0, 'run_id', run_id)
+    return data
+
+
+def _run_single_star(args):
+    return run_single(*args)
+
+
+def load_finished_runs(results_file):
+    """ Function to read results of a previous (possibly interrupted) sweep.
+        Only runs recorded in the log file results_file + '.done' are kept,
+        so that partially written runs are discarded
+
+        Returns:
+            * pandas DataFrame with results of finished runs, or None
+    """
+    done_file = results_file + '.done'
+    if not (os.path.exists(results_file) and os.path.exists(done_file)):
+        return None
+    with open(done_file) as f:
+        done_ids = {int(line) for line in f if line.strip()}
+    # round_trip parsing reads back exactly the floats written by to_csv
+    results = pd.read_csv(results_file, on_bad_lines='skip', float_precision='round_trip')
+    return results[results['run_id'].isin(done_ids)]
+
+
+def run_batch(params_grid, steps, num_replicates=1, seed=0, processes=None, results_file=None,
+              run_options=None):
+    """ Function to run a parameter sweep of Simple_Language_Model over a pool
+        of worker processes
+
+        Arguments:
+            * params_grid: dict mapping Simple_Language_Model constructor parameters
+              to lists of values, e.g. {'num_people': [1000], 'num_cities': [5, 10]}
+            * steps: maximum number of steps of each run
+            * num_replicates: number of runs of each combination of parameters
+            * seed: integer base seed of the sweep
+            * processes: number of worker processes. Defaults to number of cores
+            * results_file: optional path of a csv file where results of each run are
+              appended as soon as the run finishes. If the file exists, finished
+              runs are not executed again (resume after a crash)
+            * run_options: optional dict of extra arguments of run_model for all runs,
+              e.g. {'collect_freq': 10, 'convergence_window': 20, 'stop_if_absorbed': True}
+
+        Returns:
+            * pandas DataFrame with DataCollector series of all runs in tidy format:
+              one row per run and step, sorted by run_id and step
+    """
+    runs = get_batch_runs(params_grid, num_replicates, seed)
+    results = []
+    if results_file:
+        previous = load_finished_runs(results_file)
+        if previous is None:
+            if os.path.exists(results_file):
+                os.remove(results_file)
+            open(results_file + '.done', 'w').close()
+        else:
+            # rewrite file without partially written runs
+            previous.to_csv(results_file, index=False)
+            runs = [run for run in runs if run[0] not in set(previous['run_id'])]
+            results.append(previous)
+
+    with Pool(processes) as pool:
+        for data in pool.imap_unordered(_run_single_star, [(run, steps, run_options) for run in runs]):
+            if results_file:
+                write_header = not os.path.exists(results_file)
+                data.to_csv(results_file, mode='a', header=write_header, index=False)
+                with open(results_file + '.done', 'a') as f:
+                    f.write('{}\n'.format(data['run_id'].iloc[0]))
+            results.append(data)
+
+    if not results:
+        return pd.DataFrame()
+    results = pd.concat(results, ignore_index=True)
+    return results.sort_values(['run_id', 'step']).reset_index(drop=True)
@@ -0,0 +1,394 @@
+# IMPORT LIBS
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import itertools
+import resource
+import subprocess
+import multiprocessing
+from math import ceil, sqrt
+import numpy as np
+
+# agents per grid cell
+GRID_DENSITIES = {'sparse': 1, 'dense': 50}
+# (lang_ags_sorted_by_dist, lang_ags_sorted_in_clust)
+INIT_OPTIONS = {'sorted_by_dist': (True, True),
+                'sorted_in_clust': (False, True),
+                'unsorted': (False, False)}
+SUITES = {'quick': {'sizes': [1000, 10000], 'steps': 10},
+          'full': {'sizes': [1000, 10000, 100000, 1000000], 'steps': 10}}
+# per-agent engine is too slow beyond this population
+MAX_AGENTS_ENGINE_SIZE = 100000
+# optional dependencies that importing the model must not load
+HEAVY_MODULES = ['matplotlib', 'tables', 'deepdish', 'pyprind', 'networkx', 'scipy']
+# maximum seconds to start a worker process and import the model
+IMPORT_TIME_TARGET = 1.0
+# model reporters compared between engines
+ACCURACY_SERIES = ['count_spa', 'count_bil', 'count_cat', 'biling_evol_h', 'biling_evol_s']
+
+
+def get_scenarios(suite='quick', engines=('agents', 'arrays')):
+    """ Function to list reproducible benchmark scenarios
+
+        Arguments:
+            * suite: 'quick' or 'full'
+            * engines: model engines to benchmark
+
+        Returns:
+            * list of dicts with scenario name and Simple_Language_Model parameters
+    """
+    scenarios = []
+    for num_people, density, init, engine in itertools.product(SUITES[suite]['sizes'], GRID_DENSITIES,
+                                                               INIT_OPTIONS, engines):
+        if engine == 'agents' and num_people > MAX_AGENTS_ENGINE_SIZE:
+            continue
+        side = max(ceil(sqrt(num_people / GRID_DENSITIES[density])), 3)
+        sorted_by_dist, sorted_in_clust = INIT_OPTIONS[init]
+        scenarios.append({'name': '{}_{}_{}_{}'.format(engine, num_people, density, init),
+                          'steps': SUITES[suite]['steps'],
+                          'params': {'num_people': num_people, 'width': side, 'height': side,
+                                     'lang_ags_sorted_by_dist': sorted_by_dist,
+                                     'lang_ags_sorted_in_clust': sorted_in_clust,
+                                     'engine': engine, 'seed': 0}})
+    return scenarios
+
+
+def run_scenario(scenario):
+    """ Function to time one scenario. It must run in a fresh process,
+        so that peak RSS only accounts for this scenario
+
+        Returns:
+            * dict with scenario, per-phase times in seconds, agent-steps/sec and peak RSS
+    """
+    from model_simple import Simple_Language_Model
+
+    steps = scenario['steps']
+    start = time.perf_counter()
+    model = Simple_Language_Model(**scenario['params'])
+    init_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(steps):
+        model.step()
+    step_time = (time.perf_counter() - start) / steps
+
+    start = time.perf_counter()
+    model.datacollector.collect(model)
+    collect_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    model.create_agents_attrs_data('language')
+    attrs_data_time = time.perf_counter() - start
+
+    return dict(scenario,
+                init_s=init_time,
+                step_s=step_time,
+                collect_s=collect_time,
+                attrs_data_s=attrs_data_time,
+                agent_steps_per_s=scenario['params']['num_people'] / step_time,
+                # ru_maxrss is in kilobytes on Linux
+                peak_rss_mb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024)
+
+
+def measure_import_time(module='model_simple', repeats=5):
+    """ Function to time the startup of a worker process that imports the model.
+        Each repeat runs in a fresh interpreter, so that nothing is cached in memory
+
+        Arguments:
+            * module: name of module to import
+            * repeats: number of measurements. The fastest one is kept
+
+        Returns:
+            * dict with import time and total process startup time in seconds
+              and list of HEAVY_MODULES loaded by the import
+    """
+    code = ('import sys, time; start = time.perf_counter(); import {}; '
+            'print(time.perf_counter() - start); '
+            'print(",".join(name for name in {!r} if name in sys.modules))').format(module, HEAVY_MODULES)
+    import_times, startup_times = [], []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        output = subprocess.check_output([sys.executable, '-c', code],
+                                         cwd=os.path.dirname(os.path.abspath(__file__)))
+        startup_times.append(time.perf_counter() - start)
+        import_time, heavy_modules = output.decode().splitlines()
+        import_times.append(float(import_time))
+    return {'module': module,
+            'import_s': min(import_times),
+            'startup_s': min(startup_times),
+            'heavy_modules': [name for name in heavy_modules.split(',') if name]}
+
+
+def measure_agents(num_people=20000, num_conversations=100000):
+    """ Function to measure memory used per agent and conversation throughput
+        of both engines
+
+        Arguments:
+            * num_people: number of agents of the model
+            * num_conversations: number of conversations between random pairs of agents
+
+        Returns:
+            * dict with bytes per agent (agent object, row of agent arrays and whole model,
+              as traced by tracemalloc during model creation) and conversations/sec of
+              per-agent conversations and of one batch of vectorized conversations.
+              Each conversation includes the language status update of both agents
+    """
+    import tracemalloc
+    from model_simple import Simple_Language_Model
+
+    side = max(ceil(sqrt(num_people / GRID_DENSITIES['dense'])), 3)
+    tracemalloc.start()
+    model = Simple_Language_Model(num_people, width=side, height=side, seed=0)
+    model_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    agent = next(iter(model.schedule.agents))
+    agent_bytes = sys.getsizeof(agent) + (sys.getsizeof(agent.__dict__) if hasattr(agent, '__dict__') else 0)
+    row_bytes = sum(getattr(model.ags_data, attr).itemsize * getattr(model.ags_data, attr)[0].size
+                    for attr in model.ags_data.columns)
+
+    rng = np.random.default_rng(0)
+    agents = list(model.schedule.agents)
+    pairs = rng.integers(num_people, size=(num_conversations, 2))
+    start = time.perf_counter()
+    for i, j in pairs.tolist():
+        agents[i].get_conversation_lang(agents[j])
+        agents[i].update_lang_status()
+        agents[j].update_lang_status()
+    agents_rate = num_conversations / (time.perf_counter() - start)
+
+    ags_data = model.ags_data
+    start = time.perf_counter()
+    rows = ags_data.get_conversation_lang(pairs[:, 0], pairs[:, 1])
+    ags_data.update_lang_status(rows, model.schedule.steps)
+    arrays_rate = num_conversations / (time.perf_counter() - start)
+
+    return {'num_people': num_people,
+            'agent_object_bytes': agent_bytes,
+            'agent_row_bytes': row_bytes,
+            'model_bytes_per_agent': model_bytes / num_people,
+            'agents_conversations_per_s': agents_rate,
+            'arrays_conversations_per_s': arrays_rate}
+
+
+def compare_engines(num_people=500000, side=40, steps=60, num_replicates=4,
+                    engine='cells', reference='arrays', init='sorted_in_clust',
+                    init_lang_distrib=(0.3, 0.3, 0.4)):
+    """ Function to measure the accuracy of an approximate engine against a reference engine.
+        Both engines run the same seeds, so they start from the same population
+
+        Arguments:
+            * num_people: number of agents
+            * side: grid width and height
+            * steps: number of model steps
+            * num_replicates: number of runs of each engine, with seeds 0 ... num_replicates - 1
+            * engine, reference: model engines
+            * init: key of INIT_OPTIONS
+            * init_lang_distrib: initial pcts of lang types. Mixed populations
+              have many language switches, which are the hardest part to approximate
+
+        Returns:
+            * pandas DataFrame indexed by model reporter with the largest absolute difference
+              over steps between the mean series of both engines ('max_abs_diff') and the
+              largest standard deviation among replicates of the reference ('reference_sd'),
+              plus the mean time per step of each engine in its attrs
+    """
+    import pandas as pd
+    from model_simple import Simple_Language_Model
+
+    sorted_by_dist, sorted_in_clust = INIT_OPTIONS[init]
+    series, step_times = {}, {}
+    for name in [reference, engine]:
+        runs = []
+        start = time.perf_counter()
+        for seed in range(num_replicates):
+            model = Simple_Language_Model(num_people, width=side, height=side,
+                                          init_lang_distrib=list(init_lang_distrib),
+                                          lang_ags_sorted_by_dist=sorted_by_dist,
+                                          lang_ags_sorted_in_clust=sorted_in_clust,
+                                          engine=name, seed=seed)
+            for _ in range(steps):
+                model.step()
+            runs.append(model.get_model_vars_dataframe()[ACCURACY_SERIES].values)
+        step_times[name] = (time.perf_counter() - start) / (num_replicates * steps)
+        series[name] = np.array(runs)
+    result = pd.DataFrame({'max_abs_diff': np.abs(series[engine].mean(axis=0) -
+                                                  series[reference].mean(axis=0)).max(axis=0),
+                           'reference_sd': series[reference].std(axis=0).max(axis=0)},
+                          index=ACCURACY_SERIES)
+    result.attrs['step_s'] = step_times
+    return result
+
+
+def measure_ensemble(num_people=2000, num_replicates=50, side=20, steps=60,
+                     engines=('arrays', 'agents'), init='sorted_in_clust',
+                     init_lang_distrib=(0.3, 0.3, 0.4)):
+    """ Function to time a vectorized ensemble against the same replicates run one after another
+
+        Arguments:
+            * num_people: number of agents of each replicate
+            * num_replicates: number of replicates
+            * side: grid width and height
+            * steps: number of model steps
+            * engines: model engines of the sequential runs
+            * init: key of INIT_OPTIONS
+            * init_lang_distrib: initial pcts of lang types
+
+        Returns:
+            * dict with total seconds of the ensemble run ('ensemble_s') and of the
+              sequential runs of each engine ('<engine>_s')
+    """
+    from model_simple import Simple_Language_Model
+    from ensemble import Language_Model_Ensemble
+
+    sorted_by_dist, sorted_in_clust = INIT_OPTIONS[init]
+    params = dict(width=side, height=side, init_lang_distrib=list(init_lang_distrib),
+                  lang_ags_sorted_by_dist=sorted_by_dist, lang_ags_sorted_in_clust=sorted_in_clust)
+    start = time.perf_counter()
+    ensemble = Language_Model_Ensemble(num_replicates, num_people, seed=0, **params)
+    ensemble.run_model(steps)
+    result = {'ensemble_s': time.perf_counter() - start}
+    for engine in engines:
+        start = time.perf_counter()
+        for seed in ensemble.replicate_seeds:
+            model = Simple_Language_Model(num_people, engine=engine, seed=seed, **params)
+            for _ in range(steps):
+                model.step()
+        result[engine + '_s'] = time.perf_counter() - start
+    return result
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(suite='quick', engines=('agents', 'arrays'), output=None):
+    """ Function to run all scenarios of a suite, each one in a fresh process
+
+        Arguments:
+            * suite: 'quick' or 'full'
+            * engines: model engines to benchmark
+            * output: optional path of JSON file where results are written
+
+        Returns:
+            * dict with environment info and list of scenario results
+    """
+    results = {'commit': get_commit(),
+               'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+               'python': platform.python_version(),
+               'numpy': np.__version__,
+               'machine': platform.machine(),
+               'results': []}
+    ctx = multiprocessing.get_context('spawn')
+    for scenario in get_scenarios(suite, engines):
+        with ctx.Pool(1) as pool:
+            result = pool.apply(run_scenario, (scenario,))
+        results['results'].append(result)
+        print('{name}: {agent_steps_per_s:.0f} agent-steps/s, step {step_s:.4f} s, '
+              'init {init_s:.3f} s, peak RSS {peak_rss_mb:.0f} MB'.format(**result))
+    if output:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2)
+    return results
+
+
+def compare_results(old_file, new_file, tolerance=0.1):
+    """ Function to compare two benchmark result files, e.g. from two commits
+
+        Arguments:
+            * old_file, new_file: paths of JSON files written by run_benchmarks
+            * tolerance: relative change above which a difference is a regression
+
+        Returns:
+            * list of (scenario name, metric, old value, new value) regressions
+    """
+    with open(old_file) as f:
+        old = {res['name']: res for res in json.load(f)['results']}
+    with open(new_file) as f:
+        new = {res['name']: res for res in json.load(f)['results']}
+    regressions = []
+    for name in sorted(set(old) & set(new)):
+        # throughput must not decrease, times and memory must not increase
+        for metric, higher_is_better in [('agent_steps_per_s', True), ('init_s', False),
+                                         ('collect_s', False), ('peak_rss_mb', False)]:
+            old_value, new_value = old[name][metric], new[name][metric]
+            change = (new_value - old_value) / old_value
+            if (-change if higher_is_better else change) > tolerance:
+                regressions.append((name, metric, old_value, new_value))
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks of Simple_Language_Model')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    run_parser = subparsers.add_parser('run')
+    run_parser.add_argument('--suite', choices=sorted(SUITES), default='quick')
+    run_parser.add_argument('--engines', nargs='+', default=['agents', 'arrays'])
+    run_parser.add_argument('--output', default='benchmark_results.json')
+    compare_parser = subparsers.add_parser('compare')
+    compare_parser.add_argument('old_file')
+    compare_parser.add_argument('new_file')
+    compare_parser.add_argument('--tolerance', type=float, default=0.1)
+    import_parser = subparsers.add_parser('import')
+    import_parser.add_argument('--target', type=float, default=IMPORT_TIME_TARGET)
+    import_parser.add_argument('--repeats', type=int, default=5)
+    agents_parser = subparsers.add_parser('agents')
+    agents_parser.add_argument('--num-people', type=int, default=20000)
+    agents_parser.add_argument('--conversations', type=int, default=100000)
+    accuracy_parser = subparsers.add_parser('accuracy')
+    accuracy_parser.add_argument('--num-people', type=int, default=500000)
+    accuracy_parser.add_argument('--side', type=int, default=40)
+    accuracy_parser.add_argument('--steps', type=int, default=60)
+    accuracy_parser.add_argument('--replicates', type=int, default=4)
+    accuracy_parser.add_argument('--engine', default='cells')
+    accuracy_parser.add_argument('--reference', default='arrays')
+    accuracy_parser.add_argument('--init-lang-distrib', type=float, nargs=3, default=[0.3, 0.3, 0.4])
+    ensemble_parser = subparsers.add_parser('ensemble')
+    ensemble_parser.add_argument('--num-people', type=int, default=2000)
+    ensemble_parser.add_argument('--replicates', type=int, default=50)
+    ensemble_parser.add_argument('--side', type=int, default=20)
+    ensemble_parser.add_argument('--steps', type=int, default=60)
+    ensemble_parser.add_argument('--engines', nargs='+', default=['arrays', 'agents'])
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        run_benchmarks(args.suite, args.engines, args.output)
+    elif args.command == 'agents':
+        result = measure_agents(args.num_people, args.conversations)
+        print('agent object {agent_object_bytes} B, agent row {agent_row_bytes} B, '
+              'model {model_bytes_per_agent:.0f} B per agent; conversations/s: '
+              'agents engine {agents_conversations_per_s:.0f}, '
+              'arrays engine {arrays_conversations_per_s:.0f}'.format(**result))
+    elif args.command == 'accuracy':
+        result = compare_engines(args.num_people, args.side, args.steps, args.replicates,
+                                 args.engine, args.reference,
+                                 init_lang_distrib=args.init_lang_distrib)
+        print(result.to_string())
+        print('step time: ' + ', '.join('{} {:.3f} s'.format(name, step_s)
+                                        for name, step_s in result.attrs['step_s'].items()))
+    elif args.command == 'ensemble':
+        result = measure_ensemble(args.num_people, args.replicates, args.side, args.steps,
+                                  args.engines)
+        print('ensemble {:.2f} s; '.format(result['ensemble_s']) + ', '.join(
+            'sequential {} {:.2f} s ({:.1f}x)'.format(engine, result[engine + '_s'],
+                                                      result[engine + '_s'] / result['ensemble_s'])
+            for engine in args.engines))
+    elif args.command == 'import':
+        result = measure_import_time(repeats=args.repeats)
+        print('{module}: import {import_s:.3f} s, process startup {startup_s:.3f} s, '
+              'heavy modules loaded: {heavy_modules}'.format(**result))
+        if result['startup_s'] > args.target or result['heavy_modules']:
+            print('FAILED: startup should take less than {} s without loading {}'.format(
+                args.target, HEAVY_MODULES))
+            sys.exit(1)
+    else:
+        regressions = compare_results(args.old_file, args.new_file, args.tolerance)
+        for name, metric, old_value, new_value in regressions:
+            print('REGRESSION {}: {} {:.4g} -> {:.4g}'.format(name, metric, old_value, new_value))
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,297 @@
+# IMPORT LIBS
+import numpy as np
+
+from agent_arrays import Lang_Agents_Arrays
+
+
+class Lang_Cells_Arrays:
+    """ Coarse-grained state of a language agent population, used by engine 'cells'.
+        Agents have no identity: agents of the same cell and language type whose
+        cat pct heard rounds to the same value are merged into one class.
+        Each class is a record with its number of agents and the sums of their cat pcts
+        and word totals, so that the mean state of the class is exact, and the cost
+        of a step depends on the number of classes (at most 3 * num_bins per occupied
+        cell), not on the number of agents. The sum of squares of cat pct heard is also
+        kept, so that merging classes does not lose the spread of cat pcts heard,
+        which drives language switches.
+
+        A step is a mean-field approximation of the 'random' activation of engine 'arrays':
+            * agents of each class are spread over the Moore neighbours of their cell
+              with binomial draws
+            * in cells with more than one agent, each agent starts one conversation with
+              a random partner of its cell and is picked as partner once. Probabilities of
+              the words said and heard are computed against the language mix and mean
+              cat pcts of the cell, and the number of Catalan words heard by the agents
+              of a class is a multinomial draw
+            * cat pcts are updated, then each class is split in two halves
+              with the same mean and variance of cat pct heard, and language switches
+              are applied to each half as in Lang_Agents_Arrays
+        Running aggregates have the same names as in Lang_Agents_Arrays,
+        so model reporters read both engines alike
+
+        Accuracy against engine 'arrays' is measured by benchmarks.compare_engines
+        (largest difference over steps between mean series of both engines, and largest sd
+        among 'arrays' replicates), with init_lang_distrib [0.3, 0.3, 0.4] on a 40 x 40 grid:
+            * 20000 agents, 100 steps, 8 replicates: lang type pcts within 0.004
+              (sd 0.005 - 0.021), biling_evol_h/s within 0.0015/0.0024 (sd 0.005/0.012)
+            * 500000 agents, 60 steps, 3 replicates: lang type pcts within 0.003
+              (sd 0.0008 - 0.0025), biling_evol_h/s within 0.0010/0.0019 (sd 0.0012/0.0012)
+        Step time is bounded by the number of classes, so this engine is only faster
+        than engine 'arrays' with many agents per cell
+    """
+
+    columns = ['cell', 'language', 'count', 'cat_pct_h_sum', 'cat_pct_h_sq_sum', 'cat_pct_s_sum',
+               'heard_total_sum', 'spoken_total_sum']
+    sum_columns = ['count', 'cat_pct_h_sum', 'cat_pct_h_sq_sum', 'cat_pct_s_sum',
+                   'heard_total_sum', 'spoken_total_sum']
+    # agents of a cell and language are grouped by cat pct heard, rounded to 2 decimals
+    # as the cat pcts of agents
+    num_bins = 101
+
+    def __init__(self, grid, rng):
+        """ Arguments:
+                * grid: Cell_Index_Grid, only used for its Moore neighbourhood table
+                * rng: Buffered_RNG instance used for batched draws
+        """
+        self.grid = grid
+        self.rng = rng
+        self.cell = np.zeros(0, dtype=np.int64)
+        self.language = np.zeros(0, dtype=np.int8)  # 0, 1, 2 => spa, bil, cat
+        self.count = np.zeros(0, dtype=np.int64)
+        self.cat_pct_h_sum = np.zeros(0)
+        self.cat_pct_h_sq_sum = np.zeros(0)
+        self.cat_pct_s_sum = np.zeros(0)
+        self.heard_total_sum = np.zeros(0)
+        self.spoken_total_sum = np.zeros(0)
+        # running aggregates
+        self.lang_counts = np.zeros(3, dtype=np.int64)
+        self.biling_cat_pct_h_sum = 0.
+        self.biling_cat_pct_s_sum = 0.
+
+    def __len__(self):
+        return len(self.count)
+
+    def add_agents(self, langs, xs, ys):
+        """ Method to add agents with the initial word counts of their language type
+
+            Arguments:
+                * langs: array of agent lang types
+                * xs, ys: arrays of agent coords on grid
+        """
+        langs = np.asarray(langs, dtype=np.int8)
+        totals = Lang_Agents_Arrays.init_counts.sum(axis=1)[langs].astype(np.float64)
+        cat_pcts = Lang_Agents_Arrays.init_cat_pcts[langs]
+        new = {'cell': np.asarray(xs, dtype=np.int64) * self.grid.height + ys, 'language': langs,
+               'count': np.ones(len(langs), dtype=np.int64), 'cat_pct_h_sum': cat_pcts,
+               'cat_pct_h_sq_sum': cat_pcts ** 2, 'cat_pct_s_sum': cat_pcts, 'heard_total_sum': totals, 'spoken_total_sum': totals}
+        for attr in self.columns:
+            setattr(self, attr, np.concatenate((getattr(self, attr), new[attr])))
+        self.aggregate()
+
+    def get_state(self):
+        """ Returns:
+                * dict with all columns. Arrays are not copied
+        """
+        return {attr: getattr(self, attr) for attr in self.columns}
+
+    def set_state(self, state):
+        """ Restore columns from a dict built by get_state """
+        for attr in self.columns:
+            setattr(self, attr, np.array(state[attr]))
+        self.aggregate()
+
+    def get_sums(self, attr):
+        """ Returns:
+                * array with the sum of an agent attribute ('language', 'cat_pct_h'
+                  or 'cat_pct_s') over the agents of each class
+        """
+        if attr == 'language':
+            return self.language * self.count
+        if attr in ['cat_pct_h', 'cat_pct_s']:
+            return getattr(self, attr + '_sum')
+        raise ValueError("engine 'cells' has no agent attribute {}".format(attr))
+
+    def aggregate(self):
+        """ Merge classes with the same cell, language and rounded cat pct heard,
+            drop empty ones and recompute the running aggregates
+        """
+        keep = np.flatnonzero(self.count)
+        bins = np.round(self.cat_pct_h_sum[keep] / self.count[keep] * (self.num_bins - 1)).astype(np.int64)
+        keys = (self.cell[keep] * 3 + self.language[keep]) * self.num_bins + bins
+        order = keep[np.argsort(keys, kind='stable')]
+        keys = np.sort(keys, kind='stable')
+        starts = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1])))[:len(keys)]
+        for attr in self.columns:
+            values = getattr(self, attr)[order]
+            if attr in self.sum_columns and len(starts):
+                setattr(self, attr, np.add.reduceat(values, starts))
+            else:
+                setattr(self, attr, values[starts])
+        self.lang_counts = np.bincount(self.language, weights=self.count, minlength=3).astype(np.int64)
+        biling = self.language == 1
+        self.biling_cat_pct_h_sum = self.cat_pct_h_sum[biling].sum()
+        self.biling_cat_pct_s_sum = self.cat_pct_s_sum[biling].sum()
+
+    def check_stats(self):
+        """ Debug method that compares running lang aggregates with a recount over classes,
+            and checks that sums of cat pcts of each class are within their bounds
+        """
+        if (self.count <= 0).any():
+            raise RuntimeError('classes should not be empty')
+        for attr in ['cat_pct_h_sum', 'cat_pct_s_sum']:
+            values = getattr(self, attr)
+            if (values < -1e-9).any() or (values > self.count + 1e-9).any():
+                raise RuntimeError('{} out of bounds [0, count]'.format(attr))
+        biling = self.language == 1
+        lang_counts = np.bincount(self.language, weights=self.count, minlength=3).astype(np.int64)
+        cat_pct_h_sum, cat_pct_s_sum = self.cat_pct_h_sum[biling].sum(), self.cat_pct_s_sum[biling].sum()
+        if (not np.array_equal(lang_counts, self.lang_counts) or
+                not np.isclose(cat_pct_h_sum, self.biling_cat_pct_h_sum) or
+                not np.isclose(cat_pct_s_sum, self.biling_cat_pct_s_sum)):
+            raise RuntimeError('running lang stats {} differ from recount {}'.format(
+                (self.lang_counts, self.biling_cat_pct_h_sum, self.biling_cat_pct_s_sum),
+                (lang_counts, cat_pct_h_sum, cat_pct_s_sum)))
+
+    def _split(self, parents, counts, **values):
+        """ Replace all classes by sub-classes of given parents. Sums of sub-classes are
+            proportional to their counts, other columns are copied from parents
+            unless given as keyword arguments
+
+            Arguments:
+                * parents: array of indices of parent classes
+                * counts: array with number of agents of each sub-class
+        """
+        shares = counts / self.count[parents]
+        for attr in self.columns:
+            if attr in values:
+                setattr(self, attr, values[attr])
+            elif attr == 'count':
+                self.count = counts
+            elif attr in self.sum_columns:
+                setattr(self, attr, getattr(self, attr)[parents] * shares)
+            else:
+                setattr(self, attr, getattr(self, attr)[parents])
+
+    def move(self):
+        """ Spread the agents of each class uniformly over the Moore neighbours
+            of their cell, as in Cell_Index_Grid.random_moves
+        """
+        num_neighbors = self.grid.num_neighbors[self.cell]
+        left = self.count.copy()
+        parents, counts, cells = [], [], []
+        for j in range(self.grid.neighbors.shape[1]):
+            idxs = np.flatnonzero((j < num_neighbors) & (left > 0))
+            # conditional binomials of a uniform multinomial. Last neighbour gets all agents left
+            moved = self.rng.generator.binomial(left[idxs], 1 / (num_neighbors[idxs] - j))
+            left[idxs] -= moved
+            parents.append(idxs)
+            counts.append(moved)
+            cells.append(self.grid.neighbors[self.cell[idxs], j])
+        self._split(np.concatenate(parents), np.concatenate(counts), cell=np.concatenate(cells))
+
+    def get_cell_stats(self):
+        """ Returns:
+                * array with cell index of each class (in the returned arrays)
+                * (num_occupied_cells, 3) arrays with number of agents of each language type
+                  and their mean cat pct heard and mean cat pct spoken
+        """
+        cells, idxs = np.unique(self.cell, return_inverse=True)
+        lang_idxs = 3 * idxs + self.language
+        minlength = 3 * len(cells)
+        counts = np.bincount(lang_idxs, weights=self.count, minlength=minlength).reshape(-1, 3)
+        means = [np.divide(np.bincount(lang_idxs, weights=getattr(self, attr), minlength=minlength).reshape(-1, 3),
+                           counts, out=np.zeros_like(counts), where=counts != 0)
+                 for attr in ['cat_pct_h_sum', 'cat_pct_s_sum']]
+        return idxs, counts, means[0], means[1]
+
+    def converse(self, steps):
+        """ Conversations and language status update of all agents that
+            are not alone in their cell
+
+            Arguments:
+                * steps: model steps, to decide whether agents can switch language
+        """
+        cell_idxs, cell_counts, cell_cat_h, cell_cat_s = self.get_cell_stats()
+        num_agents = cell_counts.sum(axis=1)
+        active = np.flatnonzero(num_agents[cell_idxs] > 1)
+        idle = np.flatnonzero(num_agents[cell_idxs] <= 1)
+        cell_idxs = cell_idxs[active]
+        # lang type of partners (the agent itself may be picked, as in engine 'arrays')
+        p_spa, p_bil, p_cat = (cell_counts[cell_idxs] / num_agents[cell_idxs, None]).T
+        langs = self.language[active]
+        count = self.count[active]
+        cat_h = self.cat_pct_h_sum[active] / count
+        cat_s = self.cat_pct_s_sum[active] / count
+        heard_tot = self.heard_total_sum[active] / count
+        spoken_tot = self.spoken_total_sum[active] / count
+        # prob of l1 being cat in bil-bil pairs, for the agent and for a bilingual of its cell
+        own_bil = 2/3 * cat_s + 1/3 * cat_h
+        cell_bil = 2/3 * cell_cat_s[cell_idxs, 1] + 1/3 * cell_cat_h[cell_idxs, 1]
+        is_spa, is_bil = langs == 0, langs == 1
+        # prob that the word heard (said) by the agent in its own conversation is cat.
+        # In spa-cat pairs partner answers in cat with the prob of its cat pct heard
+        heard_own = np.select([is_spa, is_bil], [p_cat * cell_cat_h[cell_idxs, 2], p_cat + p_bil * own_bil],
+                              p_bil + p_cat + p_spa * cell_cat_h[cell_idxs, 0])
+        said_own = np.select([is_spa, is_bil], [p_cat * cat_s, p_cat + p_bil * own_bil],
+                             p_bil + p_cat + p_spa * cat_s)
+        # same probs in the conversation started by the agent that picks it as partner
+        heard_other = np.select([is_spa, is_bil], [p_cat * cell_cat_s[cell_idxs, 2], p_cat + p_bil * cell_bil],
+                                p_bil + p_cat + p_spa * cell_cat_s[cell_idxs, 0])
+        said_other = np.select([is_spa, is_bil], [p_cat * cat_h, p_cat + p_bil * cell_bil],
+                               p_bil + p_cat + p_spa * cat_h)
+        # number of cat words heard (0, 1 or 2) by each agent
+        pvals = np.column_stack(((1 - heard_own) * (1 - heard_other),
+                                 heard_own * (1 - heard_other) + (1 - heard_own) * heard_other,
+                                 heard_own * heard_other))
+        pvals = np.clip(pvals, 0, 1)
+        num_heard = self.rng.generator.multinomial(count, pvals / pvals.sum(axis=1, keepdims=True))
+
+        # each active class is split by number of cat words heard
+        # agents hear and say two words: cat pcts are updated with the words heard
+        # and with the expected number of cat words said
+        counts = num_heard.ravel()
+        cat_h_var = np.repeat(self.cat_pct_h_sq_sum[active] / count - cat_h ** 2, 3)
+        cat_h = np.repeat(heard_tot * cat_h, 3) + np.tile(np.arange(3), len(active))
+        cat_s = np.repeat(spoken_tot * cat_s + said_own + said_other, 3)
+        cat_h_var *= np.repeat((heard_tot / (heard_tot + 2)) ** 2, 3)
+        heard_tot = np.repeat(heard_tot + 2, 3)
+        spoken_tot = np.repeat(spoken_tot + 2, 3)
+        cat_h /= heard_tot
+        cat_s /= spoken_tot
+        langs = np.repeat(langs, 3)
+
+        # two-point split of each class: lows and highs of cat pct heard
+        lows = counts // 2
+        highs = counts - lows
+        spread = np.sqrt(np.maximum(cat_h_var, 0) / np.maximum(lows * highs, 1))
+        counts = np.concatenate((lows, highs))
+        cat_h = np.clip(np.concatenate((cat_h - highs * spread, cat_h + lows * spread)), 0, 1)
+        heard_tot, spoken_tot, cat_s, langs = [np.tile(values, 2) for values in
+                                               (heard_tot, spoken_tot, cat_s, langs)]
+        if steps > Lang_Agents_Arrays.lang_switch_start:
+            # same rules as Lang_Agents_Arrays.update_lang_switch
+            pcts = np.round(cat_h, 2)
+            new_langs = langs.copy()
+            new_langs[(langs == 0) & (pcts >= 0.25)] = 1
+            new_langs[(langs == 2) & (pcts <= 0.75)] = 1
+            new_langs[(langs == 1) & (pcts >= 0.9)] = 2
+            new_langs[(langs == 1) & (pcts <= 0.1)] = 0
+            langs = new_langs
+        children = {'cell': np.tile(np.repeat(self.cell[active], 3), 2), 'language': langs,
+                    'count': counts, 'cat_pct_h_sum': counts * cat_h, 'cat_pct_h_sq_sum': counts * cat_h ** 2,
+                    'cat_pct_s_sum': counts * cat_s, 'heard_total_sum': counts * heard_tot,
+                    'spoken_total_sum': counts * spoken_tot}
+        # classes of agents alone in their cell are kept as they are
+        for attr in self.columns:
+            setattr(self, attr, np.concatenate((children[attr], getattr(self, attr)[idle])))
+
+    def step(self, model):
+        """ Advance all agents one step: moves, conversations and language status update
+
+            Arguments:
+                * model: Simple_Language_Model instance owning the arrays
+        """
+        self.move()
+        self.aggregate()
+        self.converse(model.schedule.steps)
+        self.aggregate()
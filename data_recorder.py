@@ -0,0 +1,126 @@
+# IMPORT LIBS
+import numpy as np
+import pandas as pd
+import tables
+
+
+class Model_Data_Recorder:
+    """ Append-only, chunked on-disk recorder of model results (HDF5 via PyTables).
+        Model reporters collected by the DataCollector are buffered and appended
+        to the table '/model_results' every 'chunk_steps' steps, after which they are
+        dropped from the DataCollector, so that memory use does not grow with run length.
+        Optionally, compressed snapshots of agent state arrays are stored in '/agents':
+        one extendable flat array per attribute, plus a table 'snapshots' with
+        the step, start offset and length of each snapshot
+    """
+    agent_attrs_choices = ['language', 'x', 'y', 'cat_pct_s', 'cat_pct_h']
+
+    def __init__(self, filename, model, chunk_steps=100, agent_attrs=None,
+                 agents_freq=None, complevel=5):
+        """ Arguments:
+                * filename: path of HDF5 file. It is overwritten
+                * model: Simple_Language_Model instance being recorded
+                * chunk_steps: number of steps between writes to disk
+                * agent_attrs: optional list of agent attributes to snapshot,
+                  from ['language', 'x', 'y', 'cat_pct_s', 'cat_pct_h']
+                * agents_freq: steps between agent snapshots. Defaults to chunk_steps
+                * complevel: compression level of agent snapshots (0-9)
+        """
+        self.filename = filename
+        self.chunk_steps = chunk_steps
+        self.agent_attrs = agent_attrs or []
+        for attr in self.agent_attrs:
+            if attr not in self.agent_attrs_choices:
+                raise ValueError('agent_attrs should be in {}'.format(self.agent_attrs_choices))
+        self.agents_freq = agents_freq or chunk_steps
+        self.filters = tables.Filters(complevel=complevel, complib='zlib')
+        self.h5 = tables.open_file(filename, mode='w')
+        for key, value in model.get_initial_conditions().items():
+            self.h5.root._v_attrs[key] = value
+        self.model_table = None
+        # rows collected before recording started are written with the first chunk
+        self.steps_buffer = list(model.collected_steps)
+        self.agents_buffer = []
+        if self.agent_attrs:
+            group = self.h5.create_group('/', 'agents')
+            self.h5.create_table(group, 'snapshots', filters=self.filters,
+                                 description=np.dtype([('step', 'i8'), ('start', 'i8'), ('length', 'i8')]))
+            for attr in self.agent_attrs:
+                atom = tables.Atom.from_dtype(getattr(model.ags_data, attr).dtype)
+                self.h5.create_earray(group, attr, atom=atom, shape=(0,), filters=self.filters)
+
+    def record(self, model):
+        """ Method to be called right after each DataCollector collection.
+            Buffers collected step and, if needed, a snapshot of agent arrays.
+            Writes buffers to disk every chunk_steps steps
+        """
+        step = model.schedule.steps
+        self.steps_buffer.append(step)
+        if self.agent_attrs and not step % self.agents_freq:
+            n = model.ags_data.num_rows
+            self.agents_buffer.append((step, {attr: getattr(model.ags_data, attr)[:n].copy()
+                                              for attr in self.agent_attrs}))
+        if len(self.steps_buffer) >= self.chunk_steps:
+            self.flush(model)
+
+    def flush(self, model):
+        """ Append buffered data to file and drop it from memory """
+        model_vars = model.datacollector.model_vars
+        if self.steps_buffer:
+            if self.model_table is None:
+                dtype = np.dtype([('step', 'i8')] + [(name, 'f8') for name in model_vars])
+                self.model_table = self.h5.create_table('/', 'model_results', description=dtype)
+            chunk = np.empty(len(self.steps_buffer), dtype=self.model_table.dtype)
+            chunk['step'] = self.steps_buffer
+            num_steps = len(self.steps_buffer)
+            for name, values in model_vars.items():
+                chunk[name] = values[-num_steps:]
+            self.model_table.append(chunk)
+            # only written rows are dropped
+            for values in model_vars.values():
+                del values[-num_steps:]
+            del model.collected_steps[-num_steps:]
+            self.steps_buffer = []
+
+        if self.agents_buffer:
+            group = self.h5.root.agents
+            start = group[self.agent_attrs[0]].nrows
+            snapshots = []
+            for step, arrays in self.agents_buffer:
+                length = len(arrays[self.agent_attrs[0]])
+                snapshots.append((step, start, length))
+                for attr in self.agent_attrs:
+                    group[attr].append(arrays[attr])
+                start += length
+            group.snapshots.append(snapshots)
+            self.agents_buffer = []
+        self.h5.flush()
+
+    def close(self, model):
+        self.flush(model)
+        self.h5.close()
+
+
+def load_recorded_data(filename, key='model_results', steps=None):
+    """ Function to lazily read a step range from a file written by Model_Data_Recorder.
+        Only the requested rows are read from disk
+
+        Arguments:
+            * filename: path of HDF5 file
+            * key: 'model_results' or the name of a recorded agent attribute
+            * steps: optional (start, stop) tuple. Steps in range(start, stop) are read.
+              If None, all steps are read
+
+        Returns:
+            * for 'model_results', a pandas DataFrame of model reporters indexed by step.
+              For agent attributes, a dict mapping each snapshot step to a numpy array
+    """
+    start, stop = steps if steps is not None else (0, np.iinfo(np.int64).max)
+    condition = '(step >= {}) & (step < {})'.format(int(start), int(stop))
+    with tables.open_file(filename, mode='r') as h5:
+        if key == 'model_results':
+            data = h5.root.model_results.read_where(condition)
+            return pd.DataFrame(data).set_index('step')
+        snapshots = h5.root.agents.snapshots.read_where(condition)
+        earray = h5.root.agents[key]
+        return {int(step): earray[start:start + length] for step, start, length in snapshots}
@@ -0,0 +1,179 @@
+# IMPORT LIBS
+import numpy as np
+import pandas as pd
+
+# IMPORT MESA LIBS
+from mesa import Model
+from mesa.time import BaseScheduler
+
+# IMPORT MODEL
+from population import generate_population
+from agent_arrays import Lang_Agents_Arrays
+from grid_index import Cell_Index_Grid
+from random_streams import Buffered_RNG
+
+# model reporters of each replicate, as in Simple_Language_Model.create_datacollector
+ENSEMBLE_SERIES = ['count_spa', 'count_bil', 'count_cat', 'total_num_agents',
+                   'biling_evol_h', 'biling_evol_s']
+
+
+class Language_Model_Ensemble(Model):
+    """ Many independent replicates of one Simple_Language_Model configuration,
+        stepped together in a single process. The grids of all replicates are laid side
+        by side along x in one Cell_Index_Grid, whose Moore table never links cells of
+        different replicates, and agents of all replicates are rows of a single
+        Lang_Agents_Arrays. Each step of the whole ensemble is one batched step of
+        engine 'arrays', and model reporters of all replicates are computed at once
+        with np.bincount over the replicate index of each row
+
+        The gain comes from stepping all replicates with one set of numpy calls.
+        Against replicates of engine 'agents' run one after another it is over 100x, but
+        sequential runs of engine 'arrays' are already vectorized: on one core the ensemble
+        was 1.2x faster for 20 replicates of 2000 agents and 2.7x faster for 200 replicates
+        of 500 agents (see benchmarks.measure_ensemble). Small replicates gain the most
+    """
+
+    def __init__(self, num_replicates, num_people, width=5, height=5, max_people_factor=5,
+                 init_lang_distrib=[0.25, 0.65, 0.1], num_cities=10, lang_ags_sorted_by_dist=True,
+                 lang_ags_sorted_in_clust=True, activation='random', collect_freq=1, seed=None):
+        """ Arguments:
+                * num_replicates: number of replicates
+                * other arguments are those of Simple_Language_Model. Replicate r starts
+                  from the same population as Simple_Language_Model(seed=seed_r), where
+                  seed_r is the seed of run r of batch_run.get_batch_runs with the same seed
+        """
+        if activation not in ['random', 'simultaneous']:
+            raise ValueError("activation should be either 'random' or 'simultaneous'")
+        self.num_replicates = num_replicates
+        self.num_people = num_people
+        self.grid_width = width
+        self.grid_height = height
+        self.max_people_factor = max_people_factor
+        self.init_lang_distrib = init_lang_distrib
+        self.num_cities = num_cities
+        self.lang_ags_sorted_by_dist = lang_ags_sorted_by_dist
+        self.lang_ags_sorted_in_clust = lang_ags_sorted_in_clust
+        self.activation = activation
+        self.collect_freq = collect_freq
+        self.seed = seed
+        self.replicate_seeds = [int(np.random.SeedSequence(seed, spawn_key=(replicate,)).generate_state(1)[0])
+                                for replicate in range(num_replicates)]
+
+        # draws of steps of all replicates come from one stream
+        ensemble_seq, keyed_seq = np.random.SeedSequence(seed).spawn(2)
+        self.ensemble_rng = Buffered_RNG(ensemble_seq)
+        self.stream_key = int(keyed_seq.generate_state(1, dtype=np.uint64)[0])
+        self.ags_data = Lang_Agents_Arrays(num_replicates * num_people, self.ensemble_rng)
+        grid = Cell_Index_Grid(width, height, self.ags_data, self.ensemble_rng)
+        # cells of replicate r are r * width * height ... (r + 1) * width * height - 1
+        offsets = np.arange(num_replicates)[:, None, None] * grid.num_cells
+        neighbors = np.where(grid.neighbors >= 0, grid.neighbors + offsets, -1).reshape(-1, grid.neighbors.shape[1])
+        self.grid = Cell_Index_Grid(num_replicates * width, height, self.ags_data, self.ensemble_rng,
+                                    moore_table=(neighbors, np.tile(grid.num_neighbors, num_replicates)))
+        self.schedule = BaseScheduler(self)
+
+        clust_centers, cluster_sizes, replicates = [], [], []
+        for replicate, replicate_seed in enumerate(self.replicate_seeds):
+            # same stream as the population draws of Simple_Language_Model(seed=replicate_seed)
+            rng = Buffered_RNG(np.random.SeedSequence(replicate_seed).spawn(3)[0])
+            langs, xs, ys, clusters, centers, sizes = generate_population(
+                rng, num_people, width, height, init_lang_distrib, num_cities,
+                lang_ags_sorted_by_dist, lang_ags_sorted_in_clust)
+            clust_centers.append(centers)
+            cluster_sizes.append(sizes)
+            rows = self.ags_data.add_rows(langs)
+            self.ags_data.x[rows] = xs + replicate * width
+            self.ags_data.y[rows] = ys
+            if clusters is not None:
+                self.ags_data.cluster[rows] = clusters
+            replicates.append(np.full(len(rows), replicate))
+        self.rng = self.ensemble_rng
+        # lists with city centers and sizes of each replicate
+        self.clust_centers = clust_centers
+        self.cluster_sizes = cluster_sizes
+        # replicate of each agent row
+        self.replicate = np.concatenate(replicates)
+        self.grid.rebuild(np.arange(self.ags_data.num_rows))
+
+        # collected model reporters, as lists of arrays with one value per replicate
+        self.collected_steps = []
+        self.collected = {name: [] for name in ENSEMBLE_SERIES}
+
+    def get_replicate_stats(self):
+        """ Method to compute model reporters of all replicates with a full scan of all agents
+
+            Returns:
+                * dict mapping each name of ENSEMBLE_SERIES to an array with
+                  its value in each replicate
+        """
+        n = self.ags_data.num_rows
+        num_replicates = self.num_replicates
+        langs = self.ags_data.language[:n]
+        lang_counts = np.bincount(3 * self.replicate + langs, minlength=3 * num_replicates).reshape(-1, 3)
+        num_agents = lang_counts.sum(axis=1)
+        stats = {name: lang_counts[:, i] / num_agents
+                 for i, name in enumerate(['count_spa', 'count_bil', 'count_cat'])}
+        stats['total_num_agents'] = num_agents
+        biling = langs == 1
+        num_biling = lang_counts[:, 1]
+        # as in Simple_Language_Model.get_bilingual_global_evol
+        no_biling = np.where(lang_counts[:, 2] > lang_counts[:, 0], 1., 0.)
+        for name, attr in [('biling_evol_h', 'cat_pct_h'), ('biling_evol_s', 'cat_pct_s')]:
+            sums = np.bincount(self.replicate[biling], weights=getattr(self.ags_data, attr)[:n][biling],
+                               minlength=num_replicates)
+            stats[name] = np.divide(sums, num_biling, out=no_biling.copy(), where=num_biling != 0)
+        return stats
+
+    def collect(self):
+        """ Store model reporters of all replicates at current step """
+        for name, values in self.get_replicate_stats().items():
+            self.collected[name].append(values)
+        self.collected_steps.append(self.schedule.steps)
+
+    def step(self):
+        """ Advance all replicates one step """
+        if not self.schedule.steps % self.collect_freq:
+            self.collect()
+        if self.activation == 'simultaneous':
+            self.ags_data.simultaneous_step(self)
+        else:
+            self.ags_data.step(self)
+        self.schedule.steps += 1
+        self.schedule.time += 1
+
+    def run_model(self, steps, quantiles=(0.05, 0.5, 0.95)):
+        """ Method to run all replicates for a number of steps
+
+            Returns:
+                * summary of collected series, see get_summary
+        """
+        for _ in range(steps):
+            self.step()
+        return self.get_summary(quantiles)
+
+    def get_replicate_series(self, name):
+        """ Returns:
+                * pandas DataFrame with collected values of a model reporter, indexed by
+                  the step at which they were collected, with one column per replicate
+        """
+        return pd.DataFrame(np.array(self.collected[name]).reshape(-1, self.num_replicates),
+                            index=pd.Index(self.collected_steps, name='step'))
+
+    def get_summary(self, quantiles=(0.05, 0.5, 0.95)):
+        """ Method to summarize collected series over replicates
+
+            Arguments:
+                * quantiles: quantiles computed at each step
+
+            Returns:
+                * pandas DataFrame indexed by step, with (reporter, statistic) columns.
+                  Statistics are 'mean', 'std' and 'q' + quantile, e.g. 'q0.05'
+        """
+        summary = {}
+        for name in ENSEMBLE_SERIES:
+            values = np.array(self.collected[name]).reshape(-1, self.num_replicates)
+            summary[(name, 'mean')] = values.mean(axis=1)
+            summary[(name, 'std')] = values.std(axis=1)
+            for quantile, values_q in zip(quantiles, np.quantile(values, quantiles, axis=1)):
+                summary[(name, 'q{:g}'.format(quantile))] = values_q
+        return pd.DataFrame(summary, index=pd.Index(self.collected_steps, name='step'))
@@ -0,0 +1,480 @@
+# IMPORT LIBS
+from collections import defaultdict
+import numpy as np
+
+from mapped_arrays import new_mapped_array
+
+
+class Cell_Index_Grid:
+    """ Non-toroidal grid with a compact cell-occupancy index. Drop-in replacement for
+        mesa MultiGrid as used by Simple_Language_Model and Simple_Language_Agent
+
+        Two occupancy structures are kept:
+            * per-cell buckets of agents, updated incrementally in O(1) by
+              place_agent, move_agent and remove_agent (per-agent engine)
+            * a CSR snapshot (agent rows sorted by cell plus cell offsets), rebuilt
+              in one batch from agent arrays by 'rebuild' (array engine)
+
+        Cells are identified by the integer id x * height + y. The Moore neighbourhood
+        of every cell is precomputed once in a padded table
+    """
+    moore_moves = np.array([(-1, -1), (-1, 0), (-1, 1), (0, -1),
+                            (0, 1), (1, -1), (1, 0), (1, 1)])
+
+    def __init__(self, width, height, ags_data, rng, moore_table=None):
+        """ Arguments:
+                * width, height: grid dimensions
+                * ags_data: Lang_Agents_Arrays instance holding agent positions
+                * rng: Buffered_RNG instance
+                * moore_table: optional precomputed (neighbors, num_neighbors) arrays,
+                  as returned by compute_moore_table, e.g. shared by worker processes
+        """
+        self.rng = rng
+        self.width = width
+        self.height = height
+        self.torus = False
+        self.num_cells = width * height
+        self.ags_data = ags_data
+        self.neighbors, self.num_neighbors = moore_table or self.compute_moore_table()
+        self._neighborhoods = dict()
+        # agent objects by row, needed to translate the CSR snapshot to agents
+        self.row_agents = []
+        # incremental occupancy
+        self.cell_counts = np.zeros(self.num_cells, dtype=np.int64)
+        self.cells = defaultdict(list)
+        self.slots = []
+        # CSR snapshot
+        self.order = None
+        self.cell_starts = None
+        self.buckets_stale = False
+        self.snapshot_stale = False
+
+    def get_state(self):
+        """ Returns:
+                * dict with slot of each agent row in its cell bucket and
+                  staleness of buckets. Together with agent positions, it
+                  allows restoring the exact occupancy structures
+        """
+        return {'slots': np.array(self.slots, dtype=np.int64), 'buckets_stale': self.buckets_stale}
+
+    def set_state(self, state, agents):
+        """ Restore occupancy of an empty grid from a dict built by get_state
+
+            Arguments:
+                * state: dict
+                * agents: list of all agents placed on the grid
+        """
+        for agent in agents:
+            self._register(agent)
+        self.slots = state['slots'].tolist()
+        rows = np.sort(np.array([agent.row for agent in agents], dtype=np.int64))
+        self.rebuild(rows)
+        if not state['buckets_stale']:
+            self.cells = defaultdict(list)
+            for agent in sorted(agents, key=lambda ag: self.slots[ag.row]):
+                self.cells[self.cell_id(agent.pos)].append(agent)
+            self.buckets_stale = False
+
+    def compute_moore_table(self):
+        """ Method to precompute the Moore neighbourhood (radius 1, center excluded)
+            of each cell
+
+            Returns:
+                * neighbors: (num_cells, 8) array of neighbour cell ids, padded with -1
+                * num_neighbors: array with number of valid neighbours per cell
+        """
+        xs, ys = np.divmod(np.arange(self.num_cells), self.height)
+        nxs = xs[:, None] + self.moore_moves[:, 0]
+        nys = ys[:, None] + self.moore_moves[:, 1]
+        valid = (nxs >= 0) & (nxs < self.width) & (nys >= 0) & (nys < self.height)
+        # stable sort moves valid neighbours to the front of each row
+        idxs = np.argsort(~valid, axis=1, kind='stable')
+        neighbors = np.take_along_axis(np.where(valid, nxs * self.height + nys, -1), idxs, axis=1)
+        return neighbors, valid.sum(axis=1)
+
+    def cell_id(self, pos):
+        return pos[0] * self.height + pos[1]
+
+    def cell_pos(self, cell):
+        x, y = divmod(int(cell), self.height)
+        return x, y
+
+    def out_of_bounds(self, pos):
+        x, y = pos
+        return x < 0 or x >= self.width or y < 0 or y >= self.height
+
+    def get_neighborhood(self, pos, moore=True, include_center=False, radius=1):
+        """ Same as mesa MultiGrid.get_neighborhood. Moore neighbourhoods of radius 1
+            are read from the precomputed table and cached as tuples of positions
+
+            Returns:
+                * tuple of (x, y) positions. It must not be modified
+        """
+        key = (self.cell_id(pos), moore, include_center)
+        if radius == 1 and key in self._neighborhoods:
+            return self._neighborhoods[key]
+        x, y = pos
+        neighborhood = []
+        for dx in range(-radius, radius + 1):
+            for dy in range(-radius, radius + 1):
+                if not moore and abs(dx) + abs(dy) > radius:
+                    continue
+                if (dx, dy) == (0, 0) and not include_center:
+                    continue
+                if not self.out_of_bounds((x + dx, y + dy)):
+                    neighborhood.append((x + dx, y + dy))
+        neighborhood = tuple(neighborhood)
+        if radius == 1:
+            self._neighborhoods[key] = neighborhood
+        return neighborhood
+
+    def random_neighbor_cell(self, pos):
+        """ Pick uniformly one of the Moore neighbours of pos in O(1)
+
+            Returns:
+                * (x, y) position
+        """
+        cell = self.cell_id(pos)
+        return self.cell_pos(self.neighbors[cell, self.rng.randrange(self.num_neighbors[cell])])
+
+    def _register(self, agent):
+        while len(self.row_agents) <= agent.row:
+            self.row_agents.append(None)
+            self.slots.append(-1)
+        self.row_agents[agent.row] = agent
+
+    def invalidate(self):
+        """ Mark all occupancy structures as stale after agent positions were changed
+            outside of the grid (e.g. by worker processes). They are rebuilt
+            from agent arrays when first needed
+        """
+        self.snapshot_stale = True
+        self.buckets_stale = True
+
+    def _ensure_snapshot(self):
+        if self.snapshot_stale:
+            if self.ags_data.block_size:
+                self.rebuild_blocks(self._placed_row_blocks)
+            else:
+                num_rows = self.ags_data.num_rows
+                self.rebuild(np.flatnonzero(self.ags_data.x[:num_rows] >= 0))
+
+    def _placed_row_blocks(self):
+        """ Returns:
+                * generator of arrays of rows of agents placed on the grid, one for each
+                  block of ags_data.block_size rows below num_rows
+        """
+        num_rows, block_size = self.ags_data.num_rows, self.ags_data.block_size
+        for start in range(0, num_rows, block_size):
+            yield start + np.flatnonzero(self.ags_data.x[start:min(start + block_size, num_rows)] >= 0)
+
+    def _sync_buckets(self):
+        """ Rebuild incremental buckets from agent arrays after a batch update """
+        self._ensure_snapshot()
+        self.cells = defaultdict(list)
+        for agent in self.row_agents:
+            if agent is not None and agent.pos is not None:
+                bucket = self.cells[self.cell_id(agent.pos)]
+                self.slots[agent.row] = len(bucket)
+                bucket.append(agent)
+        self.buckets_stale = False
+
+    def _add_to_cell(self, agent, cell):
+        bucket = self.cells[cell]
+        self.slots[agent.row] = len(bucket)
+        bucket.append(agent)
+        self.cell_counts[cell] += 1
+        # cell order in the CSR snapshot no longer matches the buckets
+        self.snapshot_stale = True
+
+    def _remove_from_cell(self, agent, cell):
+        # swap with last agent of the bucket and pop, O(1)
+        bucket = self.cells[cell]
+        slot = self.slots[agent.row]
+        last = bucket.pop()
+        if last is not agent:
+            bucket[slot] = last
+            self.slots[last.row] = slot
+        self.cell_counts[cell] -= 1
+        self.snapshot_stale = True
+
+    def place_agent(self, agent, pos):
+        """ Position an agent on the grid, and set its pos variable """
+        if self.buckets_stale:
+            self._sync_buckets()
+        self._register(agent)
+        self._add_to_cell(agent, self.cell_id(pos))
+        agent.pos = pos
+
+    def place_agents(self, agents):
+        """ Bulk version of place_agent for agents whose positions are already
+            set in agent arrays. If incremental buckets are in use, agents are added
+            to them in O(1) each. Otherwise both occupancy structures are marked stale
+            and rebuilt from agent arrays when first needed
+        """
+        max_row = max([agent.row for agent in agents], default=-1)
+        if max_row >= len(self.row_agents):
+            self.row_agents.extend([None] * (max_row + 1 - len(self.row_agents)))
+            self.slots.extend([-1] * (max_row + 1 - len(self.slots)))
+        for agent in agents:
+            self.row_agents[agent.row] = agent
+        if self.buckets_stale or not self.cells:
+            self.invalidate()
+        else:
+            for agent in agents:
+                self._add_to_cell(agent, self.cell_id(agent.pos))
+            self.snapshot_stale = True
+
+    def remove_agent(self, agent):
+        """ Remove the agent from the grid and set its pos variable to None """
+        if self.buckets_stale:
+            self._sync_buckets()
+        self._remove_from_cell(agent, self.cell_id(agent.pos))
+        self.row_agents[agent.row] = None
+        agent.pos = None
+
+    def remove_agents(self, agents):
+        """ Bulk version of remove_agent. If incremental buckets are stale, only
+            agent positions are cleared and both occupancy structures stay stale,
+            so that removals never trigger a full resynchronization
+        """
+        if not self.buckets_stale:
+            for agent in agents:
+                self._remove_from_cell(agent, self.cell_id(agent.pos))
+        rows = [agent.row for agent in agents]
+        for row in rows:
+            self.row_agents[row] = None
+        # same as setting pos to None
+        self.ags_data.set_positions(rows, -1, -1)
+        self.snapshot_stale = True
+
+    def move_agents(self, agents, xs, ys):
+        """ Bulk version of move_agent, with the same staleness rules as remove_agents
+
+            Arguments:
+                * agents: list of agents
+                * xs, ys: arrays of new coords
+        """
+        if not self.buckets_stale:
+            for agent, x, y in zip(agents, xs.tolist(), ys.tolist()):
+                self.move_agent(agent, (x, y))
+        else:
+            rows = np.array([agent.row for agent in agents], dtype=np.int64)
+            self.ags_data.set_positions(rows, xs, ys)
+        self.snapshot_stale = True
+
+    def remove_rows(self, rows):
+        """ Row version of remove_agents for agents without agent objects,
+            that are never in incremental buckets
+        """
+        self.ags_data.set_positions(rows, -1, -1)
+        self.invalidate()
+
+    def move_rows(self, rows, xs, ys):
+        """ Row version of move_agents for agents without agent objects """
+        self.ags_data.set_positions(rows, xs, ys)
+        self.invalidate()
+
+    def move_agent(self, agent, pos):
+        """ Move an agent from its current position to a new position """
+        if self.buckets_stale:
+            self._sync_buckets()
+        self._remove_from_cell(agent, self.cell_id(agent.pos))
+        self._add_to_cell(agent, self.cell_id(pos))
+        agent.pos = pos
+
+    def get_cell_rows(self, cell_list):
+        """ Row version of get_cell_list_contents, read from the CSR snapshot.
+            It also works for agents without agent objects (engine 'arrays')
+
+            Arguments:
+                * cell_list: a single (x, y) tuple or a list of them
+
+            Returns:
+                * array of agent rows
+        """
+        if isinstance(cell_list, tuple):
+            cell_list = [cell_list]
+        self._ensure_snapshot()
+        cells = [self.cell_id(pos) for pos in cell_list]
+        return np.concatenate([self.order[self.cell_starts[cell]:self.cell_starts[cell] + self.cell_counts[cell]]
+                               for cell in cells] or [self.order[:0]])
+
+    def get_cell_list_contents(self, cell_list):
+        """ Same as mesa MultiGrid.get_cell_list_contents. Needs agent objects,
+            see get_cell_rows otherwise
+
+            Arguments:
+                * cell_list: a single (x, y) tuple or a list of them
+
+            Returns:
+                * list of agents. If a single cell is requested, the internal bucket
+                  is returned without copying and it must not be modified
+        """
+        if isinstance(cell_list, tuple):
+            cell_list = [cell_list]
+        if self.buckets_stale:
+            return [self.row_agents[row] for row in self.get_cell_rows(cell_list).tolist()]
+        if len(cell_list) == 1:
+            return self.cells.get(self.cell_id(cell_list[0]), [])
+        return [agent for pos in cell_list for agent in self.cells.get(self.cell_id(pos), [])]
+
+    def is_cell_empty(self, pos):
+        # cell counts are kept up to date by incremental buckets
+        if self.buckets_stale:
+            self._ensure_snapshot()
+        return not self.cell_counts[self.cell_id(pos)]
+
+    def random_cell_partner(self, agent):
+        """ Pick in O(1) a random agent from the cell of the given agent.
+            As in mesa-based speak, the agent itself may be picked
+
+            Returns:
+                * an agent, or None if agent is alone in its cell
+        """
+        if self.buckets_stale:
+            self._sync_buckets()
+        bucket = self.cells[self.cell_id(agent.pos)]
+        if len(bucket) > 1:
+            return bucket[self.rng.randrange(len(bucket))]
+
+    # BATCH METHODS FOR ARRAY ENGINE
+
+    def random_moves(self, rows, uniforms=None, rebuild=True):
+        """ Vectorized random step of the given agent rows into any
+            of their surrounding cells. Updates agent arrays and the CSR snapshot
+
+            Arguments:
+                * rows: array of agent rows
+                * uniforms: optional array of uniforms used to pick the cells,
+                  one per row. By default they are drawn from the model rng
+                * rebuild: if False, the CSR snapshot is not rebuilt, e.g. when rows
+                  are a block of all agents that will be moved before rebuilding it
+        """
+        cells = self.ags_data.x[rows] * self.height + self.ags_data.y[rows]
+        if uniforms is None:
+            uniforms = self.rng.generator.random(len(rows))
+        picks = (uniforms * self.num_neighbors[cells]).astype(np.int64)
+        self.ags_data.set_positions(rows, *np.divmod(self.neighbors[cells, picks], self.height))
+        if rebuild:
+            self.rebuild(rows)
+        else:
+            self.snapshot_stale = True
+
+    def _sort_by_cell(self, cells):
+        # stable sort of 16-bit integers is a radix sort
+        return np.argsort(cells.astype(np.uint16) if self.num_cells <= 1 << 16 else cells, kind='stable')
+
+    def rebuild(self, rows, block_size=None):
+        """ Rebuild the CSR snapshot from agent arrays. Incremental buckets
+            are marked stale and resynchronized on demand
+
+            Arguments:
+                * rows: array of rows of all agents placed on the grid
+                * block_size: if given, rows are counted and then placed by
+                  blocks of block_size rows (counting sort), so that temporary
+                  arrays do not grow with population. The snapshot is the same
+        """
+        if not block_size or len(rows) <= block_size:
+            cells = self.ags_data.x[rows] * self.height + self.ags_data.y[rows]
+            self.cell_counts = np.bincount(cells, minlength=self.num_cells)
+            self.cell_starts = np.cumsum(self.cell_counts) - self.cell_counts
+            self.order = rows[self._sort_by_cell(cells)]
+            self.buckets_stale = True
+            self.snapshot_stale = False
+        else:
+            self.rebuild_blocks(lambda: (rows[start:start + block_size]
+                                         for start in range(0, len(rows), block_size)))
+
+    def rebuild_blocks(self, get_blocks):
+        """ Same as rebuild, but rows are given block by block, so that no array of
+            all rows is needed. Rows are counted and then placed by blocks (counting sort).
+            If agent arrays are mapped to disk, the snapshot order is a mapped file
+            in their directory as well. The snapshot is the same as with rebuild
+
+            Arguments:
+                * get_blocks: function returning an iterable of arrays of rows of
+                  agents placed on the grid, e.g. Lang_Agents_Arrays.get_row_blocks.
+                  It is called twice, and both iterables must give the same rows
+        """
+        self.cell_counts = np.zeros(self.num_cells, dtype=np.int64)
+        for block in get_blocks():
+            self.cell_counts += np.bincount(self.ags_data.x[block] * self.height + self.ags_data.y[block],
+                                            minlength=self.num_cells)
+        self.cell_starts = np.cumsum(self.cell_counts) - self.cell_counts
+        num_placed = int(self.cell_counts.sum())
+        if self.ags_data.mapped_dir is None:
+            self.order = np.empty(num_placed, dtype=np.int64)
+        elif self.order is None or len(self.order) != num_placed or not isinstance(self.order, np.memmap):
+            self.order = new_mapped_array(self.ags_data.mapped_dir, 'grid_order', (num_placed,), np.int64)
+        # next free position of each cell in order
+        fill = self.cell_starts.copy()
+        for block in get_blocks():
+            cells = self.ags_data.x[block] * self.height + self.ags_data.y[block]
+            idxs = self._sort_by_cell(cells)
+            cells = cells[idxs]
+            # rank of each agent among agents of its cell in the block
+            ranks = np.arange(len(cells)) - np.searchsorted(cells, cells)
+            self.order[fill[cells] + ranks] = block[idxs]
+            fill += np.bincount(cells, minlength=self.num_cells)
+        self.buckets_stale = True
+        self.snapshot_stale = False
+
+    def get_cell_blocks(self, block_size):
+        """ Method to split the agents of the CSR snapshot into blocks of consecutive cells
+            with about block_size agents each (more if a single cell holds more)
+
+            Returns:
+                * list of arrays of agent rows, views of the snapshot
+        """
+        self._ensure_snapshot()
+        cell_ends = np.cumsum(self.cell_counts)
+        bounds = [0]
+        while bounds[-1] < len(self.order):
+            start = bounds[-1]
+            # end of last cell that fits in the block, or of the first cell if none fits
+            stop = cell_ends[np.searchsorted(cell_ends, start + block_size, side='right') - 1]
+            if stop <= start:
+                stop = cell_ends[np.searchsorted(cell_ends, start, side='right')]
+            bounds.append(int(stop))
+        return [self.order[start:stop] for start, stop in zip(bounds[:-1], bounds[1:])]
+
+    def random_cell_partners(self, rows):
+        """ Vectorized random_cell_partner over the CSR snapshot
+
+            Arguments:
+                * rows: array of agent rows
+
+            Returns:
+                * two arrays of rows: agents that are not alone in their cell
+                  and their randomly picked partners
+        """
+        cells = self.ags_data.x[rows] * self.height + self.ags_data.y[rows]
+        ag_counts = self.cell_counts[cells]
+        speakers = ag_counts > 1
+        picks = (self.rng.generator.random(speakers.sum()) * ag_counts[speakers]).astype(np.int64)
+        return rows[speakers], self.order[self.cell_starts[cells[speakers]] + picks]
+
+    def cell_matching(self, rows, keys):
+        """ Deterministic matching of co-located agents: agents of each cell are
+            sorted by key and paired two by two (first with second, third with fourth ...).
+            If a cell has an odd number of agents, the last one is left unmatched.
+            Pairs only depend on the agents of each cell and their keys,
+            not on the order of rows
+
+            Arguments:
+                * rows: array of agent rows
+                * keys: array of floats, one per row, e.g. keyed uniforms
+
+            Returns:
+                * two arrays of rows with the first and second agent of each pair
+        """
+        cells = self.ags_data.x[rows] * self.height + self.ags_data.y[rows]
+        order = np.lexsort((rows, keys, cells))
+        cells, rows = cells[order], rows[order]
+        same_cell = cells[1:] == cells[:-1]
+        # position of each agent within its cell
+        idxs = np.arange(len(rows))
+        cell_starts = np.maximum.accumulate(np.where(np.concatenate(([True], ~same_cell)), idxs, 0))
+        firsts = np.flatnonzero(((idxs[:-1] - cell_starts[:-1]) % 2 == 0) & same_cell)
+        return rows[firsts], rows[firsts + 1]
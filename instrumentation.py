@@ -0,0 +1,99 @@
+# IMPORT LIBS
+import json
+from time import perf_counter
+from contextlib import contextmanager, nullcontext
+from collections import defaultdict
+import pandas as pd
+
+
+class Step_Profiler:
+    """ Opt-in instrumentation of Simple_Language_Model steps.
+        It accumulates, for each model step, the time spent in each phase (seconds)
+        and event counters (conversations, language switches, empty-cell speaks and
+        conversations by pair type). Model-level phases are also kept as trace events,
+        which can be exported to Chrome trace format (chrome://tracing, Perfetto)
+    """
+    # pair type of conversation for each (lang, other lang) pair. 0, 1, 2 => spa, bil, cat
+    pair_types = {(0, 0): 'spa_pairs', (0, 1): 'spa_pairs', (1, 0): 'spa_pairs',
+                  (2, 2): 'cat_pairs', (2, 1): 'cat_pairs', (1, 2): 'cat_pairs',
+                  (1, 1): 'bil_bil_pairs', (0, 2): 'spa_cat_pairs', (2, 0): 'spa_cat_pairs'}
+
+    def __init__(self):
+        self.rows = []
+        self.events = []
+        self.step = None
+        self.current = None
+        self.origin = perf_counter()
+
+    def start_step(self, step):
+        self.step = step
+        self.current = defaultdict(float)
+
+    def end_step(self):
+        row = dict(self.current)
+        row['step'] = self.step
+        self.rows.append(row)
+        counters = {key: value for key, value in self.current.items() if not key.endswith('_s')}
+        self.events.append({'name': 'counters', 'ph': 'C', 'pid': 0, 'tid': 0,
+                            'ts': (perf_counter() - self.origin) * 1e6, 'args': counters})
+
+    def add_time(self, phase, seconds):
+        self.current[phase + '_s'] += seconds
+
+    def count(self, counter, num=1):
+        self.current[counter] += num
+
+    def count_pair(self, lang, other_lang):
+        self.current['conversations'] += 1
+        self.current[self.pair_types[(lang, other_lang)]] += 1
+
+    @contextmanager
+    def phase(self, name):
+        """ Context manager that times a phase and records it as a trace event """
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            end = perf_counter()
+            self.add_time(name, end - start)
+            self.events.append({'name': name, 'ph': 'X', 'pid': 0, 'tid': 0,
+                                'ts': (start - self.origin) * 1e6, 'dur': (end - start) * 1e6,
+                                'args': {'step': self.step}})
+
+    def get_metrics_dataframe(self):
+        """ Returns:
+                * pandas DataFrame with one row per profiled step, indexed by step like
+                  the DataCollector model reporters. Columns ending in '_s' are phase
+                  times in seconds, the others are counters
+        """
+        return pd.DataFrame(self.rows).set_index('step').fillna(0)
+
+    def export_trace(self, filename):
+        """ Write recorded phases and per-step counters as a Chrome trace JSON file """
+        with open(filename, 'w') as f:
+            json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, f)
+
+
+class Null_Profiler:
+    """ Profiler that does nothing. It is used when profiling is off """
+
+    def start_step(self, step):
+        pass
+
+    def end_step(self):
+        pass
+
+    def add_time(self, phase, seconds):
+        pass
+
+    def count(self, counter, num=1):
+        pass
+
+    def count_pair(self, lang, other_lang):
+        pass
+
+    def phase(self, name):
+        return nullcontext()
+
+
+NULL_PROFILER = Null_Profiler()
@@ -0,0 +1,97 @@
+# IMPORT LIBS
+import os
+import json
+import numpy as np
+
+# file with number of used rows and step of the last sync, see write_manifest
+MANIFEST_FILENAME = 'manifest.json'
+# rows copied at a time when mapped arrays are resized
+COPY_BLOCK_SIZE = 1 << 20
+
+
+def column_path(directory, name):
+    return os.path.join(directory, name + '.npy')
+
+
+def to_mapped_array(directory, name, array):
+    """ Function to copy an array into a new .npy file mapped in memory. As in
+        resize_mapped_array, an existing file is replaced, not overwritten
+
+        Returns:
+            * numpy memmap over the file, with the contents of array. The file can be
+              opened by other processes with np.load(path, mmap_mode='r')
+    """
+    path = column_path(directory, name)
+    mapped = np.lib.format.open_memmap(path + '.tmp', mode='w+', dtype=array.dtype, shape=array.shape)
+    for start in range(0, len(array), COPY_BLOCK_SIZE):
+        mapped[start:start + COPY_BLOCK_SIZE] = array[start:start + COPY_BLOCK_SIZE]
+    mapped.flush()
+    os.replace(path + '.tmp', path)
+    return mapped
+
+
+def new_mapped_array(directory, name, shape, dtype):
+    """ Function to create a new .npy file of zeros mapped in memory. As in
+        resize_mapped_array, an existing file is replaced, not overwritten
+
+        Returns:
+            * numpy memmap over the file
+    """
+    path = column_path(directory, name)
+    mapped = np.lib.format.open_memmap(path + '.tmp', mode='w+', dtype=dtype, shape=shape)
+    os.replace(path + '.tmp', path)
+    return mapped
+
+
+def resize_mapped_array(directory, name, mapped, capacity):
+    """ Function to grow a mapped array to a new number of rows. A new file is written
+        and then renamed over the old one, so that readers that opened the old file
+        keep a valid (stale) view of it
+
+        Arguments:
+            * mapped: numpy memmap returned by to_mapped_array or resize_mapped_array
+            * capacity: new number of rows. New rows are zeros
+
+        Returns:
+            * numpy memmap over the new file
+    """
+    path = column_path(directory, name)
+    tmp_path = path + '.tmp'
+    resized = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=mapped.dtype,
+                                        shape=(capacity,) + mapped.shape[1:])
+    for start in range(0, len(mapped), COPY_BLOCK_SIZE):
+        stop = min(start + COPY_BLOCK_SIZE, len(mapped))
+        resized[start:stop] = mapped[start:stop]
+    resized.flush()
+    os.replace(tmp_path, path)
+    return resized
+
+
+def write_manifest(directory, manifest):
+    """ Function to replace atomically the manifest of a directory of mapped arrays """
+    path = os.path.join(directory, MANIFEST_FILENAME)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f)
+    os.replace(path + '.tmp', path)
+
+
+def open_agents_snapshot(directory):
+    """ Function to open, e.g. from an analysis process, the agent columns of a model run
+        with storage_dir=directory, without copying them. Columns are read-only views
+        of the files written by the run, trimmed to the rows in use at the last sync
+        (see Lang_Agents_Arrays.sync_mapped). Rows of removed agents have x = y = -1.
+        If the run is still going, values are those of the current step, that may be
+        in progress, and arrays must be reopened to see rows added after the call
+
+        Arguments:
+            * directory: storage directory of the run
+
+        Returns:
+            * dict with 'step', 'num_rows' and a read-only numpy array for each column
+    """
+    with open(os.path.join(directory, MANIFEST_FILENAME)) as f:
+        manifest = json.load(f)
+    snapshot = {'step': manifest['step'], 'num_rows': manifest['num_rows']}
+    for name in manifest['columns']:
+        snapshot[name] = np.load(column_path(directory, name), mmap_mode='r')[:manifest['num_rows']]
+    return snapshot
@@ -1,38 +1,58 @@
 # IMPORT RELEVANT LIBRARIES
+import os
+import gc
+import glob
+import shutil
+import pickle
+import tempfile
 from importlib import reload
 from math import ceil
-import random
 import itertools
-from collections import defaultdict, Counter, OrderedDict
+from collections import defaultdict, OrderedDict, deque
 import numpy as np
 import pandas as pd
-import matplotlib
-matplotlib.use("TKAgg")
-import matplotlib.pylab as plt
-import matplotlib.animation as animation
-from scipy.spatial.distance import pdist
-import networkx as nx
 
-#import library to save any python data type to HDF5
-import deepdish as dd
-
-# import progress bar
-import pyprind
+# plotting (matplotlib), HDF5 (deepdish, tables) and progress bar (pyprind) libraries
+# are imported in the methods that use them, so that importing the model is fast
+# and does not need them
 
 
 # IMPORT FROM simp_agent.py
 from agent_simple import Simple_Language_Agent
+from agent_arrays import Lang_Agents_Arrays
+from cell_arrays import Lang_Cells_Arrays
+from grid_index import Cell_Index_Grid
+from random_streams import Buffered_RNG
+from social_networks import Compact_Network
+from population import (compute_cluster_sizes, generate_cluster_points_coords, generate_population,
+                        write_population)
+from instrumentation import Step_Profiler, NULL_PROFILER
 
 # IMPORT MESA LIBRARIES
 from mesa import Model
 from mesa.time import RandomActivation, SimultaneousActivation, StagedActivation
-from mesa.space import MultiGrid
 from mesa.datacollection import DataCollector
 
 class Simple_Language_Model(Model):
     def __init__(self, num_people, width=5, height=5, max_people_factor=5,
                  init_lang_distrib=[0.25, 0.65, 0.1], num_cities=10, lang_ags_sorted_by_dist=True,
-                 lang_ags_sorted_in_clust=True):
+                 lang_ags_sorted_in_clust=True, engine='agents', activation='random',
+                 collect_freq=1, birth_rate=0., death_rate=0., migration_rate=0.,
+                 storage_dir=None, block_size=None, debug_stats=False, seed=None):
+        if engine not in ['agents', 'arrays', 'cells']:
+            raise ValueError("engine should be 'agents', 'arrays' or 'cells'")
+        if activation not in ['random', 'simultaneous']:
+            raise ValueError("activation should be either 'random' or 'simultaneous'")
+        if engine == 'cells' and activation != 'random':
+            raise ValueError("engine 'cells' only supports activation='random'")
+        if engine == 'cells' and (birth_rate or death_rate or migration_rate):
+            raise ValueError("engine 'cells' has no demographic dynamics")
+        if storage_dir and engine != 'arrays':
+            raise ValueError("agent arrays can only be stored on disk with engine 'arrays'")
+        if (storage_dir or block_size) and activation != 'simultaneous':
+            # random steps draw partners against the whole population at once
+            raise ValueError("agent arrays can only be stored on disk or stepped in blocks "
+                             "with activation='simultaneous'")
         self.num_people = num_people
         self.grid_width = width
         self.grid_height = height
@@ -43,64 +63,112 @@ class Simple_Language_Model(Model):
         self.lang_ags_sorted_in_clust = lang_ags_sorted_in_clust
         self.clust_centers = None
         self.cluster_sizes = None
-
-        # define grid and schedule
-        self.grid = MultiGrid(height, width, False)
+        # 'agents' steps each agent through the schedule,
+        # 'arrays' steps the whole population at once on self.ags_data, where agents
+        # are only rows, without agent objects,
+        # 'cells' steps an approximate coarse-grained population without agents
+        # on self.cells_data (see cell_arrays.Lang_Cells_Arrays)
+        self.engine = engine
+        # 'random' updates agents one after the other (engine 'agents') or with one
+        # batched step of random partners (engine 'arrays'). 'simultaneous' matches
+        # co-located agents in pairs and commits all conversations at once against
+        # a snapshot of word counts. It is order-independent and runs on
+        # self.ags_data for both engines
+        self.activation = activation
+        # model reporters are collected every collect_freq steps
+        self.collect_freq = collect_freq
+        # per-agent and per-step probabilities of having a child, dying and migrating
+        # to another city (see update_demography)
+        self.birth_rate = birth_rate
+        self.death_rate = death_rate
+        self.migration_rate = migration_rate
+        # if set, agent columns are memory-mapped files in storage_dir, that can be larger
+        # than RAM and be read by other processes while the model runs (see
+        # mapped_arrays.open_agents_snapshot). If block_size is set, agents are stepped
+        # (with simultaneous activation), updated by demography and, with engine 'arrays',
+        # created in blocks of about block_size rows, so that memory used is bounded
+        self.storage_dir = storage_dir
+        self.block_size = block_size
+        # check running lang stats against a full recount at every step
+        self.debug_stats = debug_stats
+
+        # define random streams: all model randomness derives from seed
+        # (mesa self.random is only used by the schedule to shuffle agents)
+        self.seed = seed
+        model_seq, schedule_seq, keyed_seq = np.random.SeedSequence(seed).spawn(3)
+        self.rng = Buffered_RNG(model_seq)
+        self.reset_randomizer(int(schedule_seq.generate_state(1)[0]))
+        # key of counter-based draws of simultaneous steps, see keyed_uniforms
+        self.stream_key = int(keyed_seq.generate_state(1, dtype=np.uint64)[0])
+
+        # define agents state arrays, grid and schedule
+        if storage_dir:
+            self.ags_data = Lang_Agents_Arrays(0, self.rng)
+            self.ags_data.map_to_disk(storage_dir, self.get_pool_size())
+        else:
+            self.ags_data = Lang_Agents_Arrays(self.get_pool_size(), self.rng)
+        self.ags_data.block_size = block_size
+        self.grid = Cell_Index_Grid(width, height, self.ags_data, self.rng)
         self.schedule = RandomActivation(self)
 
-        ## RANDOMLY DEFINE ALL CITY-CENTERS COORDS (CITY == HOMES, JOB CENTERS and SCHOOLS)
-        # first define available points as pct of squared grid length
-        grid_pct_list = np.linspace(0.1, 0.9, 100) # avoid edges
-        # now generate the cluster centers (CITIES-VILLAGES)
-        self.clust_centers = np.random.choice(grid_pct_list,size=(self.num_cities, 2),replace=False)
-        if lang_ags_sorted_by_dist:
-            self.clust_centers = sorted(self.clust_centers,
-                                        key=lambda x:pdist([x,[0,0]])
-                                       )
-
+        self.create_networks()
 
+        # ADD ALL AGENTS TO GRID AND SCHEDULE (or to cell classes)
+        self.cells_data = None
+        if engine == 'cells':
+            self.cells_data = Lang_Cells_Arrays(self.grid, self.rng)
+            self.cells_data.add_agents(*self.generate_population()[:3])
+        else:
+            self.create_lang_agents()
 
-        # INITIALIZE KNOWN PEOPLE NETWORK => label is lang spoken
-        self.known_people_network = nx.DiGraph()
-        #        self.known_people_network.add_edge('A','B', lang_spoken = 'cat')
-        #        self.known_people_network.add_edge('A','C', lang_spoken = 'spa')
-        #        self.known_people_network['A']['C']['lang_spoken']
-        #        self.known_people_network['B']['A'] = 'cat'
+        # DATA COLLECTOR (and optional on-disk recorder, see start_recording)
+        self.recorder = None
+        self.create_datacollector()
+        # step of each collection, as the index of model reporters
+        self.collected_steps = []
+        # why and when the last run_model stopped
+        self.run_report = None
+        # optional step instrumentation, see start_profiling
+        self.profiler = None
+        # optional multi-process stepping, see start_partitioned
+        self.partitioned_stepper = None
+        # optional live monitoring server, see start_monitor
+        self.monitor = None
+        # optional incremental spatial metrics, see start_metrics
+        self.metrics = None
+
+    def create_networks(self):
+        # Networks are compact graphs indexed by agent rows. Agents become nodes
+        # only when they get their first edge (see social_networks.Compact_Network)
+
+        # INITIALIZE KNOWN PEOPLE NETWORK => label is lang spoken (0, 1 => spa, cat)
+        self.known_people_network = Compact_Network(directed=True)
+        #        self.known_people_network.add_edge(ag_A, ag_B, lang_spoken=1)
+        #        self.known_people_network.add_edge(ag_A, ag_C, lang_spoken=0)
+        #        self.known_people_network.get_edge_data(ag_A, ag_C)['lang_spoken']
 
         # INITIALIZE FRIENDSHIP NETWORK
-        self.friendship_network = nx.Graph()  # sort by friendship intensity
-        #       sorted(self.friendship_network[n_1].items(),
+        self.friendship_network = Compact_Network(directed=False)  # sort by friendship intensity
+        #       sorted(self.friendship_network[ag_1].items(),
         #                    key=lambda edge: edge[1]['link_strength'],
         #                    reverse = True)
 
         # INITIALIZE FAMILY NETWORK
-        self.family_network = nx.DiGraph()
-
-        # ADD ALL AGENTS TO GRID AND SCHEDULE
-        S = 0.5
-        if (not lang_ags_sorted_by_dist) and (not lang_ags_sorted_in_clust):
-            for id_ in range(self.num_people):
-                x = random.randrange(self.grid_width)
-                y = random.randrange(self.grid_height)
-                coord = (x,y)
-                lang = np.random.choice([0,1,2], p=self.init_lang_distrib)
-                ag = Simple_Language_Agent(self, id_, lang, S)
-                self.add_agent(ag, coord)
-        else:
-            self.create_lang_agents()
+        self.family_network = Compact_Network(directed=True)
 
-        # DATA COLLECTOR
+    def create_datacollector(self):
         self.datacollector = DataCollector(
             model_reporters={"count_spa": lambda m: m.get_lang_stats(0),
                              "count_bil": lambda m: m.get_lang_stats(1),
                              "count_cat": lambda m: m.get_lang_stats(2),
-                             "total_num_agents": lambda m:len(m.schedule.agents),
+                             "total_num_agents": lambda m: m.get_num_agents(),
                              "biling_evol_h": lambda m:m.get_bilingual_global_evol('heard'),
                              "biling_evol_s": lambda m: m.get_bilingual_global_evol('spoken')}
         )
 
     def add_agent(self, a, coords):
-        """Method to add a given agent to grid, schedule and system networks
+        """Method to add a given agent to grid and schedule. Agent is added
+        to system networks when it gets its first edge
 
         Arguments:
             * a : agent class instance
@@ -110,64 +178,119 @@ class Simple_Language_Model(Model):
         # add agent to grid and schedule
         self.schedule.add(a)
         self.grid.place_agent(a, (coords[0], coords[1]))
-        ## add agent node to all networks
-        self.known_people_network.add_node(a)
-        self.friendship_network.add_node(a)
-        self.family_network.add_node(a)
 
-    def compute_cluster_sizes(self, min_size=20, small_large_pcts=[0.6, 0.4]):
-        """ Method to compute sizes of each agent cluster
+    def add_agents(self, ids, langs, xs, ys, clusters=None, S=0.5):
+        """Method to create many agents at once and add them to grid
+        and schedule with a single bulk insertion in each structure.
+        Agents take the free rows of removed agents first (see Lang_Agents_Arrays.add_rows)
 
         Arguments:
-            * min_size: minimum accepted cluster size ( integer)
-            * small_large_pcts: percentages of small and large cities over total ( list of floats  0<x<1)
+            * ids : array of agent unique ids, or None to use agent rows as ids,
+              so that ids of removed agents are reused along with their rows
+            * langs : array of agent lang types
+            * xs, ys : arrays of agent coords on grid
+            * clusters : optional array with index of cluster of each agent
+            * S : agents parameter S
 
         Returns:
-            * list of integers representing cluster sizes
+            * list of new agents
 
         """
-        if min_size * self.num_cities >= self.num_people:
-            raise ValueError('num_people should be greater than min_size * num_cities ')
-        size_choices = [max(int(self.num_people / (10 * self.num_cities)), min_size),
-                        max(int(self.num_people / self.num_cities), min_size)]
-        city_sizes = np.random.choice(size_choices, p=small_large_pcts, size=self.num_cities - 1)
-        last_city_size = self.num_people - city_sizes.sum()
-        city_sizes = np.append(city_sizes, last_city_size)
-        pcts = np.random.dirichlet(city_sizes)
-        return np.random.multinomial(city_sizes.sum(), pcts)
-
-    def generate_cluster_points_coords(self, pct_grid_w, pct_grid_h, clust_size):
-        """ Using binomial ditribution, this method generates initial coordinates
-            for a given cluster, defined via its center and its size.
-            Cluster size as well as cluster center coords
-            (in grid percentage) must be provided
+        rows = self.ags_data.add_rows(langs, xs, ys, clusters)
+        if ids is None:
+            ids = rows
+        # cyclic garbage collection would be triggered many times while
+        # creating large numbers of objects, although none of them is garbage
+        gc_was_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            agents = [Simple_Language_Agent(self, id_, None, S, row=row)
+                      for id_, row in zip(np.asarray(ids).tolist(), rows.tolist())]
+            self.schedule._agents.update((ag.unique_id, ag) for ag in agents)
+            self.grid.place_agents(agents)
+        finally:
+            if gc_was_enabled:
+                gc.enable()
+        return agents
+
+    def add_rows(self, langs, xs, ys, clusters=None):
+        """Row version of add_agents for engine 'arrays', whose agents have
+        no agent objects. Agents take the free rows of removed agents first
 
         Arguments:
-            * pct_grid_w: positive float < 1 to define clust_center along grid width
-            * pct_grid_h: positive float < 1 to define clust_center along grid height
-            * clust_size: desired size of the cluster being generated
+            * langs : array of agent lang types
+            * xs, ys : arrays of agent coords on grid
+            * clusters : optional array with index of cluster of each agent
 
         Returns:
-            * cluster_coordinates: two numpy arrays with x and y coordinates
-            respectively
+            * array of rows of new agents
+
+        """
+        rows = self.ags_data.add_rows(langs, xs, ys, clusters)
+        self.grid.invalidate()
+        return rows
+
+    def remove_rows(self, rows):
+        """Row version of remove_agents for engine 'arrays'. Rows are
+        removed from grid and networks, and freed for reuse
+
+        Arguments:
+            * rows : array of unique rows of agents
+
+        """
+        self.grid.remove_rows(rows)
+        for network in [self.known_people_network, self.friendship_network, self.family_network]:
+            network.remove_nodes(rows)
+        self.ags_data.remove_rows(rows)
+
+    def remove_agent(self, a):
+        """Method to remove a given agent from grid, schedule and networks.
+        Its row is freed for reuse
+
+        Arguments:
+            * a : agent class instance
 
         """
-        ## use binomial generator to get clusters in width * height grid
-        ## n = grid_width, p = pct_grid, size = num_experim
-        x_coords = np.random.binomial(self.grid_width,
-                                      pct_grid_w,
-                                      size=clust_size)
-        for idx, elem in enumerate(x_coords):
-            if elem >= self.grid_width:
-                x_coords[idx] = self.grid_width - 1
-
-        y_coords = np.random.binomial(self.grid_height,
-                                      pct_grid_h,
-                                      size=clust_size)
-        for idx, elem in enumerate(y_coords):
-            if elem >= self.grid_width:
-                y_coords[idx] = self.grid_height - 1
-        return x_coords, y_coords
+        self.remove_agents([a])
+
+    def remove_agents(self, agents):
+        """Bulk version of remove_agent. Each removal is O(1) in grid
+        and schedule
+
+        Arguments:
+            * agents : list of agents
+
+        """
+        rows = np.array([ag.row for ag in agents], dtype=np.int64)
+        for ag in agents:
+            del self.schedule._agents[ag.unique_id]
+        self.grid.remove_agents(agents)
+        for network in [self.known_people_network, self.friendship_network, self.family_network]:
+            network.remove_nodes(rows)
+        self.ags_data.remove_rows(rows)
+
+    def get_pool_size(self):
+        """ Returns:
+                * number of preallocated agent rows: max_people_factor * num_people
+                  if population can grow, num_people otherwise (none for engine 'cells')
+        """
+        if self.engine == 'cells':
+            return 0
+        if self.birth_rate or self.migration_rate or self.death_rate:
+            return self.max_people_factor * self.num_people
+        return self.num_people
+
+    def compute_cluster_sizes(self, min_size=20, small_large_pcts=[0.6, 0.4]):
+        """ Method to compute sizes of each agent cluster, see population.compute_cluster_sizes """
+        return compute_cluster_sizes(self.rng, self.num_people, self.num_cities,
+                                     min_size=min_size, small_large_pcts=small_large_pcts)
+
+    def generate_cluster_points_coords(self, pct_grid_w, pct_grid_h, clust_size):
+        """ Method to generate coordinates of agents of a cluster,
+            see population.generate_cluster_points_coords
+        """
+        return generate_cluster_points_coords(self.rng, self.grid_width, self.grid_height,
+                                              pct_grid_w, pct_grid_h, clust_size)
 
     def create_lang_agents(self):
         """ Method to instantiate all agents
@@ -179,34 +302,63 @@ class Simple_Language_Model(Model):
                 if agents must be sorted by distance to center of cluster they belong to
 
             """
+        if self.engine == 'arrays' and self.block_size:
+            # agents are only rows of agent arrays. The population is drawn block by block
+            # into the free rows of the arrays, then added as rows block by block
+            ags = self.ags_data
+            self.clust_centers, self.cluster_sizes = write_population(
+                self.rng, {attr: getattr(ags, attr) for attr in ['language', 'x', 'y', 'cluster']},
+                self.num_people, self.grid_width, self.grid_height, self.init_lang_distrib,
+                self.num_cities, self.lang_ags_sorted_by_dist, self.lang_ags_sorted_in_clust,
+                block_size=self.block_size)
+            for start in range(0, self.num_people, self.block_size):
+                block = slice(start, min(start + self.block_size, self.num_people))
+                self.add_rows(ags.language[block].copy(), ags.x[block].copy(), ags.y[block].copy(),
+                              None if self.cluster_sizes is None else ags.cluster[block].copy())
+            return
+        langs, xs, ys, clusters = self.generate_population()
+        if self.engine == 'arrays':
+            # agents are only rows of agent arrays
+            self.add_rows(langs, xs, ys, clusters)
+        else:
+            self.add_agents(np.arange(self.num_people), langs, xs, ys, clusters=clusters)
+
+    def generate_population(self):
+        """ Method to draw city centers, then lang type, coords and cluster of all
+            initial agents, see population.generate_population. City centers and
+            cluster sizes are stored in self.clust_centers and self.cluster_sizes
+
+        Returns:
+            * four numpy arrays with lang types, x and y coords and cluster index
+              of each agent. Cluster index is None if agents are not clustered
+
+        """
+        (langs, xs, ys, clusters,
+         self.clust_centers, self.cluster_sizes) = generate_population(
+            self.rng, self.num_people, self.grid_width, self.grid_height, self.init_lang_distrib,
+            self.num_cities, self.lang_ags_sorted_by_dist, self.lang_ags_sorted_in_clust)
+        return langs, xs, ys, clusters
 
-        self.cluster_sizes = self.compute_cluster_sizes()
-        array_langs = np.random.choice([0, 1, 2], p=self.init_lang_distrib, size=self.num_people)
-        if self.lang_ags_sorted_by_dist:
-            array_langs.sort()
-        idxs_to_split = self.cluster_sizes.cumsum()
-        langs_per_clust = np.split(array_langs, idxs_to_split)
-        if (not self.lang_ags_sorted_by_dist) and (self.lang_ags_sorted_in_clust):
-            for subarray in langs_per_clust:
-                subarray.sort()  # invert if needed
-        ids = set(range(self.num_people))
-
-        for clust_idx, (clust_size, clust_c_coords) in enumerate(zip(self.cluster_sizes, self.clust_centers)):
-            x_cs, y_cs = self.generate_cluster_points_coords(clust_c_coords[0], clust_c_coords[1], clust_size)
-            if (not self.lang_ags_sorted_by_dist) and (self.lang_ags_sorted_in_clust):
-                clust_p_coords = sorted(list(zip(x_cs, y_cs)),
-                                        key=lambda x:pdist([x, [self.grid_width*self.clust_centers[clust_idx][0],
-                                                                self.grid_height*self.clust_centers[clust_idx][1]]
-                                                            ])
-                                        )
-                x_cs, y_cs = list(zip(*clust_p_coords))
-            for ag_lang, x, y in zip(langs_per_clust[clust_idx], x_cs, y_cs):
-                ag = Simple_Language_Agent(self, ids.pop(), ag_lang, 0.5)
-                self.add_agent(ag, (x, y))
 
+    @property
+    def stats_data(self):
+        """ Arrays that keep the running lang aggregates read by model reporters:
+            self.cells_data for engine 'cells', self.ags_data otherwise
+        """
+        return self.cells_data if self.engine == 'cells' else self.ags_data
+
+    def get_num_agents(self):
+        """ Returns:
+                * number of agents. Engines 'cells' and 'arrays' have no agent
+                  objects, so it is read from the running aggregates
+        """
+        if self.engine != 'agents':
+            return int(self.stats_data.lang_counts.sum())
+        return self.schedule.get_agent_count()
 
     def get_lang_stats(self, i):
-        """Method to get counts of each type of lang agent
+        """Method to get counts of each type of lang agent.
+        Counts are read in constant time from the running aggregates of self.stats_data
 
         Arguments:
             * i : integer from [0,1,2] hat specifies agent lang type
@@ -215,14 +367,13 @@ class Simple_Language_Model(Model):
             * lang type count as percentage of total
 
         """
-        ag_lang_list = [ag.language for ag in self.schedule.agents]
-        num_ag = len(ag_lang_list)
-        lang_counts = Counter(ag_lang_list)
-        return lang_counts[i]/num_ag
+        lang_counts = self.stats_data.lang_counts
+        return lang_counts[i] / lang_counts.sum()
 
     def get_bilingual_global_evol(self, lang_typology):
         """Method to compute internal linguistic structure of all bilinguals,
-        expressed as average amount of Catalan heard or spoken as % of total
+        expressed as average amount of Catalan heard or spoken as % of total.
+        Average is read in constant time from the running aggregates of self.stats_data
 
          Arguments:
              * lang_typology: string that can take either of two values 'heard' or 'spoken'
@@ -231,64 +382,369 @@ class Simple_Language_Model(Model):
              * float representing the AVERAGE percentage of Catalan in bilinguals
 
         """
-        list_biling = [(ag.lang_freq['cat_pct_h'], ag.lang_freq['cat_pct_s'])
-                       for ag in self.schedule.agents if ag.language == 1]
-        if lang_typology == 'heard':
-            if list_biling:
-                return np.array(list(zip(*list_biling))[0]).mean()
+        num_biling = self.stats_data.lang_counts[1]
+        if num_biling:
+            if lang_typology == 'heard':
+                return self.stats_data.biling_cat_pct_h_sum / num_biling
             else:
-                if self.get_lang_stats(2) > self.get_lang_stats(0):
-                    return 1
-                else:
-                    return 0
+                return self.stats_data.biling_cat_pct_s_sum / num_biling
         else:
-            if list_biling:
-                return np.array(list(zip(*list_biling))[1]).mean()
+            if self.stats_data.lang_counts[2] > self.stats_data.lang_counts[0]:
+                return 1
             else:
-                if self.get_lang_stats(2) > self.get_lang_stats(0):
-                    return 1
+                return 0
+
+    def update_demography(self):
+        """ Method to apply one step of demographic dynamics, with batched draws.
+            Each agent dies with probability death_rate. Each surviving agent migrates
+            with probability migration_rate to a random city, where it gets coords
+            drawn as those of initial agents of the city. Then each survivor has a child
+            with probability birth_rate, as long as population stays below
+            max_people_factor * num_people. Children are born in the cell and city
+            of their parent, with parent's lang type. Rows and ids of dead agents
+            are reused by children. If block_size is set, agents are visited block by block
+            of rows, with the same draws, so that only arrays of dying, migrating
+            and parent agents grow with population
+        """
+        def get_row_blocks():
+            # rows in use when called, so survivors after deaths
+            if self.block_size:
+                return self.ags_data.get_row_blocks()
+            return [self.ags_data.get_rows()]
+
+        def pick_rows(rate):
+            # rows in use that are picked with probability rate, in row order
+            return np.concatenate([rows[self.rng.generator.random(len(rows)) < rate]
+                                   for rows in get_row_blocks()] or [np.zeros(0, dtype=np.int64)])
+
+        if self.death_rate:
+            for rows in get_row_blocks():
+                dies = rows[self.rng.generator.random(len(rows)) < self.death_rate]
+                if self.engine == 'arrays':
+                    self.remove_rows(dies)
                 else:
-                    return 0
+                    self.remove_agents([self.grid.row_agents[row] for row in dies.tolist()])
+        if self.migration_rate:
+            movers = pick_rows(self.migration_rate)
+            cities = self.rng.generator.integers(self.num_cities, size=len(movers))
+            clust_centers = np.asarray(self.clust_centers)
+            xs, ys = self.generate_cluster_points_coords(clust_centers[cities, 0],
+                                                         clust_centers[cities, 1], len(movers))
+            if self.engine == 'arrays':
+                self.grid.move_rows(movers, xs, ys)
+            else:
+                self.grid.move_agents([self.grid.row_agents[row] for row in movers.tolist()], xs, ys)
+            self.ags_data.set_clusters(movers, cities)
+        if self.birth_rate:
+            parents = pick_rows(self.birth_rate)
+            parents = parents[:max(self.max_people_factor * self.num_people - self.get_num_agents(), 0)]
+            children = (self.ags_data.language[parents], self.ags_data.x[parents],
+                        self.ags_data.y[parents], self.ags_data.cluster[parents])
+            if self.engine == 'arrays':
+                self.add_rows(*children)
+            else:
+                self.add_agents(None, *children)
 
     def step(self):
-        self.datacollector.collect(self)
-        self.schedule.step()
+        profiler = self.profiler or NULL_PROFILER
+        profiler.start_step(self.schedule.steps)
+        if self.debug_stats:
+            self.stats_data.check_stats()
+            if self.metrics:
+                self.metrics.check()
+        with profiler.phase('collect'):
+            if not self.schedule.steps % self.collect_freq:
+                self.datacollector.collect(self)
+                self.collected_steps.append(self.schedule.steps)
+                if self.recorder:
+                    self.recorder.record(self)
+                if self.storage_dir:
+                    self.ags_data.sync_mapped(self.schedule.steps)
+            if self.metrics and not self.schedule.steps % self.metrics.collect_freq:
+                self.metrics.collect(self.schedule.steps)
+        with profiler.phase('agents_step'):
+            if self.partitioned_stepper:
+                self.partitioned_stepper.step(self)
+                self.schedule.steps += 1
+                self.schedule.time += 1
+            elif self.activation == 'simultaneous':
+                self.ags_data.simultaneous_step(self)
+                self.schedule.steps += 1
+                self.schedule.time += 1
+            elif self.engine == 'arrays':
+                self.ags_data.step(self)
+                self.schedule.steps += 1
+                self.schedule.time += 1
+            elif self.engine == 'cells':
+                self.cells_data.step(self)
+                self.schedule.steps += 1
+                self.schedule.time += 1
+            else:
+                self.schedule.step()
+        if self.birth_rate or self.death_rate or self.migration_rate:
+            with profiler.phase('demography'):
+                self.update_demography()
+        profiler.end_step()
+
+    def start_profiling(self):
+        """ Method to turn on per-phase timers and event counters of each step.
+            Per-step metrics are available through self.profiler.get_metrics_dataframe()
+            and can be exported with self.profiler.export_trace(filename)
+        """
+        self.profiler = Step_Profiler()
+        self.ags_data.profiler = self.profiler
+
+    def stop_profiling(self):
+        """ Turn off profiling
 
-    def run_model(self, steps, save_frames_freq=0):
-        pbar = pyprind.ProgBar(steps)
+            Returns:
+                * the Step_Profiler with all recorded metrics
+        """
+        profiler = self.profiler
+        self.profiler = None
+        self.ags_data.profiler = None
+        return profiler
+
+    def start_partitioned(self, processes=None):
+        """ Method to run the next steps on worker processes, each one stepping
+            the agents of a vertical strip of the grid over shared-memory agent arrays.
+            Agent state evolves exactly as in a single-process run.
+            Needs simultaneous activation and no demographic dynamics.
+            No agents can be added until stop_partitioned
+
+            Arguments:
+                * processes: number of workers. Defaults to number of cores
+        """
+        if self.activation != 'simultaneous':
+            raise ValueError("partitioned stepping needs activation='simultaneous'")
+        if self.birth_rate or self.death_rate or self.migration_rate:
+            raise ValueError('partitioned stepping needs a population without demographic dynamics')
+        if self.metrics:
+            raise ValueError('partitioned stepping can not update spatial metrics')
+        if self.storage_dir:
+            raise ValueError('partitioned stepping needs agent arrays in memory')
+        from partitioned import Partitioned_Stepper
+
+        self.partitioned_stepper = Partitioned_Stepper(self, processes)
+
+    def stop_partitioned(self):
+        """ Stop worker processes and move agent arrays back to private memory """
+        self.partitioned_stepper.close()
+        self.partitioned_stepper = None
+
+    def start_metrics(self, collect_freq=10, collect_local=False):
+        """ Method to start tracking per-cell and per-cluster language aggregates,
+            updated incrementally on every change of agent state, and to collect
+            spatial segregation indices every collect_freq steps
+            (see spatial_metrics.Spatial_Metrics)
+
+            Arguments:
+                * collect_freq: steps between collections of indices
+                * collect_local: boolean to also collect a raster of local Moran's I
+
+            Returns:
+                * the Spatial_Metrics instance. Collected indices are read with its
+                  get_dataframe, get_cluster_dataframe and get_local_morans_rasters methods
+        """
+        if self.engine == 'cells':
+            raise ValueError("engine 'cells' has no agents to track spatial metrics of")
+        if self.partitioned_stepper:
+            raise ValueError('partitioned stepping can not update spatial metrics')
+        from spatial_metrics import Spatial_Metrics
+
+        self.metrics = Spatial_Metrics(self.ags_data, self.grid, self.num_cities, collect_freq,
+                                       collect_local=collect_local)
+        self.ags_data.metrics = self.metrics
+        return self.metrics
+
+    def stop_metrics(self):
+        """ Stop updating spatial metrics
+
+            Returns:
+                * the Spatial_Metrics instance, with the indices collected so far
+        """
+        metrics = self.metrics
+        self.metrics = None
+        self.ags_data.metrics = None
+        return metrics
+
+    def start_monitor(self, host='127.0.0.1', port=8765, unix_socket=None,
+                      checkpoint_file='model_checkpoint.pkl', min_interval=0.2, raster_size=64):
+        """ Method to start a live monitoring server of next run_model calls.
+            Clients get model reporters and downsampled language rasters as
+            Server-Sent Events from GET /events, and can pause, resume or checkpoint
+            the run with POST /pause, /resume and /checkpoint (see monitoring.Model_Monitor)
+
+            Arguments:
+                * host: local address of the server
+                * port: TCP port (0 for any free port)
+                * unix_socket: optional path of a Unix socket to serve on instead
+                * checkpoint_file: path where checkpoint commands save the model
+                * min_interval: minimum seconds between published steps
+                * raster_size: maximum side of published rasters
+
+            Returns:
+                * the Model_Monitor instance
+        """
+        from monitoring import Model_Monitor
+
+        self.monitor = Model_Monitor(host=host, port=port, unix_socket=unix_socket,
+                                     checkpoint_file=checkpoint_file, min_interval=min_interval,
+                                     raster_size=raster_size)
+        return self.monitor
+
+    def stop_monitor(self):
+        """ Stop the monitoring server and disconnect its clients """
+        try:
+            self.monitor.close()
+        finally:
+            self.monitor = None
+
+    def run_model(self, steps, save_frames_freq=0, progress_bar=True,
+                  checkpoint_freq=0, checkpoint_file='model_checkpoint.pkl', collect_freq=None,
+                  convergence_window=0, convergence_tol=1e-5,
+                  convergence_vars=('count_spa', 'count_bil', 'count_cat'), stop_if_absorbed=False):
+        """ Method to run the model for a number of steps, or until it converges
+
+            Arguments:
+                * steps: maximum number of steps
+                * save_frames_freq: steps between saved figures (0 for none)
+                * progress_bar: boolean
+                * checkpoint_freq: steps between checkpoints (0 for none)
+                * checkpoint_file: path of checkpoint file
+                * collect_freq: optional number of steps between collections of model
+                  reporters. It replaces the collect_freq of the model
+                * convergence_window: if not 0, the run stops when the variance of each of
+                  convergence_vars over the last convergence_window collections is below
+                  convergence_tol. Only collections made after agents can switch language
+                  (see Lang_Agents_Arrays.lang_switch_start) count
+                * convergence_tol: variance tolerance of convergence
+                * convergence_vars: names of model reporters checked for convergence
+                * stop_if_absorbed: if True, the run stops when all agents speak the same
+                  monolingual language, a state that can not be left
+
+            Returns:
+                * dict with 'stop_reason' ('converged', 'absorbed' or 'max_steps'),
+                  'stop_step' (model step at which the run stopped) and 'steps_run'.
+                  It is also stored as self.run_report
+        """
+        if collect_freq is not None:
+            self.collect_freq = collect_freq
+        if progress_bar:
+            import pyprind
+            pbar = pyprind.ProgBar(steps)
+        # values of convergence_vars at last collections
+        window = deque(maxlen=convergence_window or None)
+        reporters = [self.datacollector.model_reporters[name] for name in convergence_vars]
+        stop_reason = 'max_steps'
+        steps_run = 0
         for _ in range(steps):
+            collecting = (convergence_window and not self.schedule.steps % self.collect_freq and
+                          self.schedule.steps > Lang_Agents_Arrays.lang_switch_start)
+            if collecting:
+                # same values as those collected by this step
+                window.append([reporter(self) for reporter in reporters])
             self.step()
+            steps_run += 1
             if save_frames_freq:
                 if not self.schedule.steps%save_frames_freq:
                     self.show_results(step=self.schedule.steps, plot_results=False, save_fig=True)
-            pbar.update()
+            if checkpoint_freq:
+                if not self.schedule.steps % checkpoint_freq:
+                    self.save_checkpoint(checkpoint_file)
+            if progress_bar:
+                pbar.update()
+            if self.monitor:
+                self.monitor.after_step(self)
+            if stop_if_absorbed and self.is_absorbed():
+                stop_reason = 'absorbed'
+                break
+            if (collecting and len(window) == convergence_window and
+                    np.all(np.var(np.array(window), axis=0) < convergence_tol)):
+                stop_reason = 'converged'
+                break
+        self.run_report = {'stop_reason': stop_reason, 'stop_step': self.schedule.steps,
+                           'steps_run': steps_run}
+        if self.monitor:
+            self.monitor.publish(self, force=True)
+        return self.run_report
+
+    def is_absorbed(self):
+        """ Returns:
+                * True if all agents are monolingual in the same language
+        """
+        lang_counts = self.stats_data.lang_counts
+        num_agents = lang_counts.sum()
+        return bool(num_agents) and (lang_counts[0] == num_agents or lang_counts[2] == num_agents)
+
+    def get_model_vars_dataframe(self):
+        """ Returns:
+                * pandas DataFrame with collected model reporters, indexed by the step
+                  at which they were collected
+        """
+        data = self.datacollector.get_model_vars_dataframe()
+        data.index = pd.Index(self.collected_steps, name='step')
+        return data
+
+    def get_grid_raster(self, ag_attr='language', block_size=1):
+        """ Method to compute the mean value of an agent attribute in each grid cell
+
+            Arguments:
+                * ag_attr: agent attribute. Columns of the agent arrays are aggregated
+                  with np.bincount, other attributes are read from each agent.
+                  Engine 'cells' only has 'language', 'cat_pct_h' and 'cat_pct_s'
+                * block_size: side of square blocks of cells averaged together,
+                  to get a downsampled raster
+
+            Returns:
+                * 2D numpy array of shape (ceil(grid_height / block_size),
+                  ceil(grid_width / block_size)), indexed [y, x], with nan in empty cells
+        """
+        n = self.ags_data.num_rows
+        # number of agents behind each value (None: one)
+        weights = None
+        if self.engine == 'cells':
+            xs, ys = np.divmod(self.cells_data.cell, self.grid_height)
+            values, weights = self.cells_data.get_sums(ag_attr), self.cells_data.count
+        elif ag_attr in self.ags_data.columns:
+            placed = self.ags_data.x[:n] >= 0
+            xs, ys = self.ags_data.x[:n][placed], self.ags_data.y[:n][placed]
+            values = getattr(self.ags_data, ag_attr)[:n][placed]
+        else:
+            agents = [ag for ag in self.schedule.agents if ag.pos is not None]
+            xs = np.array([ag.pos[0] for ag in agents], dtype=np.int64)
+            ys = np.array([ag.pos[1] for ag in agents], dtype=np.int64)
+            values = np.array([getattr(ag, ag_attr) for ag in agents], dtype=np.float64)
+        width, height = ceil(self.grid_width / block_size), ceil(self.grid_height / block_size)
+        cells = xs // block_size * height + ys // block_size
+        sums = np.bincount(cells, weights=values, minlength=width * height)
+        counts = np.bincount(cells, weights=weights, minlength=width * height)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means = sums / counts
+        return means.reshape(width, height).T
 
     def create_agents_attrs_data(self, ag_attr, plot=False):
-        ag_and_coords = [(getattr(ag, ag_attr), ag.pos[0], ag.pos[1])
-                         for ag in self.schedule.agents]
-        ag_and_coords = np.array(ag_and_coords)
-        df_attrs = pd.DataFrame({'values': ag_and_coords[:, 0],
-                                 'x': ag_and_coords[:, 1],
-                                 'y': ag_and_coords[:, 2]})
-        self.df_attrs_avg = df_attrs.groupby(['x', 'y']).mean()
+        raster = self.get_grid_raster(ag_attr)
+        ys, xs = np.nonzero(~np.isnan(raster))
+        df_attrs = pd.DataFrame({'values': raster[ys, xs], 'x': xs, 'y': ys})
+        self.df_attrs_avg = df_attrs.set_index(['x', 'y']).sort_index()
 
         if plot:
-            s = plt.scatter(self.df_attrs_avg.reset_index()['x'],
-                            self.df_attrs_avg.reset_index()['y'],
-                            c=self.df_attrs_avg.reset_index()['values'],
+            import matplotlib.pylab as plt
+            s = plt.scatter(xs, ys, c=raster[ys, xs],
                             vmin=0, vmax=2, s=30,
                             cmap='viridis')
             plt.colorbar(s)
             plt.show()
 
-
     def show_results(self, ag_attr='language', step=None,
                      plot_results=True, plot_type='imshow', save_fig=False):
+        import matplotlib.pylab as plt
 
         grid_size = (3, 5)
         self.create_agents_attrs_data(ag_attr)
 
-        data_2_plot = self.datacollector.get_model_vars_dataframe()[:step]
+        data_2_plot = self.get_model_vars_dataframe().loc[:step]
         data_2D = self.df_attrs_avg.reset_index()
 
         ax1 = plt.subplot2grid(grid_size, (0, 3), rowspan=1, colspan=2)
@@ -319,105 +775,249 @@ class Simple_Language_Model(Model):
             plt.show()
 
     def run_and_animate(self, steps, plot_type='imshow'):
+        import matplotlib.pylab as plt
+        import matplotlib.animation as animation
+        from rendering import Results_Frame
+
         fig = plt.figure()
-        grid_size = (3, 5)
-        ax1 = plt.subplot2grid(grid_size, (0, 3), rowspan=1, colspan=2)
-        ax1.set_xlim(0, steps)
-        ax1.set_ylim(0, 1)
-        ax1.xaxis.tick_bottom()
-        line10, = ax1.plot([], [], lw=2, label='count_spa')
-        line11, = ax1.plot([], [], lw=2, label='count_bil')
-        line12, = ax1.plot([], [], lw=2, label='count_cat')
-        ax1.legend(loc='best', prop={'size': 8})
-        ax1.set_title("lang_groups")
-        ax2 = plt.subplot2grid(grid_size, (1, 3), rowspan=1, colspan=2)
-        ax2.set_xlim(0, steps)
-        ax2.set_ylim(0, self.max_people_factor * self.num_people)
-        line2, = ax2.plot([], [], lw=2, label = "total_num_agents")
-        ax2.legend(loc='best', prop={'size': 8})
-        ax2.set_title("num_agents")
-        ax3 = plt.subplot2grid(grid_size, (2, 3), rowspan=1, colspan=2)
-        ax3.set_xlim(0, steps)
-        ax3.set_ylim(0, 1)
-        line30, = ax3.plot([], [], lw=2, label='biling_evol_h')
-        line31, = ax3.plot([], [], lw=2, label='biling_evol_s')
-        ax3.legend(loc='best', prop={'size': 8})
-        ax3.set_title("biling_quality")
-        ax4 = plt.subplot2grid(grid_size, (0, 0), rowspan=3, colspan=3)
-        ax4.set_xlim(0, self.grid_width-1)
-        ax4.set_ylim(0, self.grid_height-1)
-        if plot_type == 'imshow':
-            im_2D = ax4.imshow(np.zeros((self.grid_width, self.grid_height)),
-                               vmin=0, vmax=2, cmap='viridis',
-                               interpolation='nearest', origin='lower')
-            fig.colorbar(im_2D)
-        elif plot_type == 'scatter':
-            dots = ax4.scatter([], [], c=[], vmin=0, vmax=2, cmap='viridis')
-            fig.colorbar(dots)
-        time_text = ax4.text(0.02, 0.95, '', transform=ax4.transAxes)
-
-        def init_show():
-            if plot_type == 'imshow':
-                im_2D.set_array(np.random.choice([np.nan, 0], p=[1, 0], size=(self.grid_width, self.grid_height)))
-                return im_2D,
-            elif plot_type == 'scatter':
-                dots.set_offsets([0,0])
-                return dots,
+        frame = Results_Frame(fig, self, steps, plot_type=plot_type)
 
         def run_and_update(i):
-            #run model step
             self.step()
+            return frame.update()
 
-            #create plots and data for 1D plots
-            data = self.datacollector.get_model_vars_dataframe()
-            line10.set_data(data.index, data['count_spa'])
-            line11.set_data(data.index, data['count_bil'])
-            line12.set_data(data.index, data['count_cat'])
-
-            line2.set_data(data.index, data['total_num_agents'])
-
-            line30.set_data(data.index, data['biling_evol_h'])
-            line31.set_data(data.index, data['biling_evol_s'])
-            # generate data for 2D representation
-            self.create_agents_attrs_data('language')
-            # create 2D plot
-            time_text.set_text('time = %.1f' % i)
-            if plot_type == 'imshow':
-                im_2D.set_array(self.df_attrs_avg.unstack('x'))
-                return line10, line11, line12, line2, line30, line31, im_2D, time_text
-            else:
-                data = np.hstack((self.df_attrs_avg.reset_index()['x'][:, np.newaxis],
-                                  self.df_attrs_avg.reset_index()['y'][:, np.newaxis]))
-                dots.set_offsets(data)
-                dots.set_array(self.df_attrs_avg.reset_index()['values'])
-                return line10, line11, line12, line2, line30, line31, dots, time_text
-
-        # generate persistent animation object
-        ani = animation.FuncAnimation(fig, run_and_update,init_func=init_show,
+        # generate persistent animation object. init_func draws the initial state,
+        # otherwise FuncAnimation calls run_and_update once more to init the blit
+        ani = animation.FuncAnimation(fig, run_and_update, init_func=frame.draw_grid,
                                       frames=steps, interval=100, blit=True, repeat=False)
         plt.tight_layout()
         plt.show()
 
-    def save_model_data(self):
-        self.model_data = {'initial_conditions':{'cluster_sizes': self.cluster_sizes,
-                                                 'cluster_centers': self.clust_centers,
-                                                 'init_num_people': self.num_people,
-                                                 'grid_width': self.grid_width,
-                                                 'grid_height': self.grid_height,
-                                                 'init_lang_distrib': self.init_lang_distrib,
-                                                 'num_cities': self.num_cities,
-                                                 'sort_by_dist': self.lang_ags_sorted_by_dist,
-                                                 'sort_within_clust': self.lang_ags_sorted_in_clust},
-                           'model_results': self.datacollector.get_model_vars_dataframe()}
-        dd.io.save('model_data.h5', self.model_data)
+    def run_and_render(self, steps, output='frames', plot_type='imshow', render_freq=1, fps=10):
+        """ Method to run the model and render results without a display.
+            Frames are written by a background thread while the model keeps running
 
-    def load_model_data(self, data_filename, key='/' ):
-        return dd.io.load(data_filename,key)
+            Arguments:
+                * steps: number of model steps
+                * output: path of video file (e.g. 'run.mp4', needs ffmpeg)
+                  or directory where a PNG sequence is written
+                * plot_type: 'imshow' or 'scatter'
+                * render_freq: steps between rendered frames
+                * fps: frames per second of video
 
+            Returns:
+                * number of frames written
+        """
+        from rendering import render_run
+
+        return render_run(self, steps, output, plot_type=plot_type,
+                          render_freq=render_freq, fps=fps)
+
+    def get_initial_conditions(self):
+        return {'cluster_sizes': self.cluster_sizes,
+                'cluster_centers': self.clust_centers,
+                'init_num_people': self.num_people,
+                'grid_width': self.grid_width,
+                'grid_height': self.grid_height,
+                'init_lang_distrib': self.init_lang_distrib,
+                'num_cities': self.num_cities,
+                'sort_by_dist': self.lang_ags_sorted_by_dist,
+                'sort_within_clust': self.lang_ags_sorted_in_clust}
+
+    def start_recording(self, data_filename, chunk_steps=100, agent_attrs=None, agents_freq=None):
+        """ Method to stream collected data to an HDF5 file while the model runs.
+            Model reporters are written every chunk_steps steps and then dropped from
+            the DataCollector, which only keeps the steps not yet written to disk
+
+            Arguments:
+                * data_filename: path of HDF5 file
+                * chunk_steps: number of steps between writes to disk
+                * agent_attrs: optional list of agent attributes to snapshot,
+                  from ['language', 'x', 'y', 'cat_pct_s', 'cat_pct_h']
+                * agents_freq: steps between agent snapshots. Defaults to chunk_steps
+        """
+        from data_recorder import Model_Data_Recorder
+
+        self.recorder = Model_Data_Recorder(data_filename, self, chunk_steps=chunk_steps,
+                                            agent_attrs=agent_attrs, agents_freq=agents_freq)
 
+    def stop_recording(self):
+        self.recorder.close(self)
+        self.recorder = None
 
+    def save_model_data(self):
+        """ Method to save initial conditions and collected data. If the model is
+            being recorded, pending data is written and the recording file is closed.
+            Otherwise, all data is saved to 'model_data.h5' at once
+        """
+        if self.recorder:
+            self.stop_recording()
+            return
+        self.model_data = {'initial_conditions': self.get_initial_conditions(),
+                           'model_results': self.get_model_vars_dataframe()}
+        import deepdish as dd
+        dd.io.save('model_data.h5', self.model_data)
 
+    def load_model_data(self, data_filename, key='/', steps=None):
+        """ Method to load saved data
 
+            Arguments:
+                * data_filename: path of HDF5 file
+                * key: node to load
+                * steps: optional (start, stop) tuple to lazily read a step range from a file
+                  written by start_recording. Then key must be 'model_results'
+                  or a recorded agent attribute
 
+        """
+        if steps is not None:
+            from data_recorder import load_recorded_data
+            return load_recorded_data(data_filename, key, steps)
+        import deepdish as dd
+        return dd.io.load(data_filename,key)
 
-        
\ No newline at end of file
+    def save_checkpoint(self, filename):
+        """ Method to write a binary checkpoint with the full model state: parameters,
+            agent arrays, grid occupancy, networks, random states, schedule and collected series.
+            File is replaced atomically, so that a crash while writing
+            does not corrupt the previous checkpoint. Recording is not part of the checkpoint.
+            Agent columns stored on disk (storage_dir) are not pickled: they are copied,
+            block by block, to .npy files of a new directory next to the checkpoint file,
+            named <filename>.<random>.columns, and columns of previous checkpoints
+            of the same file are removed once the file is replaced
+
+            Arguments:
+                * filename: path of checkpoint file
+        """
+        agents = list(self.schedule._agents.values())
+        columns_dir = None
+        if self.storage_dir:
+            columns_dir = tempfile.mkdtemp(prefix=os.path.basename(filename) + '.', suffix='.columns',
+                                           dir=os.path.dirname(os.path.abspath(filename)))
+            self.ags_data.write_columns(columns_dir)
+        state = {'params': {'num_people': self.num_people, 'width': self.grid_width,
+                            'height': self.grid_height, 'max_people_factor': self.max_people_factor,
+                            'init_lang_distrib': self.init_lang_distrib, 'num_cities': self.num_cities,
+                            'lang_ags_sorted_by_dist': self.lang_ags_sorted_by_dist,
+                            'lang_ags_sorted_in_clust': self.lang_ags_sorted_in_clust,
+                            'engine': self.engine, 'activation': self.activation,
+                            'collect_freq': self.collect_freq, 'birth_rate': self.birth_rate,
+                            'death_rate': self.death_rate, 'migration_rate': self.migration_rate,
+                            'storage_dir': self.storage_dir, 'block_size': self.block_size,
+                            'debug_stats': self.debug_stats,
+                            'seed': self.seed},
+                 'clust_centers': self.clust_centers,
+                 'cluster_sizes': self.cluster_sizes,
+                 'steps': self.schedule.steps,
+                 'time': self.schedule.time,
+                 # agents in schedule order, as (unique_id, row, S) arrays
+                 'agents': (np.array([ag.unique_id for ag in agents]),
+                            np.array([ag.row for ag in agents]),
+                            np.array([ag.S for ag in agents])),
+                 'ags_data': self.ags_data.get_state(with_columns=columns_dir is None),
+                 # directory of agent columns, relative to the checkpoint file
+                 'columns_dir': columns_dir and os.path.basename(columns_dir),
+                 'cells_data': self.cells_data.get_state() if self.engine == 'cells' else None,
+                 'grid': self.grid.get_state(),
+                 'networks': {name: getattr(self, name).get_state()
+                              for name in ['known_people_network', 'friendship_network',
+                                           'family_network']},
+                 'rng': self.rng.get_state(),
+                 'stream_key': self.stream_key,
+                 'schedule_rng': self.random.getstate(),
+                 'model_vars': self.datacollector.model_vars,
+                 'collected_steps': self.collected_steps,
+                 'metrics': self.metrics.get_state() if self.metrics else None}
+        tmp_filename = filename + '.tmp'
+        with open(tmp_filename, 'wb') as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_filename, filename)
+        for old_dir in glob.glob(glob.escape(os.path.abspath(filename)) + '.*.columns'):
+            if old_dir != columns_dir:
+                shutil.rmtree(old_dir, ignore_errors=True)
+
+    @classmethod
+    def load_checkpoint(cls, filename, storage_dir=None):
+        """ Method to restore a model from a checkpoint written by save_checkpoint.
+            The restored model continues bit-identically to the original run
+
+            Arguments:
+                * filename: path of checkpoint file
+                * storage_dir: directory of agent columns, if the checkpointed model
+                  stored them on disk. Defaults to the directory of the checkpointed model
+
+            Returns:
+                * Simple_Language_Model instance
+        """
+        with open(filename, 'rb') as f:
+            state = pickle.load(f)
+        params = state['params']
+        model = cls.__new__(cls)
+        model.num_people = params['num_people']
+        model.grid_width = params['width']
+        model.grid_height = params['height']
+        model.max_people_factor = params['max_people_factor']
+        model.init_lang_distrib = params['init_lang_distrib']
+        model.num_cities = params['num_cities']
+        model.lang_ags_sorted_by_dist = params['lang_ags_sorted_by_dist']
+        model.lang_ags_sorted_in_clust = params['lang_ags_sorted_in_clust']
+        model.engine = params['engine']
+        model.activation = params['activation']
+        model.collect_freq = params['collect_freq']
+        model.birth_rate = params.get('birth_rate', 0.)
+        model.death_rate = params.get('death_rate', 0.)
+        model.migration_rate = params.get('migration_rate', 0.)
+        model.storage_dir = params.get('storage_dir') and (storage_dir or params['storage_dir'])
+        model.block_size = params.get('block_size')
+        model.debug_stats = params['debug_stats']
+        model.seed = params['seed']
+        model.clust_centers = state['clust_centers']
+        model.cluster_sizes = state['cluster_sizes']
+
+        model.rng = Buffered_RNG()
+        model.rng.set_state(state['rng'])
+        model.stream_key = state['stream_key']
+        model.random.setstate(state['schedule_rng'])
+        capacity = max(state['ags_data']['num_rows'], model.get_pool_size())
+        if model.storage_dir:
+            model.ags_data = Lang_Agents_Arrays(0, model.rng)
+            model.ags_data.map_to_disk(model.storage_dir, capacity)
+        else:
+            model.ags_data = Lang_Agents_Arrays(capacity, model.rng)
+        model.ags_data.block_size = model.block_size
+        columns_dir = state.get('columns_dir')
+        if columns_dir:
+            columns_dir = os.path.join(os.path.dirname(os.path.abspath(filename)), columns_dir)
+        model.ags_data.set_state(state['ags_data'], columns_dir)
+        model.grid = Cell_Index_Grid(model.grid_width, model.grid_height, model.ags_data, model.rng)
+        model.cells_data = None
+        if model.engine == 'cells':
+            model.cells_data = Lang_Cells_Arrays(model.grid, model.rng)
+            model.cells_data.set_state(state['cells_data'])
+        model.schedule = RandomActivation(model)
+        model.schedule.steps = state['steps']
+        model.schedule.time = state['time']
+        model.create_networks()
+        for name, network_state in state['networks'].items():
+            getattr(model, name).set_state(network_state)
+        agents = []
+        for unique_id, row, S in zip(*state['agents']):
+            ag = Simple_Language_Agent(model, int(unique_id), None, S, row=int(row))
+            model.schedule.add(ag)
+            agents.append(ag)
+        model.grid.set_state(state['grid'], agents)
+        if model.engine == 'arrays':
+            # agents without agent objects are placed from agent arrays
+            model.grid.invalidate()
+
+        model.recorder = None
+        model.profiler = None
+        model.partitioned_stepper = None
+        model.monitor = None
+        model.create_datacollector()
+        model.datacollector.model_vars.update(state['model_vars'])
+        model.collected_steps = state['collected_steps']
+        model.run_report = None
+        model.metrics = None
+        if state.get('metrics'):
+            model.start_metrics().set_state(state['metrics'])
+        return model
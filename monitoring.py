@@ -0,0 +1,223 @@
+# IMPORT LIBS
+import os
+import json
+import queue
+import asyncio
+import threading
+import concurrent.futures
+from math import ceil
+from time import perf_counter
+import numpy as np
+
+LOCAL_HOSTS = ['127.0.0.1', 'localhost', '::1']
+STATUS_REASONS = {200: 'OK', 404: 'Not Found', 405: 'Method Not Allowed',
+                  500: 'Internal Server Error', 504: 'Gateway Timeout'}
+# seconds given to clients to read queued frames when the monitor is closed
+CLOSE_TIMEOUT = 1.
+
+
+class Model_Monitor:
+    """ Live monitoring service of a running Simple_Language_Model. An asyncio HTTP server
+        runs in a background thread, bound to localhost or to a Unix socket, with endpoints:
+            * GET /events: Server-Sent Events stream of 'step' events with current
+              model reporters and a downsampled raster of mean agent language per cell
+            * GET /state: latest published step as JSON
+            * POST /pause, POST /resume: pause and resume the run
+            * POST /checkpoint: save a checkpoint of the model and reply with its path
+
+        The simulation publishes after each step by calling after_step. Publishing is
+        rate-limited and never waits for clients: each client has a bounded queue, and
+        when it is full the oldest frame is dropped
+    """
+
+    def __init__(self, host='127.0.0.1', port=8765, unix_socket=None,
+                 checkpoint_file='model_checkpoint.pkl', min_interval=0.2,
+                 max_queued=8, raster_size=64):
+        """ Arguments:
+                * host: local address the server binds to. Ignored if unix_socket is given
+                * port: TCP port. Use 0 to pick a free port (see self.port)
+                * unix_socket: optional path of a Unix socket to bind to instead
+                * checkpoint_file: path where checkpoint commands save the model
+                * min_interval: minimum seconds between published frames
+                * max_queued: maximum number of frames waiting to be sent to each client
+                * raster_size: maximum side of published rasters, in blocks of cells
+        """
+        if unix_socket is None and host not in LOCAL_HOSTS:
+            raise ValueError('monitor can only bind to {} or a Unix socket'.format(LOCAL_HOSTS))
+        self.unix_socket = unix_socket
+        self.checkpoint_file = checkpoint_file
+        self.min_interval = min_interval
+        self.max_queued = max_queued
+        self.raster_size = raster_size
+        self.last_publish = None
+        self.latest = None
+        # queue of frames of each client, mapped to the task and writer streaming them
+        self.clients = {}
+        self.resumed = threading.Event()
+        self.resumed.set()
+        # checkpoint commands, as futures resolved by the simulation thread
+        self.checkpoint_requests = queue.SimpleQueue()
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.server = asyncio.run_coroutine_threadsafe(self._start_server(host, port), self.loop).result()
+        self.port = None if unix_socket else self.server.sockets[0].getsockname()[1]
+
+    async def _start_server(self, host, port):
+        if self.unix_socket:
+            return await asyncio.start_unix_server(self._handle, self.unix_socket)
+        return await asyncio.start_server(self._handle, host, port)
+
+    # SIMULATION THREAD
+
+    def after_step(self, model):
+        """ Method to be called by the simulation loop after each step. It publishes
+            a frame if min_interval has elapsed, serves checkpoint commands
+            and blocks while the run is paused
+        """
+        self.publish(model)
+        while True:
+            self._serve_checkpoints(model)
+            if self.resumed.wait(timeout=0.1):
+                break
+
+    def publish(self, model, force=False):
+        """ Send current state of the model to all clients, unless the last frame
+            was published less than min_interval seconds ago and force is False
+        """
+        now = perf_counter()
+        if not force and self.last_publish is not None and now - self.last_publish < self.min_interval:
+            return
+        self.last_publish = now
+        block_size = max(ceil(max(model.grid_width, model.grid_height) / self.raster_size), 1)
+        frame = {'step': model.schedule.steps,
+                 'reporters': {name: reporter(model) for name, reporter
+                               in model.datacollector.model_reporters.items()},
+                 'block_size': block_size,
+                 'raster': model.get_grid_raster('language', block_size=block_size)}
+        self.loop.call_soon_threadsafe(self._broadcast, frame)
+
+    def _serve_checkpoints(self, model):
+        while not self.checkpoint_requests.empty():
+            future = self.checkpoint_requests.get()
+            try:
+                model.save_checkpoint(self.checkpoint_file)
+                future.set_result(self.checkpoint_file)
+            except Exception as error:
+                future.set_exception(error)
+
+    def close(self):
+        """ Stop the server and disconnect all clients. Clients get the frames already
+            queued for them, unless they do not read them within CLOSE_TIMEOUT seconds
+        """
+        async def stop_server():
+            self.server.close()
+            for client in self.clients:
+                if client.full():
+                    # drop oldest frame to make room for the end of stream
+                    client.get_nowait()
+                client.put_nowait(None)
+            streams = dict(self.clients.values())
+            if streams:
+                # clients that stopped reading stay blocked in writer.drain
+                _, blocked = await asyncio.wait(streams, timeout=CLOSE_TIMEOUT)
+                for stream in blocked:
+                    streams[stream].transport.abort()
+                if blocked:
+                    await asyncio.wait(blocked)
+            await self.server.wait_closed()
+        try:
+            asyncio.run_coroutine_threadsafe(stop_server(), self.loop).result()
+        finally:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+            self.loop.close()
+            self.resumed.set()
+            if self.unix_socket and os.path.exists(self.unix_socket):
+                os.remove(self.unix_socket)
+
+    # SERVER THREAD
+
+    def _broadcast(self, frame):
+        raster = np.round(frame['raster'], 3)
+        frame = dict(frame, paused=not self.resumed.is_set(),
+                     reporters={name: float(value) for name, value in frame['reporters'].items()},
+                     raster=[[None if np.isnan(value) else value for value in row]
+                             for row in raster.tolist()])
+        self.latest = frame
+        message = 'event: step\ndata: {}\n\n'.format(json.dumps(frame)).encode()
+        for client in self.clients:
+            if client.full():
+                # drop stale frame
+                client.get_nowait()
+            client.put_nowait(message)
+
+    async def _handle(self, reader, writer):
+        try:
+            request_line = await reader.readline()
+            method, target = request_line.decode('latin-1').split()[:2]
+            # headers and body are not used
+            while (await reader.readline()).strip():
+                pass
+            path = target.split('?')[0]
+            routes = {'/events': ('GET', self._stream), '/state': ('GET', self._state),
+                      '/pause': ('POST', self._pause), '/resume': ('POST', self._resume),
+                      '/checkpoint': ('POST', self._checkpoint)}
+            if path not in routes:
+                await self._respond(writer, 404, {'error': 'unknown path'})
+            elif routes[path][0] != method:
+                await self._respond(writer, 405, {'error': 'use ' + routes[path][0]})
+            else:
+                await routes[path][1](writer)
+        except (ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def _respond(self, writer, status, body):
+        body = json.dumps(body).encode()
+        writer.write('HTTP/1.1 {} {}\r\nContent-Type: application/json\r\nContent-Length: {}\r\n'
+                     'Connection: close\r\n\r\n'.format(status, STATUS_REASONS[status], len(body)).encode())
+        writer.write(body)
+        await writer.drain()
+
+    async def _stream(self, writer):
+        writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\n'
+                     b'Cache-Control: no-cache\r\nConnection: keep-alive\r\n\r\n')
+        await writer.drain()
+        client = asyncio.Queue(maxsize=self.max_queued)
+        self.clients[client] = (asyncio.current_task(), writer)
+        try:
+            while True:
+                message = await client.get()
+                if message is None:
+                    break
+                writer.write(message)
+                await writer.drain()
+        finally:
+            self.clients.pop(client, None)
+
+    async def _state(self, writer):
+        await self._respond(writer, 200, self.latest or {})
+
+    async def _pause(self, writer):
+        self.resumed.clear()
+        await self._respond(writer, 200, {'paused': True})
+
+    async def _resume(self, writer):
+        self.resumed.set()
+        await self._respond(writer, 200, {'paused': False})
+
+    async def _checkpoint(self, writer):
+        future = concurrent.futures.Future()
+        self.checkpoint_requests.put(future)
+        try:
+            # saved by the simulation thread at the end of the current step
+            filename = await asyncio.wait_for(asyncio.wrap_future(future), timeout=60)
+        except asyncio.TimeoutError:
+            await self._respond(writer, 504, {'error': 'checkpoint not saved within 60 s'})
+        except Exception as error:
+            # raised by save_checkpoint in the simulation thread
+            await self._respond(writer, 500, {'error': str(error)})
+        else:
+            await self._respond(writer, 200, {'checkpoint': filename})
@@ -0,0 +1,135 @@
+# IMPORT LIBS
+import multiprocessing
+import numpy as np
+
+from agent_arrays import Lang_Agents_Arrays
+from grid_index import Cell_Index_Grid
+from random_streams import keyed_uniforms
+from shared_arrays import to_shared_array, attach_shared_array
+
+
+def get_tiles(xs, width, num_tiles):
+    """ Tiles are vertical strips of grid columns of (almost) equal width
+
+        Returns:
+            * array with tile index of each x coordinate
+    """
+    return xs * num_tiles // width
+
+
+def _tile_worker(conn, tile, num_tiles, ags_specs, num_rows, table_specs, width, height,
+                 stream_key, rows):
+    """ Main loop of the worker process that steps the agents of one tile.
+        Agent arrays and the Moore table are attached from shared memory. Agents
+        only move to neighbouring cells, so migrants only go to adjacent tiles
+
+        Messages received through conn:
+            * ('move', step): move agents of the tile. Replies with a list of arrays,
+              the rows of agents that left to each tile
+            * ('converse', step, migrants): add agents arrived from other tiles,
+              then match co-located agents, run conversations and update language status.
+              Replies with the changes of the running aggregates
+            * ('stop',): close shared memory and exit
+    """
+    ags_data = Lang_Agents_Arrays.attach_memory(ags_specs, num_rows)
+    table_blocks, moore_table = zip(*[attach_shared_array(spec) for spec in table_specs])
+    grid = Cell_Index_Grid(width, height, ags_data, None, moore_table=moore_table)
+    keyed_streams = Lang_Agents_Arrays.keyed_streams
+    try:
+        while True:
+            message = conn.recv()
+            if message[0] == 'move':
+                step = message[1]
+                grid.random_moves(rows, keyed_uniforms(stream_key, step, keyed_streams['move'], rows))
+                tiles = get_tiles(ags_data.x[rows], width, num_tiles)
+                conn.send([rows[tiles == other] for other in range(num_tiles)])
+                rows = rows[tiles == tile]
+            elif message[0] == 'converse':
+                step, migrants = message[1:]
+                rows = np.sort(np.concatenate([rows] + migrants))
+                ags_data.lang_counts[:] = 0
+                ags_data.biling_cat_pct_h_sum = ags_data.biling_cat_pct_s_sum = 0.
+                firsts, seconds = grid.cell_matching(
+                    rows, keyed_uniforms(stream_key, step, keyed_streams['match'], rows))
+                speakers = ags_data.converse_matched(firsts, seconds, stream_key, step)
+                ags_data.update_lang_status(speakers, step)
+                conn.send((ags_data.lang_counts.copy(), ags_data.biling_cat_pct_h_sum,
+                           ags_data.biling_cat_pct_s_sum))
+            else:
+                break
+    finally:
+        # drop array views before closing their blocks
+        blocks = ags_data.shared_blocks + list(table_blocks)
+        del ags_data, grid, moore_table
+        for block in blocks:
+            block.close()
+        conn.close()
+
+
+class Partitioned_Stepper:
+    """ Runs simultaneous steps of a model on worker processes, one per tile of the grid.
+        Agent columns and the Moore table are moved to shared memory and each worker
+        moves, matches and updates in place the agents of its own tile. After the moves,
+        agents that crossed a tile border are sent to the worker of their new tile.
+        Since matching and all random draws of simultaneous steps only depend on cells
+        and rows, agent state evolves exactly as in a single-process simultaneous run.
+        Running aggregates are the sum of the changes made by the workers,
+        so they only differ from a single-process run by floating point rounding
+    """
+
+    def __init__(self, model, processes=None):
+        """ Arguments:
+                * model: Simple_Language_Model with simultaneous activation
+                * processes: number of workers (tiles). Defaults to number of cores,
+                  at most one per grid column
+        """
+        self.ags_data = model.ags_data
+        self.num_tiles = min(processes or multiprocessing.cpu_count(), model.grid_width)
+        ags_specs = self.ags_data.share_memory()
+        self.table_blocks, table_specs = [], []
+        for array in (model.grid.neighbors, model.grid.num_neighbors):
+            block, _, spec = to_shared_array(array)
+            self.table_blocks.append(block)
+            table_specs.append(spec)
+        num_rows = self.ags_data.num_rows
+        rows = np.flatnonzero(self.ags_data.x[:num_rows] >= 0)
+        tiles = get_tiles(self.ags_data.x[rows], model.grid_width, self.num_tiles)
+        self.conns, self.workers = [], []
+        for tile in range(self.num_tiles):
+            conn, worker_conn = multiprocessing.Pipe()
+            worker = multiprocessing.Process(
+                target=_tile_worker, daemon=True,
+                args=(worker_conn, tile, self.num_tiles, ags_specs, num_rows, table_specs,
+                      model.grid_width, model.grid_height, model.stream_key, rows[tiles == tile]))
+            worker.start()
+            self.conns.append(conn)
+            self.workers.append(worker)
+
+    def step(self, model):
+        """ Advance all agents one simultaneous step """
+        step = model.schedule.steps
+        for conn in self.conns:
+            conn.send(('move', step))
+        # migrants[i][j]: rows of agents that moved from tile i to tile j
+        migrants = [conn.recv() for conn in self.conns]
+        for tile, conn in enumerate(self.conns):
+            conn.send(('converse', step, [migrants[other][tile] for other in range(self.num_tiles)
+                                          if other != tile]))
+        for lang_counts, cat_pct_h_sum, cat_pct_s_sum in [conn.recv() for conn in self.conns]:
+            self.ags_data.lang_counts += lang_counts
+            self.ags_data.biling_cat_pct_h_sum += cat_pct_h_sum
+            self.ags_data.biling_cat_pct_s_sum += cat_pct_s_sum
+        model.grid.invalidate()
+
+    def close(self):
+        """ Stop workers and move agent arrays back to private memory """
+        for conn in self.conns:
+            conn.send(('stop',))
+        for worker in self.workers:
+            worker.join()
+        for conn in self.conns:
+            conn.close()
+        for block in self.table_blocks:
+            block.close()
+            block.unlink()
+        self.ags_data.release_memory()
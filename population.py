@@ -0,0 +1,181 @@
+# IMPORT LIBS
+import numpy as np
+
+# Functions to draw initial agent populations, shared by Simple_Language_Model
+# and Language_Model_Ensemble. All draws come from the given Buffered_RNG, in a fixed
+# order, so that a model and a replicate with the same seed get the same population
+
+
+def compute_cluster_sizes(rng, num_people, num_cities, min_size=20, small_large_pcts=[0.6, 0.4]):
+    """ Function to compute sizes of each agent cluster
+
+    Arguments:
+        * rng: Buffered_RNG instance
+        * num_people: total number of agents
+        * num_cities: number of clusters
+        * min_size: minimum accepted cluster size ( integer)
+        * small_large_pcts: percentages of small and large cities over total ( list of floats  0<x<1)
+
+    Returns:
+        * list of integers representing cluster sizes
+
+    """
+    if min_size * num_cities >= num_people:
+        raise ValueError('num_people should be greater than min_size * num_cities ')
+    size_choices = [max(int(num_people / (10 * num_cities)), min_size),
+                    max(int(num_people / num_cities), min_size)]
+    city_sizes = rng.generator.choice(size_choices, p=small_large_pcts, size=num_cities - 1)
+    last_city_size = num_people - city_sizes.sum()
+    city_sizes = np.append(city_sizes, last_city_size)
+    pcts = rng.generator.dirichlet(city_sizes)
+    return rng.generator.multinomial(city_sizes.sum(), pcts)
+
+
+def generate_cluster_points_coords(rng, grid_width, grid_height, pct_grid_w, pct_grid_h, clust_size):
+    """ Using binomial ditribution, this function generates initial coordinates
+        for a given cluster, defined via its center and its size.
+        Cluster size as well as cluster center coords
+        (in grid percentage) must be provided
+
+    Arguments:
+        * rng: Buffered_RNG instance
+        * grid_width, grid_height: grid dimensions
+        * pct_grid_w: positive float < 1 to define clust_center along grid width
+        * pct_grid_h: positive float < 1 to define clust_center along grid height
+        * clust_size: desired size of the cluster being generated
+
+        pct_grid_w and pct_grid_h may also be arrays of length clust_size,
+        to generate points of several clusters in a single call
+
+    Returns:
+        * cluster_coordinates: two numpy arrays with x and y coordinates
+        respectively
+
+    """
+    ## use binomial generator to get clusters in width * height grid
+    ## n = grid_width, p = pct_grid, size = num_experim
+    x_coords = rng.generator.binomial(grid_width, pct_grid_w, size=clust_size)
+    np.minimum(x_coords, grid_width - 1, out=x_coords)
+
+    y_coords = rng.generator.binomial(grid_height, pct_grid_h, size=clust_size)
+    np.minimum(y_coords, grid_height - 1, out=y_coords)
+    return x_coords, y_coords
+
+
+def generate_population(rng, num_people, grid_width, grid_height, init_lang_distrib, num_cities,
+                        lang_ags_sorted_by_dist=True, lang_ags_sorted_in_clust=True):
+    """ Function to draw city centers, then lang type, coords and cluster of all
+        initial agents, according to lang_ags_sorted_by_dist and lang_ags_sorted_in_clust
+
+    Arguments:
+        * rng: Buffered_RNG instance
+        * other arguments are those of Simple_Language_Model
+
+    Returns:
+        * six items: numpy arrays with lang types, x and y coords and cluster index
+          of each agent, array of city centers (as grid pcts) and array of cluster sizes.
+          Cluster index and sizes are None if agents are not clustered
+
+    """
+    ## RANDOMLY DEFINE ALL CITY-CENTERS COORDS (CITY == HOMES, JOB CENTERS and SCHOOLS)
+    # first define available points as pct of squared grid length
+    grid_pct_list = np.linspace(0.1, 0.9, 100) # avoid edges
+    # now generate the cluster centers (CITIES-VILLAGES)
+    clust_centers = rng.generator.choice(grid_pct_list, size=(num_cities, 2), replace=False)
+    if lang_ags_sorted_by_dist:
+        clust_centers = clust_centers[np.argsort(np.hypot(*clust_centers.T), kind='stable')]
+
+    if (not lang_ags_sorted_by_dist) and (not lang_ags_sorted_in_clust):
+        xs = rng.generator.integers(grid_width, size=num_people)
+        ys = rng.generator.integers(grid_height, size=num_people)
+        langs = rng.generator.choice([0,1,2], p=init_lang_distrib, size=num_people)
+        return langs, xs, ys, None, clust_centers, None
+
+    cluster_sizes = compute_cluster_sizes(rng, num_people, num_cities)
+    array_langs = rng.generator.choice([0, 1, 2], p=init_lang_distrib, size=num_people)
+    if lang_ags_sorted_by_dist:
+        array_langs.sort()
+    # cluster index of each agent
+    clusters = np.repeat(np.arange(num_cities), cluster_sizes)
+    # generate coords of all clusters at once
+    x_cs, y_cs = generate_cluster_points_coords(rng, grid_width, grid_height,
+                                                clust_centers[clusters, 0],
+                                                clust_centers[clusters, 1], num_people)
+    if (not lang_ags_sorted_by_dist) and (lang_ags_sorted_in_clust):
+        # sort langs and coords (by distance to cluster center) within each cluster
+        array_langs = array_langs[np.lexsort((array_langs, clusters))]  # invert if needed
+        dists = np.hypot(x_cs - grid_width * clust_centers[clusters, 0],
+                         y_cs - grid_height * clust_centers[clusters, 1])
+        idxs_sorted = np.lexsort((dists, clusters))
+        x_cs, y_cs = x_cs[idxs_sorted], y_cs[idxs_sorted]
+    return array_langs, x_cs, y_cs, clusters, clust_centers, cluster_sizes
+
+
+def write_population(rng, columns, num_people, grid_width, grid_height, init_lang_distrib, num_cities,
+                     lang_ags_sorted_by_dist=True, lang_ags_sorted_in_clust=True, block_size=1 << 20):
+    """ Block version of generate_population: same draws in the same order, so that the
+        population is the same, but written block by block of block_size agents into given
+        columns (e.g. memory-mapped), so that temporary arrays do not grow with num_people.
+        If agents are sorted within clusters only (not by distance), they are sorted
+        cluster by cluster, so temporary arrays of that step grow with the largest cluster
+
+    Arguments:
+        * rng: Buffered_RNG instance
+        * columns: dict with 'language', 'x', 'y' and 'cluster' arrays of at least
+          num_people rows, written in rows 0 ... num_people - 1. Cluster is not
+          written if agents are not clustered
+        * block_size: number of agents drawn at a time
+        * other arguments are those of generate_population
+
+    Returns:
+        * array of city centers (as grid pcts) and array of cluster sizes,
+          None if agents are not clustered
+
+    """
+    blocks = [slice(start, min(start + block_size, num_people)) for start in range(0, num_people, block_size)]
+    # city centers are drawn as in generate_population
+    grid_pct_list = np.linspace(0.1, 0.9, 100)
+    clust_centers = rng.generator.choice(grid_pct_list, size=(num_cities, 2), replace=False)
+    if lang_ags_sorted_by_dist:
+        clust_centers = clust_centers[np.argsort(np.hypot(*clust_centers.T), kind='stable')]
+
+    if (not lang_ags_sorted_by_dist) and (not lang_ags_sorted_in_clust):
+        for name, size in [('x', grid_width), ('y', grid_height)]:
+            for block in blocks:
+                columns[name][block] = rng.generator.integers(size, size=block.stop - block.start)
+        for block in blocks:
+            columns['language'][block] = rng.generator.choice([0,1,2], p=init_lang_distrib,
+                                                              size=block.stop - block.start)
+        return clust_centers, None
+
+    cluster_sizes = compute_cluster_sizes(rng, num_people, num_cities)
+    cluster_ends = np.cumsum(cluster_sizes)
+    lang_counts = np.zeros(3, dtype=np.int64)
+    for block in blocks:
+        langs = rng.generator.choice([0, 1, 2], p=init_lang_distrib, size=block.stop - block.start)
+        lang_counts += np.bincount(langs, minlength=3)
+        columns['language'][block] = langs
+        # agents are assigned to clusters in order
+        columns['cluster'][block] = np.searchsorted(cluster_ends, np.arange(block.start, block.stop), side='right')
+    if lang_ags_sorted_by_dist:
+        # sorted langs are lang_counts[0] zeros, then lang_counts[1] ones, then twos
+        lang_ends = np.cumsum(lang_counts)
+        for block in blocks:
+            columns['language'][block] = np.searchsorted(lang_ends, np.arange(block.start, block.stop),
+                                                         side='right')
+    # all x coords are drawn before y coords, as in generate_cluster_points_coords
+    for coord, (name, size) in enumerate([('x', grid_width), ('y', grid_height)]):
+        for block in blocks:
+            coords = rng.generator.binomial(size, clust_centers[columns['cluster'][block], coord])
+            columns[name][block] = np.minimum(coords, size - 1)
+    if (not lang_ags_sorted_by_dist) and (lang_ags_sorted_in_clust):
+        # sort langs and coords (by distance to cluster center) within each cluster
+        for cluster, (start, stop) in enumerate(zip(cluster_ends - cluster_sizes, cluster_ends)):
+            block = slice(start, stop)
+            columns['language'][block] = np.sort(columns['language'][block])
+            x_cs, y_cs = np.array(columns['x'][block]), np.array(columns['y'][block])
+            dists = np.hypot(x_cs - grid_width * clust_centers[cluster, 0],
+                             y_cs - grid_height * clust_centers[cluster, 1])
+            idxs_sorted = np.argsort(dists, kind='stable')
+            columns['x'][block], columns['y'][block] = x_cs[idxs_sorted], y_cs[idxs_sorted]
+    return clust_centers, cluster_sizes
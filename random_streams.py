@@ -0,0 +1,78 @@
+# IMPORT LIBS
+import numpy as np
+
+
+class Buffered_RNG:
+    """ Random number source owned by the model and shared by agents, grid and agent arrays.
+        It wraps a numpy.random.Generator ('generator' attribute), used directly for
+        batched draws, and serves scalar draws from a pre-drawn block of uniforms
+        that is refilled in bulk when exhausted
+    """
+
+    def __init__(self, seed=None, block_size=4096):
+        """ Arguments:
+                * seed: integer, numpy SeedSequence or None
+                * block_size: number of uniforms pre-drawn at each refill
+        """
+        self.generator = np.random.default_rng(seed)
+        self.block_size = block_size
+        self._buffer = []
+
+    def _refill(self):
+        self._buffer = self.generator.random(self.block_size).tolist()
+
+    def random(self):
+        """ Draw a float uniformly from [0, 1) """
+        if not self._buffer:
+            self._refill()
+        return self._buffer.pop()
+
+    def randrange(self, n):
+        """ Draw an integer uniformly from range(n) """
+        return int(self.random() * n)
+
+    def choice(self, seq):
+        """ Pick an element of a non-empty sequence uniformly """
+        return seq[int(self.random() * len(seq))]
+
+    def bernoulli(self, p):
+        """ Draw 1 with probability p, 0 otherwise """
+        return int(self.random() < p)
+
+    def get_state(self):
+        """ Returns:
+                * tuple with generator state and pending buffered uniforms
+        """
+        return self.generator.bit_generator.state, list(self._buffer)
+
+    def set_state(self, state):
+        self.generator.bit_generator.state, buffer = state
+        self._buffer = list(buffer)
+
+
+def _splitmix64(x):
+    """ SplitMix64 finalizer of an array of uint64 (wraps around on overflow) """
+    x = x + np.uint64(0x9E3779B97F4A7C15)
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+def keyed_uniforms(key, step, stream, ids):
+    """ Counter-based uniforms: the value drawn for each id is a hash of
+        (key, step, stream, id) only. Unlike draws from a Buffered_RNG, it does not
+        depend on how many values were drawn before or on how ids are split into
+        batches, so steps can be computed in any order or in parallel
+
+        Arguments:
+            * key: 64 bit integer, e.g. Simple_Language_Model.stream_key
+            * step: integer model step
+            * stream: small integer that identifies the purpose of the draw
+            * ids: array of non-negative integers (agent rows)
+
+        Returns:
+            * array of floats in [0, 1), one per id
+    """
+    counter = _splitmix64(np.array([(step << 8) + stream], dtype=np.uint64) ^ np.uint64(key))
+    hashes = _splitmix64(np.asarray(ids, dtype=np.uint64) ^ counter)
+    return (hashes >> np.uint64(11)) * (1.0 / (1 << 53))
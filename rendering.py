@@ -0,0 +1,217 @@
+# IMPORT LIBS
+import os
+import queue
+import shutil
+import threading
+import subprocess
+import numpy as np
+import matplotlib.image as mpimg
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+# model reporters plotted in each panel of the results figure
+PANELS = [('lang_groups', ['count_spa', 'count_bil', 'count_cat']),
+          ('num_agents', ['total_num_agents']),
+          ('biling_quality', ['biling_evol_h', 'biling_evol_s'])]
+VIDEO_EXTENSIONS = ('.mp4', '.avi', '.mkv', '.mov', '.webm')
+
+
+class Results_Frame:
+    """ Results figure of a Simple_Language_Model run, updated in place frame by frame.
+        Line data are kept in buffers preallocated for the whole run and the grid
+        raster is recomputed from the agent arrays, so that the cost of a frame
+        does not depend on the number of steps already run
+    """
+
+    def __init__(self, fig, model, steps, plot_type='imshow', ag_attr='language'):
+        """ Arguments:
+                * fig: matplotlib figure, either from pyplot or a plain Figure
+                * model: Simple_Language_Model instance
+                * steps: number of model steps shown. At most one frame per step
+                * plot_type: 'imshow' or 'scatter'
+                * ag_attr: agent attribute averaged in each grid cell
+        """
+        if plot_type not in ['imshow', 'scatter']:
+            raise ValueError("plot_type should be 'imshow' or 'scatter'")
+        self.fig = fig
+        self.model = model
+        self.plot_type = plot_type
+        self.ag_attr = ag_attr
+        self.num_frames = 0
+        self.steps = np.zeros(steps, dtype=np.int64)
+        self.buffers = {}
+        self.lines = {}
+        gs = fig.add_gridspec(3, 5)
+        for i, (title, names) in enumerate(PANELS):
+            ax = fig.add_subplot(gs[i, 3:])
+            ax.set_xlim(model.schedule.steps, model.schedule.steps + steps)
+            ax.set_ylim(0, model.max_people_factor * model.num_people if title == 'num_agents' else 1)
+            ax.xaxis.tick_bottom()
+            ax.set_title(title)
+            for name in names:
+                self.buffers[name] = np.full(steps, np.nan)
+                self.lines[name], = ax.plot([], [], lw=2, label=name)
+            ax.legend(loc='best', prop={'size': 8})
+        ax = fig.add_subplot(gs[:, :3])
+        ax.set_xlim(-0.5, model.grid_width - 0.5)
+        ax.set_ylim(-0.5, model.grid_height - 0.5)
+        if plot_type == 'imshow':
+            self.grid_artist = ax.imshow(np.full((model.grid_height, model.grid_width), np.nan),
+                                         vmin=0, vmax=2, cmap='viridis',
+                                         interpolation='nearest', origin='lower')
+        else:
+            self.grid_artist = ax.scatter([], [], c=[], vmin=0, vmax=2, s=35, cmap='viridis')
+        fig.colorbar(self.grid_artist, ax=ax)
+        self.time_text = ax.text(0.02, 0.95, '', transform=ax.transAxes)
+        self.artists = tuple(self.lines.values()) + (self.grid_artist, self.time_text)
+
+    def update(self):
+        """ Append current model reporter values to line buffers and refresh grid raster
+
+            Returns:
+                * tuple of updated artists (for blitting)
+        """
+        i = self.num_frames
+        if i == len(self.steps):
+            raise IndexError('frame buffers are full')
+        self.steps[i] = self.model.schedule.steps
+        reporters = self.model.datacollector.model_reporters
+        for name, line in self.lines.items():
+            # reporters are O(1) reads of running aggregates
+            self.buffers[name][i] = reporters[name](self.model)
+            line.set_data(self.steps[:i + 1], self.buffers[name][:i + 1])
+        self.num_frames += 1
+        return self.draw_grid()
+
+    def draw_grid(self):
+        """ Refresh grid raster and time text from current model state, without
+            appending a frame to line buffers, e.g. to draw the initial state
+
+            Returns:
+                * tuple of all artists (for blitting)
+        """
+        raster = self.model.get_grid_raster(self.ag_attr)
+        if self.plot_type == 'imshow':
+            self.grid_artist.set_data(raster)
+        else:
+            ys, xs = np.nonzero(~np.isnan(raster))
+            self.grid_artist.set_offsets(np.column_stack((xs, ys)))
+            self.grid_artist.set_array(raster[ys, xs])
+        self.time_text.set_text('time = %.1f' % self.model.schedule.steps)
+        return self.artists
+
+
+class Frame_Writer(threading.Thread):
+    """ Background thread that writes rendered RGBA frames either to a video file
+        (piped to ffmpeg) or to a numbered PNG sequence. Frames wait in a bounded queue,
+        so the simulation only blocks if encoding falls behind by max_queued frames
+    """
+
+    def __init__(self, output, fps=10, max_queued=16):
+        """ Arguments:
+                * output: path of video file (mp4, avi, mkv, mov, webm) or
+                  directory of PNG sequence
+                * fps: frames per second of video
+                * max_queued: maximum number of frames waiting to be written
+        """
+        super().__init__(daemon=True)
+        self.output = output
+        self.fps = fps
+        self.is_video = output.lower().endswith(VIDEO_EXTENSIONS)
+        if self.is_video:
+            if shutil.which('ffmpeg') is None:
+                raise RuntimeError('ffmpeg is needed to write video files')
+        else:
+            os.makedirs(output, exist_ok=True)
+        self.frames = queue.Queue(maxsize=max_queued)
+        self.num_written = 0
+        self.error = None
+        self.start()
+
+    def write(self, frame):
+        """ Queue an RGBA frame (height x width x 4 uint8 array) to be written """
+        if self.error:
+            raise self.error
+        self.frames.put(frame)
+
+    def _open_video(self, height, width):
+        cmd = ['ffmpeg', '-y', '-loglevel', 'error',
+               '-f', 'rawvideo', '-pix_fmt', 'rgba', '-s', '{}x{}'.format(width, height),
+               '-r', str(self.fps), '-i', '-',
+               # yuv420p needs even dimensions
+               '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2', '-pix_fmt', 'yuv420p', self.output]
+        return subprocess.Popen(cmd, stdin=subprocess.PIPE)
+
+    def run(self):
+        process = None
+        while True:
+            frame = self.frames.get()
+            if frame is None:
+                break
+            if self.error:
+                # keep draining the queue so that the simulation never blocks
+                continue
+            try:
+                if self.is_video:
+                    if process is None:
+                        process = self._open_video(*frame.shape[:2])
+                    process.stdin.write(frame.tobytes())
+                else:
+                    mpimg.imsave(os.path.join(self.output, 'frame_{:06d}.png'.format(self.num_written)),
+                                 frame)
+                self.num_written += 1
+            except Exception as error:
+                self.error = error
+        if process is not None:
+            process.stdin.close()
+            if process.wait() and not self.error:
+                self.error = RuntimeError('ffmpeg exited with code {}'.format(process.returncode))
+
+    def close(self):
+        """ Wait until all queued frames are written """
+        self.frames.put(None)
+        self.join()
+        if self.error:
+            raise self.error
+
+
+def render_run(model, steps, output, plot_type='imshow', render_freq=1, fps=10, dpi=100):
+    """ Function to run a model and render its results headless (Agg canvas, no display).
+        Drawing is done in the calling thread, since matplotlib is not thread-safe,
+        while writing frames to disk is done by a Frame_Writer thread. Static parts of
+        the figure (axes, labels, legends) are drawn once; each frame only redraws
+        the updated artists over a copy of that background (blitting)
+
+        Arguments:
+            * model: Simple_Language_Model instance
+            * steps: number of model steps
+            * output: path of video file or directory of PNG sequence
+            * plot_type: 'imshow' or 'scatter'
+            * render_freq: steps between rendered frames
+            * fps: frames per second of video
+            * dpi: resolution of frames
+
+        Returns:
+            * number of frames written
+    """
+    fig = Figure(figsize=(10, 6), dpi=dpi)
+    canvas = FigureCanvasAgg(fig)
+    frame = Results_Frame(fig, model, steps, plot_type=plot_type)
+    fig.tight_layout()
+    for artist in frame.artists:
+        artist.set_animated(True)
+    canvas.draw()
+    background = canvas.copy_from_bbox(fig.bbox)
+    writer = Frame_Writer(output, fps=fps)
+    try:
+        for _ in range(steps):
+            model.step()
+            if not model.schedule.steps % render_freq:
+                canvas.restore_region(background)
+                for artist in frame.update():
+                    fig.draw_artist(artist)
+                # copy, since the canvas buffer is reused by the next draw
+                writer.write(np.array(canvas.buffer_rgba()))
+    finally:
+        writer.close()
+    return writer.num_written
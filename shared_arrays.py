@@ -0,0 +1,32 @@
+# IMPORT LIBS
+from multiprocessing import shared_memory
+import numpy as np
+
+
+def to_shared_array(array):
+    """ Function to copy an array into a new shared memory block
+
+        Returns:
+            * block: SharedMemory instance. It must be kept alive while the array
+              is used, then closed and unlinked by its owner
+            * shared: numpy array over the block, with the contents of array
+            * spec: (block name, shape, dtype string) tuple to attach the array
+              from another process with attach_shared_array
+    """
+    block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    shared = np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)
+    shared[...] = array
+    return block, shared, (block.name, array.shape, array.dtype.str)
+
+
+def attach_shared_array(spec):
+    """ Function to attach, from another process, an array created by to_shared_array
+
+        Returns:
+            * block: SharedMemory instance. It must be kept alive while the array
+              is used, then closed (not unlinked)
+            * array: numpy array over the block
+    """
+    name, shape, dtype = spec
+    block = shared_memory.SharedMemory(name=name)
+    return block, np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
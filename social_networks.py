@@ -0,0 +1,318 @@
+# IMPORT LIBS
+import numpy as np
+
+# edge (u, v) has key u << KEY_SHIFT | v, so that sorted keys are edges sorted by source
+KEY_SHIFT = 32
+
+
+class Compact_Network:
+    """ Compact graph of agents, indexed by agent row. It replaces the networkx graphs
+        of the model, with the same add_edge/remove_edge/has_edge/neighbors interface.
+
+        Edges are stored in slots of arrays (src, dst) with edge attributes in arrays:
+            * lang_spoken: 0, 1 => spa, cat (-1 if undefined)
+            * link_strength: float (nan if undefined)
+        Nodes are not stored: an agent becomes a node when it gets its first edge.
+        Edges are found through a sorted array of edge keys (u << KEY_SHIFT | v) with
+        the slot of each edge, so that out-neighbours of a node are a range of it.
+        New edges are appended to a small buffer of recent keys, merged into the sorted
+        keys when it is full, so that adding edges never re-sorts all of them.
+        Slots of removed edges are reused by new edges, and slots are compacted
+        when too many of them are free
+    """
+    # max number of recent edges not merged yet into the sorted keys
+    max_recent = 4096
+    # slots are compacted when free ones exceed this fraction of all slots
+    max_free_fraction = 0.5
+    min_compact_slots = 1024
+
+    def __init__(self, directed=True, capacity=1024):
+        """ Arguments:
+                * directed: boolean. Undirected edges are stored in both directions
+                * capacity: initial number of edge slots
+        """
+        self.directed = directed
+        self.num_slots = 0
+        self.num_edges = 0
+        self.src = np.zeros(capacity, dtype=np.int64)
+        self.dst = np.zeros(capacity, dtype=np.int64)
+        self.lang_spoken = np.full(capacity, -1, dtype=np.int8)
+        self.link_strength = np.full(capacity, np.nan)
+        self.valid = np.zeros(capacity, dtype=bool)
+        self.free_slots = []
+        # sorted edge keys and their slots (-1 for removed edges)
+        self.keys = np.zeros(0, dtype=np.int64)
+        self.key_slots = np.zeros(0, dtype=np.int64)
+        # unsorted keys and slots of recent edges
+        self.num_recent = 0
+        self.recent_keys = np.zeros(self.max_recent, dtype=np.int64)
+        self.recent_slots = np.zeros(self.max_recent, dtype=np.int64)
+
+    @staticmethod
+    def _node(node):
+        """ Nodes can be given either as agents or as agent rows """
+        return int(getattr(node, 'row', node))
+
+    def _grow(self):
+        capacity = 2 * len(self.src)
+        for attr, fill in [('src', 0), ('dst', 0), ('lang_spoken', -1),
+                           ('link_strength', np.nan), ('valid', False)]:
+            old = getattr(self, attr)
+            new = np.full(capacity, fill, dtype=old.dtype)
+            new[:len(old)] = old
+            setattr(self, attr, new)
+
+    def _find(self, key):
+        """ Returns:
+                * ('recent', position) or ('sorted', position) of the edge
+                  with given key, or (None, -1) if there is no such edge
+        """
+        if self.num_recent:
+            positions = np.flatnonzero(self.recent_keys[:self.num_recent] == key)
+            if len(positions):
+                return 'recent', int(positions[0])
+        position = int(np.searchsorted(self.keys, key))
+        if position < len(self.keys) and self.keys[position] == key and self.key_slots[position] >= 0:
+            return 'sorted', position
+        return None, -1
+
+    def _slot(self, u, v):
+        """ Returns:
+                * slot of edge (u, v), or -1 if there is no such edge
+        """
+        where, position = self._find(u << KEY_SHIFT | v)
+        if where == 'recent':
+            return int(self.recent_slots[position])
+        if where == 'sorted':
+            return int(self.key_slots[position])
+        return -1
+
+    def _merge_recent(self):
+        """ Merge recent keys into the sorted keys, dropping removed edges """
+        recent_keys = self.recent_keys[:self.num_recent]
+        order = np.argsort(recent_keys)
+        valid = self.key_slots >= 0
+        keys, key_slots = self.keys[valid], self.key_slots[valid]
+        positions = np.searchsorted(keys, recent_keys[order])
+        self.keys = np.insert(keys, positions, recent_keys[order])
+        self.key_slots = np.insert(key_slots, positions, self.recent_slots[:self.num_recent][order])
+        self.num_recent = 0
+
+    def _set_edge(self, u, v, lang_spoken, link_strength):
+        slot = self._slot(u, v)
+        if slot < 0:
+            if self.free_slots:
+                slot = self.free_slots.pop()
+            else:
+                if self.num_slots == len(self.src):
+                    self._grow()
+                slot = self.num_slots
+                self.num_slots += 1
+            self.src[slot], self.dst[slot] = u, v
+            self.lang_spoken[slot], self.link_strength[slot] = -1, np.nan
+            self.valid[slot] = True
+            self.num_edges += 1
+            if self.num_recent == self.max_recent:
+                self._merge_recent()
+            self.recent_keys[self.num_recent] = u << KEY_SHIFT | v
+            self.recent_slots[self.num_recent] = slot
+            self.num_recent += 1
+        if lang_spoken is not None:
+            self.lang_spoken[slot] = lang_spoken
+        if link_strength is not None:
+            self.link_strength[slot] = link_strength
+
+    def add_edge(self, u, v, lang_spoken=None, link_strength=None):
+        """ Add an edge, or update the attributes of an existing one
+
+            Arguments:
+                * u, v: agents or agent rows
+                * lang_spoken: optional integer 0 (spa) or 1 (cat)
+                * link_strength: optional float
+        """
+        u, v = self._node(u), self._node(v)
+        self._set_edge(u, v, lang_spoken, link_strength)
+        if not self.directed and u != v:
+            self._set_edge(v, u, lang_spoken, link_strength)
+
+    def _free(self, slots):
+        """ Free slots of removed edges, and compact slots if too many are free """
+        self.valid[slots] = False
+        self.free_slots.extend(np.atleast_1d(slots).tolist())
+        self.num_edges -= np.size(slots)
+        if (self.num_slots >= self.min_compact_slots and
+                len(self.free_slots) > self.max_free_fraction * self.num_slots):
+            self.compact()
+
+    def remove_edge(self, u, v):
+        u, v = self._node(u), self._node(v)
+        pairs = [(u, v)] if self.directed else [(u, v), (v, u)]
+        for a, b in pairs:
+            where, position = self._find(a << KEY_SHIFT | b)
+            if where == 'recent':
+                slot = int(self.recent_slots[position])
+                # swap with last recent edge
+                last = self.num_recent - 1
+                self.recent_keys[position] = self.recent_keys[last]
+                self.recent_slots[position] = self.recent_slots[last]
+                self.num_recent = last
+                self._free(slot)
+            elif where == 'sorted':
+                slot = int(self.key_slots[position])
+                self.key_slots[position] = -1
+                self._free(slot)
+
+    def remove_nodes(self, nodes):
+        """ Remove all edges from or to the given nodes, e.g. removed agents
+            whose rows will be reused
+
+            Arguments:
+                * nodes: array of agent rows
+        """
+        if not self.num_edges:
+            return
+        n = self.num_slots
+        slots = np.flatnonzero(self.valid[:n] & (np.isin(self.src[:n], nodes) | np.isin(self.dst[:n], nodes)))
+        if not len(slots):
+            return
+        self.key_slots[np.isin(self.key_slots, slots)] = -1
+        keep = ~np.isin(self.recent_slots[:self.num_recent], slots)
+        num_kept = int(keep.sum())
+        self.recent_keys[:num_kept] = self.recent_keys[:self.num_recent][keep]
+        self.recent_slots[:num_kept] = self.recent_slots[:self.num_recent][keep]
+        self.num_recent = num_kept
+        self._free(slots)
+
+    def compact(self):
+        """ Move edges to the first slots, in slot order, and drop free slots """
+        self._merge_recent()
+        valid_slots = np.flatnonzero(self.valid[:self.num_slots])
+        new_slots = np.full(self.num_slots, -1, dtype=np.int64)
+        new_slots[valid_slots] = np.arange(len(valid_slots))
+        for attr in ['src', 'dst', 'lang_spoken', 'link_strength']:
+            array = getattr(self, attr)
+            array[:len(valid_slots)] = array[valid_slots]
+        self.valid[:self.num_slots] = False
+        self.valid[:len(valid_slots)] = True
+        self.num_slots = len(valid_slots)
+        self.free_slots = []
+        self.key_slots = new_slots[self.key_slots]
+
+    def has_edge(self, u, v):
+        return self._slot(self._node(u), self._node(v)) >= 0
+
+    def get_edge_data(self, u, v):
+        """ Returns:
+                * dict with edge attributes, or None if there is no edge
+        """
+        slot = self._slot(self._node(u), self._node(v))
+        if slot < 0:
+            return None
+        return {'lang_spoken': int(self.lang_spoken[slot]),
+                'link_strength': float(self.link_strength[slot])}
+
+    def _out_slots(self, u):
+        start, end = np.searchsorted(self.keys, [u << KEY_SHIFT, (u + 1) << KEY_SHIFT])
+        slots = self.key_slots[start:end]
+        slots = slots[slots >= 0]
+        if self.num_recent:
+            recent = self.recent_keys[:self.num_recent] >> KEY_SHIFT == u
+            if recent.any():
+                slots = np.concatenate((slots, self.recent_slots[:self.num_recent][recent]))
+        return slots
+
+    def neighbors(self, u):
+        """ Returns:
+                * array with rows of (successor) neighbours of u
+        """
+        return self.dst[self._out_slots(self._node(u))]
+
+    def degree(self, u):
+        return len(self._out_slots(self._node(u)))
+
+    def random_neighbor(self, u, rng):
+        """ Pick a random (successor) neighbour of u in O(log number of edges)
+
+            Arguments:
+                * u: agent or agent row
+                * rng: Buffered_RNG instance
+
+            Returns:
+                * row of neighbour, or None if u has no neighbours
+        """
+        out_slots = self._out_slots(self._node(u))
+        if len(out_slots):
+            return int(self.dst[out_slots[rng.randrange(len(out_slots))]])
+
+    def __getitem__(self, u):
+        """ networkx-like adjacency of u: {neighbour row: edge attributes dict} """
+        return {int(self.dst[slot]): {'lang_spoken': int(self.lang_spoken[slot]),
+                                      'link_strength': float(self.link_strength[slot])}
+                for slot in self._out_slots(self._node(u))}
+
+    def _valid_slots(self):
+        return np.flatnonzero(self.valid[:self.num_slots])
+
+    def nodes(self):
+        """ Returns:
+                * sorted array of rows of agents with at least one edge
+        """
+        slots = self._valid_slots()
+        return np.union1d(self.src[slots], self.dst[slots])
+
+    def number_of_edges(self):
+        num_edges = self.num_edges
+        if not self.directed:
+            # self loops are stored once, other edges twice
+            slots = self._valid_slots()
+            num_self_loops = np.sum(self.src[slots] == self.dst[slots])
+            num_edges = (num_edges + num_self_loops) // 2
+        return int(num_edges)
+
+    def to_networkx(self, row_agents=None):
+        """ Export network for analysis
+
+            Arguments:
+                * row_agents: optional sequence mapping rows to agents. If given,
+                  nodes of the exported graph are agents instead of rows
+
+            Returns:
+                * networkx DiGraph (directed) or Graph (undirected)
+        """
+        import networkx as nx
+
+        graph = nx.DiGraph() if self.directed else nx.Graph()
+        node = (lambda row: row_agents[row]) if row_agents is not None else (lambda row: row)
+        graph.add_nodes_from(node(row) for row in self.nodes().tolist())
+        for slot in self._valid_slots().tolist():
+            attrs = {}
+            if self.lang_spoken[slot] >= 0:
+                attrs['lang_spoken'] = int(self.lang_spoken[slot])
+            if not np.isnan(self.link_strength[slot]):
+                attrs['link_strength'] = float(self.link_strength[slot])
+            graph.add_edge(node(int(self.src[slot])), node(int(self.dst[slot])), **attrs)
+        return graph
+
+    def get_state(self):
+        """ Returns:
+                * dict with arrays of valid edges (src, dst and attributes)
+        """
+        slots = self._valid_slots()
+        return {'directed': self.directed, 'src': self.src[slots], 'dst': self.dst[slots],
+                'lang_spoken': self.lang_spoken[slots], 'link_strength': self.link_strength[slots]}
+
+    def set_state(self, state):
+        """ Restore edges of an empty network from a dict built by get_state """
+        self.directed = state['directed']
+        num_edges = len(state['src'])
+        while len(self.src) < num_edges:
+            self._grow()
+        self.num_slots = self.num_edges = num_edges
+        for attr in ['src', 'dst', 'lang_spoken', 'link_strength']:
+            getattr(self, attr)[:num_edges] = state[attr]
+        self.valid[:num_edges] = True
+        self.free_slots = []
+        keys = self.src[:num_edges] << KEY_SHIFT | self.dst[:num_edges]
+        self.key_slots = np.argsort(keys)
+        self.keys = keys[self.key_slots]
+        self.num_recent = 0
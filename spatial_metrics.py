@@ -0,0 +1,371 @@
+# IMPORT LIBS
+import numpy as np
+import pandas as pd
+
+# model-level series collected by Spatial_Metrics.collect
+METRICS_SERIES = ['dissimilarity', 'morans_i']
+# max number of queued single-row changes
+MAX_PENDING = 1 << 16
+
+
+class Spatial_Metrics:
+    """ Per-cell and per-cluster language aggregates of the agents of a Lang_Agents_Arrays,
+        kept up to date incrementally, and spatial segregation indices computed from them.
+
+        Each agent placed on the grid adds its lang type, cat_pct_h and cat_pct_s to the
+        aggregates of its cell and, if it belongs to one, of its cluster (city).
+        Lang_Agents_Arrays takes the keys of some rows (get_keys) before every change of
+        their language, cat pcts, position or cluster and calls update_changed after it,
+        so that aggregates are updated at a cost proportional to the number of agents
+        whose contribution changed.
+        Cat pcts are rounded to hundredths by the model, so their sums are kept
+        as exact integer numbers of hundredths.
+
+        Indices are computed from cell aggregates, never from agents:
+            * dissimilarity: index of dissimilarity between spa and cat monolinguals,
+              0.5 * sum over cells of |spa_i / spa_total - cat_i / cat_total|.
+              Computed with one pass over cells
+            * morans_i: global Moran's I of mean cat_pct_h per cell, over occupied cells
+              with binary weights between Moore neighbours. Sums that define it are
+              refreshed only over the cells that changed since the last evaluation
+              and their neighbours (see refresh)
+
+        Local Moran's I is a map with one value per cell, not a model-level series, so
+        it is only collected, as one raster per collection, if collect_local is True
+    """
+
+    def __init__(self, ags_data, grid, num_clusters, collect_freq=10, collect_local=False):
+        """ Arguments:
+                * ags_data: Lang_Agents_Arrays instance
+                * grid: Cell_Index_Grid instance, whose Moore table defines neighbours
+                * num_clusters: number of clusters (model num_cities)
+                * collect_freq: steps between collections of indices
+                * collect_local: boolean to also collect local Moran's I of each cell.
+                  Memory grows with number of cells times number of collections
+        """
+        self.ags_data = ags_data
+        self.height = grid.height
+        self.num_cells = grid.num_cells
+        self.num_clusters = num_clusters
+        self.collect_freq = collect_freq
+        self.collect_local = collect_local
+        # single-row changes waiting to be applied in one batch, as
+        # (cell, lang, cat_h, cat_s, cluster, sign) tuples
+        self.pending = []
+        # neighbour cells, with padding -1 pointing to an always empty extra cell
+        self.neighbors = np.where(grid.neighbors >= 0, grid.neighbors, self.num_cells)
+        self.recount()
+        # collected series
+        self.collected_steps = []
+        self.collected = {name: [] for name in METRICS_SERIES}
+        self.collected_clusters = []
+        self.collected_local = []
+
+    def recount(self):
+        """ Compute all aggregates with a full scan of agents, then all Moran's I sums """
+        ags = self.ags_data
+        n = ags.num_rows
+        self.cell_counts = np.zeros((self.num_cells, 3), dtype=np.int64)
+        self.cell_cat_h = np.zeros(self.num_cells, dtype=np.int64)
+        self.cell_cat_s = np.zeros(self.num_cells, dtype=np.int64)
+        self.cluster_counts = np.zeros((self.num_clusters, 3), dtype=np.int64)
+        self.cluster_cat_h = np.zeros(self.num_clusters, dtype=np.int64)
+        self.cluster_cat_s = np.zeros(self.num_clusters, dtype=np.int64)
+        self.dirty = np.zeros(self.num_cells, dtype=bool)
+        self.pending = []
+        self.update(np.flatnonzero(ags.x[:n] >= 0), 1)
+        self._recompute_sums()
+
+    @staticmethod
+    def _add(array, idxs, sign, weights=None):
+        """ array[idxs] += sign * weights (sign if no weights) with repeated idxs.
+            Small batches use np.add.at, large ones a bincount over the whole array
+        """
+        if 8 * len(idxs) < len(array):
+            np.add.at(array, idxs, sign if weights is None else sign * weights)
+        elif weights is None:
+            array += sign * np.bincount(idxs, minlength=len(array))
+        else:
+            array += sign * np.bincount(idxs, weights=weights, minlength=len(array)).astype(array.dtype)
+
+    def get_keys(self, rows):
+        """ Returns:
+                * contributions of given rows to the aggregates: tuple of cells (-1 for
+                  agents off the grid), lang types, cat_pct_h and cat_pct_s in hundredths
+                  and clusters. Each item is a scalar if a single row is given
+        """
+        ags = self.ags_data
+        if len(rows) == 1:
+            # scalar path, much faster for the per-agent engine
+            row = int(rows[0])
+            x = ags.x.item(row)
+            return (x * self.height + ags.y.item(row) if x >= 0 else -1, ags.language.item(row),
+                    int(ags.cat_pct_h.item(row) * 100 + 0.5), int(ags.cat_pct_s.item(row) * 100 + 0.5),
+                    ags.cluster.item(row))
+        xs = ags.x[rows]
+        return (np.where(xs >= 0, xs * self.height + ags.y[rows], -1), ags.language[rows],
+                (ags.cat_pct_h[rows] * 100 + 0.5).astype(np.int64),
+                (ags.cat_pct_s[rows] * 100 + 0.5).astype(np.int64), ags.cluster[rows])
+
+    def _apply_one(self, keys, sign):
+        # scalar writes into numpy arrays are slow, so single-row changes are queued
+        if keys[0] >= 0:
+            self.pending.append(keys + (sign,))
+            if len(self.pending) >= MAX_PENDING:
+                self.flush()
+
+    def flush(self):
+        """ Apply queued single-row changes to the aggregates """
+        if not self.pending:
+            return
+        pending = np.array(self.pending, dtype=np.int64)
+        self.pending = []
+        for sign in [-1, 1]:
+            keys = pending[pending[:, 5] == sign, :5].T
+            self._apply_cells(keys, sign)
+            self._apply_clusters(keys, sign)
+
+    def _apply_cells(self, keys, sign):
+        cells, langs, cat_h, cat_s, _ = keys
+        placed = cells >= 0
+        if not placed.all():
+            cells, langs, cat_h, cat_s = cells[placed], langs[placed], cat_h[placed], cat_s[placed]
+        self._add(self.cell_counts.reshape(-1), 3 * cells + langs, sign)
+        self._add(self.cell_cat_h, cells, sign, cat_h)
+        self._add(self.cell_cat_s, cells, sign, cat_s)
+        self.dirty[cells] = True
+
+    def _apply_clusters(self, keys, sign):
+        cells, langs, cat_h, cat_s, clusters = keys
+        counted = (cells >= 0) & (clusters >= 0)
+        if not counted.all():
+            clusters, langs, cat_h, cat_s = clusters[counted], langs[counted], cat_h[counted], cat_s[counted]
+        self._add(self.cluster_counts.reshape(-1), 3 * clusters + langs, sign)
+        self._add(self.cluster_cat_h, clusters, sign, cat_h)
+        self._add(self.cluster_cat_s, clusters, sign, cat_s)
+
+    def update(self, rows, sign):
+        """ Add (sign=1) or remove (sign=-1) the contribution of given rows
+            to the aggregates. Rows must be unique. Agents not on the grid are skipped
+        """
+        keys = self.get_keys(rows)
+        if len(rows) == 1:
+            self._apply_one(keys, sign)
+            return
+        self._apply_cells(keys, sign)
+        self._apply_clusters(keys, sign)
+
+    def update_changed(self, rows, old_keys):
+        """ Move the contribution of given rows from old_keys, as returned by get_keys
+            before a change of agent state, to their current keys. Only rows whose
+            contribution to each aggregate changed are visited. Rows must be unique
+        """
+        new_keys = self.get_keys(rows)
+        if len(rows) == 1:
+            if new_keys != old_keys:
+                self._apply_one(old_keys, -1)
+                self._apply_one(new_keys, 1)
+            return
+        cells_changed, langs_changed, cat_h_changed, cat_s_changed, clusters_changed = [
+            old != new for old, new in zip(old_keys, new_keys)]
+        values_changed = langs_changed | cat_h_changed | cat_s_changed
+        placed_changed = (old_keys[0] >= 0) != (new_keys[0] >= 0)
+        for apply, changed in [(self._apply_cells, cells_changed | values_changed),
+                               (self._apply_clusters, clusters_changed | placed_changed | values_changed)]:
+            idxs = np.flatnonzero(changed)
+            if len(idxs) == len(rows):
+                old, new = old_keys, new_keys
+            elif len(idxs):
+                old, new = [[key[idxs] for key in keys] for keys in (old_keys, new_keys)]
+            else:
+                continue
+            apply(old, -1)
+            apply(new, 1)
+
+    def _cell_values(self, cells):
+        """ Returns:
+                * occupancy (0 or 1) and mean cat_pct_h (0 if empty) of given cells
+        """
+        counts = self.cell_counts[cells].sum(axis=1)
+        return (counts > 0).astype(np.int64), self.cell_cat_h[cells] / (100 * np.maximum(counts, 1))
+
+    def _recompute_sums(self):
+        """ Compute values of all cells, their neighbour sums and Moran's I sums """
+        self.occupied, self.values = self._cell_values(np.arange(self.num_cells))
+        # extra empty cell for padding
+        self.occupied = np.append(self.occupied, 0)
+        self.values = np.append(self.values, 0.)
+        # sums of values and of occupancy over neighbours of each cell
+        self.lag = self.values[self.neighbors].sum(axis=1)
+        self.degree = self.occupied[self.neighbors].sum(axis=1)
+        self.num_occupied = int(self.occupied.sum())
+        self.sum_v = self.values.sum()
+        self.sum_v2 = (self.values ** 2).sum()
+        self.sum_v_lag = (self.values[:-1] * self.lag).sum()
+        self.sum_v_degree = (self.values[:-1] * self.degree).sum()
+        self.sum_weights = int((self.occupied[:-1] * self.degree).sum())
+        self.dirty[:] = False
+
+    def _terms(self, cells):
+        values, occupied = self.values[cells], self.occupied[cells]
+        return ((values * self.lag[cells]).sum(), (values * self.degree[cells]).sum(),
+                int((occupied * self.degree[cells]).sum()))
+
+    def refresh(self):
+        """ Bring Moran's I sums up to date with cell aggregates. Only cells changed since
+            the last refresh and their neighbours are visited. If most cells changed,
+            all sums are recomputed, which also discards accumulated rounding errors
+        """
+        self.flush()
+        changed = np.flatnonzero(self.dirty)
+        if 2 * len(changed) > self.num_cells:
+            self._recompute_sums()
+            return
+        self.dirty[changed] = False
+        neighbors = self.neighbors[changed]
+        affected = np.unique(np.concatenate((changed, neighbors[neighbors < self.num_cells])))
+        sum_v_lag, sum_v_degree, sum_weights = self._terms(affected)
+        self.sum_v_lag -= sum_v_lag
+        self.sum_v_degree -= sum_v_degree
+        self.sum_weights -= sum_weights
+        occupied, values = self._cell_values(changed)
+        d_occupied, d_values = occupied - self.occupied[changed], values - self.values[changed]
+        self.num_occupied += int(d_occupied.sum())
+        self.sum_v += d_values.sum()
+        self.sum_v2 += (values ** 2 - self.values[changed] ** 2).sum()
+        self.occupied[changed], self.values[changed] = occupied, values
+        # padding cell absorbs updates of missing neighbours
+        lag, degree = np.append(self.lag, 0.), np.append(self.degree, 0)
+        np.add.at(lag, neighbors, np.broadcast_to(d_values[:, None], neighbors.shape))
+        np.add.at(degree, neighbors, np.broadcast_to(d_occupied[:, None], neighbors.shape))
+        self.lag, self.degree = lag[:-1], degree[:-1]
+        sum_v_lag, sum_v_degree, sum_weights = self._terms(affected)
+        self.sum_v_lag += sum_v_lag
+        self.sum_v_degree += sum_v_degree
+        self.sum_weights += sum_weights
+
+    def get_dissimilarity(self):
+        """ Returns:
+                * index of dissimilarity between spa and cat monolinguals,
+                  nan if one of both groups is empty
+        """
+        self.flush()
+        spa, cat = self.cell_counts[:, 0], self.cell_counts[:, 2]
+        spa_total, cat_total = spa.sum(), cat.sum()
+        if not spa_total or not cat_total:
+            return np.nan
+        return 0.5 * np.abs(spa / spa_total - cat / cat_total).sum()
+
+    def _moran_moments(self):
+        mean = self.sum_v / self.num_occupied
+        variance = self.sum_v2 / self.num_occupied - mean ** 2
+        return mean, variance
+
+    def get_morans_i(self):
+        """ Returns:
+                * global Moran's I of mean cat_pct_h per occupied cell,
+                  nan if all occupied cells have the same value or none has neighbours
+        """
+        self.refresh()
+        if not self.num_occupied or not self.sum_weights:
+            return np.nan
+        mean, variance = self._moran_moments()
+        if variance <= 1e-12:
+            return np.nan
+        cross = self.sum_v_lag - 2 * mean * self.sum_v_degree + mean ** 2 * self.sum_weights
+        return cross / (self.sum_weights * variance)
+
+    def get_local_morans_i(self):
+        """ Returns:
+                * 2D numpy array of local Moran's I of each cell, indexed [y, x] as
+                  Simple_Language_Model.get_grid_raster, with nan in empty cells
+        """
+        self.refresh()
+        local = np.full(self.num_cells, np.nan)
+        if self.num_occupied:
+            mean, variance = self._moran_moments()
+            occupied = self.occupied[:-1] == 1
+            with np.errstate(invalid='ignore', divide='ignore'):
+                local[occupied] = ((self.values[:-1][occupied] - mean) *
+                                   (self.lag[occupied] - mean * self.degree[occupied]) / variance)
+        return local.reshape(-1, self.height).T
+
+    def collect(self, step):
+        """ Store indices and cluster aggregates at given step """
+        self.collected_steps.append(step)
+        self.collected['dissimilarity'].append(self.get_dissimilarity())
+        self.collected['morans_i'].append(self.get_morans_i())
+        self.collected_clusters.append(np.column_stack((self.cluster_counts, self.cluster_cat_h,
+                                                        self.cluster_cat_s)))
+        if self.collect_local:
+            self.collected_local.append(self.get_local_morans_i().astype(np.float32))
+
+    def get_dataframe(self):
+        """ Returns:
+                * pandas DataFrame of collected indices, indexed by step
+        """
+        return pd.DataFrame(self.collected, index=pd.Index(self.collected_steps, name='step'))
+
+    def get_local_morans_rasters(self):
+        """ Returns:
+                * 3D numpy array of local Moran's I collected with collect_local, indexed
+                  [collection, y, x], with one raster per step of get_dataframe().index
+        """
+        if not self.collected_local:
+            return np.zeros((0, self.height, self.num_cells // self.height), dtype=np.float32)
+        return np.stack(self.collected_local)
+
+    def get_cluster_dataframe(self):
+        """ Returns:
+                * pandas DataFrame indexed by (step, cluster) with pct of each lang type
+                  and mean cat pcts of the agents of each cluster at each collection
+        """
+        if not self.collected_clusters:
+            data = np.zeros((0, 5), dtype=np.int64)
+        else:
+            data = np.concatenate(self.collected_clusters)
+        num_agents = data[:, :3].sum(axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            df = pd.DataFrame({'count_spa': data[:, 0] / num_agents, 'count_bil': data[:, 1] / num_agents,
+                               'count_cat': data[:, 2] / num_agents, 'num_agents': num_agents,
+                               'cat_pct_h': data[:, 3] / (100 * num_agents),
+                               'cat_pct_s': data[:, 4] / (100 * num_agents)})
+        df.index = pd.MultiIndex.from_product([self.collected_steps, range(self.num_clusters)],
+                                              names=['step', 'cluster'])
+        return df
+
+    def check(self):
+        """ Debug method that compares aggregates and Moran's I sums with a full recount """
+        aggregates = ['cell_counts', 'cell_cat_h', 'cell_cat_s',
+                      'cluster_counts', 'cluster_cat_h', 'cluster_cat_s']
+        self.flush()
+        current = {attr: getattr(self, attr).copy() for attr in aggregates}
+        self.refresh()
+        sums = [self.sum_v, self.sum_v2, self.sum_v_lag, self.sum_v_degree, self.sum_weights,
+                self.num_occupied]
+        self.recount()
+        for attr in aggregates:
+            if not np.array_equal(current[attr], getattr(self, attr)):
+                raise RuntimeError('spatial metrics {} differ from recount'.format(attr))
+        if not np.allclose(sums, [self.sum_v, self.sum_v2, self.sum_v_lag, self.sum_v_degree,
+                                  self.sum_weights, self.num_occupied]):
+            raise RuntimeError("Moran's I sums differ from recount")
+
+    def get_state(self):
+        """ Returns:
+                * dict with collect_freq and collected series. Aggregates are not
+                  part of it, since they are recounted from agents
+        """
+        return {'collect_freq': self.collect_freq, 'collected_steps': self.collected_steps,
+                'collected': self.collected, 'collected_clusters': self.collected_clusters,
+                'collect_local': self.collect_local, 'collected_local': self.collected_local}
+
+    def set_state(self, state):
+        """ Restore collected series from a dict built by get_state """
+        self.collect_freq = state['collect_freq']
+        self.collected_steps = state['collected_steps']
+        self.collected = state['collected']
+        self.collected_clusters = state['collected_clusters']
+        # states saved before local Moran's I could be collected have none
+        self.collect_local = state.get('collect_local', False)
+        self.collected_local = state.get('collected_local', [])
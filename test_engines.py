@@ -0,0 +1,135 @@
+# IMPORT LIBS
+import numpy as np
+import pandas as pd
+import pytest
+
+from model_simple import Simple_Language_Model
+
+SEEDS = range(8)
+STEPS = 30
+# max absolute difference between means over seeds of both engines. Final stats of
+# single runs have a standard deviation of about 0.02 over seeds, so means over
+# 8 seeds have a standard error of about 0.007
+TOLERANCE = 0.03
+
+
+def final_stats(engine, seed):
+    """ Returns:
+            * array with pct of spa, bil and cat agents and mean cat_pct_h of
+              bilinguals after STEPS steps of a model run with given engine and seed
+    """
+    model = Simple_Language_Model(400, width=15, height=15, init_lang_distrib=[0.3, 0.4, 0.3],
+                                  engine=engine, seed=seed)
+    for _ in range(STEPS):
+        model.step()
+    return np.array([model.get_lang_stats(i) for i in range(3)] +
+                    [model.get_bilingual_global_evol('heard')])
+
+
+def agent_columns(model):
+    """ Returns:
+            * dict with a copy of each agent array, up to the last row in use
+    """
+    num_rows = model.ags_data.num_rows
+    return {attr: np.array(getattr(model.ags_data, attr)[:num_rows]) for attr in model.ags_data.columns}
+
+
+def assert_same_agents(model, other):
+    columns, other_columns = agent_columns(model), agent_columns(other)
+    for attr in columns:
+        assert np.array_equal(columns[attr], other_columns[attr]), attr
+
+
+@pytest.fixture(scope='module')
+def engine_stats():
+    return {engine: np.array([final_stats(engine, seed) for seed in SEEDS])
+            for engine in ['agents', 'arrays']}
+
+
+@pytest.mark.parametrize('idx, name', [(0, 'count_spa'), (1, 'count_bil'), (2, 'count_cat'),
+                                       (3, 'biling_evol_h')])
+def test_engines_statistically_equivalent(engine_stats, idx, name):
+    mean_agents = engine_stats['agents'][:, idx].mean()
+    mean_arrays = engine_stats['arrays'][:, idx].mean()
+    assert abs(mean_agents - mean_arrays) <= TOLERANCE, name
+
+
+def test_population_is_conserved(engine_stats):
+    for stats in engine_stats.values():
+        assert np.allclose(stats[:, :3].sum(axis=1), 1)
+
+
+def test_cell_rows_match_buckets_after_agent_moves():
+    model = Simple_Language_Model(400, width=15, height=15, engine='agents', seed=0)
+    for _ in range(3):
+        model.step()
+    grid = model.grid
+    for x in range(grid.width):
+        for y in range(grid.height):
+            bucket_rows = [agent.row for agent in grid.cells.get(grid.cell_id((x, y)), [])]
+            assert sorted(grid.get_cell_rows((x, y)).tolist()) == sorted(bucket_rows), (x, y)
+
+
+@pytest.mark.parametrize('engine, activation', [('agents', 'random'), ('agents', 'simultaneous'),
+                                                ('arrays', 'random'), ('arrays', 'simultaneous'),
+                                                ('cells', 'random')])
+def test_checkpoint_continues_identically(tmp_path, engine, activation):
+    # engine 'cells' has no demographic dynamics
+    rates = {} if engine == 'cells' else dict(birth_rate=0.02, death_rate=0.02, migration_rate=0.02)
+    params = dict(width=15, height=15, engine=engine, activation=activation, seed=1, **rates)
+    model = Simple_Language_Model(400, **params)
+    for _ in range(12):
+        model.step()
+    checkpointed = Simple_Language_Model(400, **params)
+    for _ in range(6):
+        checkpointed.step()
+    checkpointed.save_checkpoint(str(tmp_path / 'model.pkl'))
+    restored = Simple_Language_Model.load_checkpoint(str(tmp_path / 'model.pkl'))
+    for _ in range(6):
+        restored.step()
+    pd.testing.assert_frame_equal(restored.get_model_vars_dataframe(), model.get_model_vars_dataframe(),
+                                  check_exact=True)
+    assert_same_agents(restored, model)
+
+
+def test_simultaneous_step_does_not_depend_on_agent_order():
+    model = Simple_Language_Model(400, width=15, height=15, engine='arrays', activation='simultaneous', seed=2)
+    shuffled = Simple_Language_Model(400, width=15, height=15, engine='arrays', activation='simultaneous', seed=2)
+    # agents of shuffled model are processed in a different order at each step
+    permutations = np.random.default_rng(0)
+    get_rows = shuffled.ags_data.get_rows
+    shuffled.ags_data.get_rows = lambda: permutations.permutation(get_rows())
+    for _ in range(15):
+        model.step()
+        shuffled.step()
+    assert_same_agents(shuffled, model)
+
+
+def test_partitioned_steps_match_single_process():
+    params = dict(width=15, height=15, engine='arrays', activation='simultaneous', seed=3)
+    model = Simple_Language_Model(400, **params)
+    partitioned = Simple_Language_Model(400, **params)
+    partitioned.start_partitioned(processes=3)
+    try:
+        for _ in range(12):
+            model.step()
+            partitioned.step()
+    finally:
+        partitioned.stop_partitioned()
+    assert_same_agents(partitioned, model)
+    pd.testing.assert_frame_equal(partitioned.get_model_vars_dataframe(), model.get_model_vars_dataframe())
+
+
+@pytest.mark.parametrize('engine, on_disk', [('agents', False), ('arrays', False), ('arrays', True)])
+def test_block_steps_match_in_memory_steps(tmp_path, engine, on_disk):
+    params = dict(width=15, height=15, engine=engine, activation='simultaneous', birth_rate=0.02,
+                  death_rate=0.02, migration_rate=0.02, seed=4)
+    model = Simple_Language_Model(400, **params)
+    blocks = Simple_Language_Model(400, block_size=64, storage_dir=str(tmp_path) if on_disk else None,
+                                   **params)
+    for _ in range(12):
+        model.step()
+        blocks.step()
+    assert_same_agents(blocks, model)
+    # running sums of cat pcts may differ by rounding errors
+    pd.testing.assert_frame_equal(blocks.get_model_vars_dataframe(), model.get_model_vars_dataframe())